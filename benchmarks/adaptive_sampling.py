@@ -0,0 +1,124 @@
+"""
+Inference saved by adaptive sampling (pose.infer_scenes_adaptive) compared to inferring every
+sampled frame (pose.infer_scenes), and how often both give the same scene label. The early exit
+(the default) keeps every label, the coarse mode and budgets trade labels for fewer frames.
+
+The fixture set is a seeded set of synthetic scenes with recorded pose predictions: scenes
+without people, with a person in a few frames only, single people of changing quality and
+scenes where a second person appears at some point. A fixture inferencer returns the recorded
+predictions, so no model is needed and every variant sees the same predictions.
+
+Usage (from the repository root):
+    python benchmarks/adaptive_sampling.py [--scenes 500] [--seed 0]
+"""
+import argparse
+import os
+import random
+import sys
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from vlp.api import pose  # noqa: E402
+
+FRAME_WIDTH, FRAME_HEIGHT = 320, 180
+
+# (coarse mode, coarse stride, budget), the first one is the default early exit
+VARIANTS = [(False, 1, 0), (False, 1, 16), (True, 2, 0), (True, 2, 16), (True, 3, 0), (True, 3, 12), (True, 3, 16),
+            (True, 4, 8)]
+
+
+def make_person(quality):
+    '''A prediction rated high, medium or low by pose.rate_frames'''
+    scores = [0.9] * pose.NUM_KEYPOINTS
+    if quality in ('medium', 'low'):
+        scores[13] = scores[14] = 0.2  # knees
+    if quality == 'low':
+        scores[5:13] = [0.4] * 8  # shoulders, arms and hips barely visible
+    return {'keypoints': [[0.0, 0.0]] * pose.NUM_KEYPOINTS, 'keypoint_scores': scores,
+            'bbox': [[10, 10, 110, 170]], 'bbox_score': 0.9}
+
+
+def make_scene_predictions(rng):
+    '''The people of every sampled frame of a random scene of 5 to 40 samples'''
+    frames = rng.randint(5, 40)
+    kind = rng.choice(['nobody', 'glimpse', 'single', 'single', 'multiple'])
+    if kind == 'nobody':
+        return [[] for _ in range(frames)]
+    if kind == 'glimpse':
+        visible = set(rng.sample(range(frames), rng.randint(1, 2)))
+        return [[make_person('low')] if frame in visible else [] for frame in range(frames)]
+
+    # the quality of a single person drifts slowly, a second person appears from a random frame on
+    qualities = []
+    quality = rng.choice(['high', 'medium', 'low'])
+    for _ in range(frames):
+        if rng.random() < 0.2:
+            quality = rng.choice(['high', 'medium', 'low'])
+        qualities.append(quality)
+    second_from = rng.randint(0, frames - 1) if kind == 'multiple' else frames
+    return [[make_person(quality)] + ([make_person('high')] if frame >= second_from else [])
+            for frame, quality in enumerate(qualities)]
+
+
+class FixtureInferencer:
+    '''Returns the recorded predictions of a frame, the frames are arrays holding their fixture index'''
+
+    def __init__(self, predictions):
+        self.predictions = predictions
+        self.calls = 0
+        self.frames = 0
+
+    def __call__(self, inputs, batch_size=1, **kwargs):
+        for start in range(0, len(inputs), batch_size):
+            batch = inputs[start:start + batch_size]
+            self.calls += 1
+            self.frames += len(batch)
+            yield {'predictions': [self.predictions[int(frame[0, 0])] for frame in batch]}
+
+
+def build_fixtures(scene_count, seed):
+    rng = random.Random(seed)
+    predictions = []
+    scenes = []
+    for number in range(scene_count):
+        frames = []
+        for people in make_scene_predictions(rng):
+            frames.append(np.array([[len(predictions)]]))
+            predictions.append(people)
+        scenes.append(pose.Scene('fixture', number, 0.0, 0.0, frames, FRAME_WIDTH, FRAME_HEIGHT))
+    return scenes, predictions
+
+
+def label(results):
+    return [pose.label_scenes([result])[0][3] for result in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenes', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=pose.BATCH_SIZE)
+    args = parser.parse_args()
+
+    scenes, predictions = build_fixtures(args.scenes, args.seed)
+    inferencer = FixtureInferencer(predictions)
+    reference = label(pose.infer_scenes(inferencer, scenes, args.batch_size))
+    print(f"{len(scenes)} scenes, {len(predictions)} sampled frames, labels {dict(Counter(reference))}")
+    print(f"{'all frames':<26}{inferencer.frames:>8} frames{inferencer.calls:>6} calls")
+
+    for coarse, coarse_stride, budget in VARIANTS:
+        inferencer = FixtureInferencer(predictions)
+        labels = label(pose.infer_scenes_adaptive(inferencer, scenes, args.batch_size, coarse=coarse,
+                                                  coarse_stride=coarse_stride, budget=budget))
+        agreement = np.mean([a == b for a, b in zip(labels, reference)])
+        disagreements = Counter(f"{a}->{b}" for a, b in zip(reference, labels) if a != b)
+        name = f"{'coarse ' + str(coarse_stride) if coarse else 'early exit'}, budget {budget or '-'}"
+        print(f"{name:<26}{inferencer.frames:>8} frames{inferencer.calls:>6} calls"
+              f"{1 - inferencer.frames / len(predictions):>7.0%} saved{agreement:>8.1%} agree"
+              f"  {dict(disagreements.most_common(4))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the former per-scene frame sampling of hansposealgorithm.py (seek to every scene,
+read() every frame, keep every 30th) with the single sequential pass of
+sampling.read_scheduled_frames (grab() skipped frames, retrieve() sampled ones).
+
+Usage (from the repository root):
+    python benchmarks/frame_sampling.py [video.mp4 ...] [--scene-seconds 7]
+Without arguments a synthetic 3 minute 720p video is generated. The scenes are fixed
+ranges of --scene-seconds, so both variants sample the same frames.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from vlp.api import sampling  # noqa: E402
+from scene_detection import write_synthetic_video  # noqa: E402
+
+
+def read_with_seeks(video_path, schedule, scene_ranges, step=30):
+    '''The former sampling loop of hansposealgorithm.process_video'''
+    cap = cv2.VideoCapture(video_path)
+    for scene_index, _ in schedule:
+        start_frame, end_frame = scene_ranges[scene_index]
+        frame_count = 0
+        scene_frames = []
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        for _ in range(start_frame, end_frame):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if frame_count % step == 0:
+                scene_frames.append(frame)
+            frame_count += 1
+        yield scene_index, scene_frames
+    cap.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('videos', nargs='*')
+    parser.add_argument('--scene-seconds', type=float, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        videos = args.videos
+        if not videos:
+            path = os.path.join(directory, 'long.mp4')
+            write_synthetic_video(path, [30 * 12] * 15)
+            videos = [path]
+
+        print(f"{'video':<20}{'frames':>8}{'samples':>9}{'seek+read s':>13}{'sequential s':>14}{'saved':>8}{'same frames':>13}")
+        for video in videos:
+            capture = cv2.VideoCapture(video)
+            frames, fps = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), capture.get(cv2.CAP_PROP_FPS)
+            capture.release()
+
+            scene_length = int(args.scene_seconds * fps)
+            scene_ranges = [(start, min(start + scene_length, frames)) for start in range(0, frames, scene_length)]
+            # every 30th frame, like the former loop
+            schedule = sampling.build_schedule(scene_ranges, fps, samples_per_second=fps / 30, max_samples=0)
+
+            start = time.perf_counter()
+            seek_results = list(read_with_seeks(video, schedule, scene_ranges))
+            seek_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            sequential_results = list(sampling.read_scheduled_frames(video, schedule))
+            sequential_seconds = time.perf_counter() - start
+
+            same = all(len(a) == len(b) and all(np.array_equal(x, y) for x, y in zip(a, b))
+                       for (_, a), (_, b) in zip(seek_results, sequential_results))
+            samples = sum(len(frames) for _, frames in sequential_results)
+            print(f"{os.path.basename(video):<20}{frames:>8}{samples:>9}{seek_seconds:>13.2f}{sequential_seconds:>14.2f}"
+                  f"{1 - sequential_seconds / seek_seconds:>8.0%}{str(same):>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Compares scene detection followed by a sampling pass (two decodes of the video) with
+sampling.stream_scenes, which detects the scenes and samples the frames in one decode.
+Reports the total time and the time until the first scene is ready for pose analysis.
+
+Usage (from the repository root):
+    python benchmarks/fused_analysis.py [video.mp4 ...]
+Without arguments a synthetic 3 minute 720p video with 15 scenes is generated.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from vlp.api import sampling, scenes  # noqa: E402
+from scene_detection import write_synthetic_video  # noqa: E402
+
+
+def two_passes(video_path):
+    fps = cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FPS)
+    scene_ranges = [(round(start * fps), round(end * fps)) for start, end in scenes.detect_scenes_exact(video_path)]
+    for scene_index, frames in sampling.read_scheduled_frames(video_path, sampling.build_schedule(scene_ranges, fps)):
+        yield scene_index, frames
+
+
+def one_pass(video_path):
+    for scene_index, _, _, frames in sampling.stream_scenes(video_path):
+        yield scene_index, frames
+
+
+def measure(scene_stream):
+    start = time.perf_counter()
+    first_scene = None
+    samples = 0
+    for _, frames in scene_stream:
+        first_scene = first_scene or time.perf_counter() - start
+        samples += len(frames)
+    return time.perf_counter() - start, first_scene or 0.0, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('videos', nargs='*')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        videos = args.videos
+        if not videos:
+            path = os.path.join(directory, 'long.mp4')
+            write_synthetic_video(path, [30 * 12] * 15)
+            videos = [path]
+
+        print(f"{'video':<20}{'variant':>10}{'total s':>10}{'first scene s':>15}{'samples':>9}")
+        for video in videos:
+            for name, variant in [('two pass', two_passes), ('one pass', one_pass)]:
+                total, first_scene, samples = measure(variant(video))
+                print(f"{os.path.basename(video):<20}{name:>10}{total:>10.2f}{first_scene:>15.2f}{samples:>9}")
+
+
+if __name__ == '__main__':
+    main()
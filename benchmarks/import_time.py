@@ -0,0 +1,63 @@
+"""
+Cold start cost of the server entry points, measured with python -X importtime.
+Reports the cumulative import time of server.wsgi, of server.urls (loaded by the first request)
+and of the heaviest modules, and the wall time of manage.py check.
+
+Usage (from the repository root, with the .env of the server):
+    python benchmarks/import_time.py [--runs 5]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+VLP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vlp')
+
+# modules whose cumulative import time is reported if they are imported at all
+WATCHED_MODULES = ['server.wsgi', 'server.urls', 'api.views', 'api.helpers', 'api.tasks', 'moviepy.editor',
+                   'yt_dlp', 'scenedetect', 'cv2', 'googleapiclient.discovery']
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)')
+
+
+def import_times(code):
+    '''Returns the cumulative import time in ms of every module imported by code'''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=VLP_DIR,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2)) / 1000
+    return times
+
+
+def best_wall_time(command, runs):
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=VLP_DIR, capture_output=True, check=True)
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    # the best of several runs, so the file system cache is warm for both entry points
+    runs = [import_times('import server.wsgi, server.urls') for _ in range(args.runs)]
+    print(f"{'module':<28}{'cumulative ms':>14}")
+    for module in WATCHED_MODULES:
+        measured = [times[module] for times in runs if module in times]
+        print(f"{module:<28}{min(measured) if measured else 0:>14.1f}{'' if measured else '  (not imported)'}")
+
+    print(f"\n{'python -c import server.wsgi, server.urls':<44}{best_wall_time([sys.executable, '-c', 'import server.wsgi, server.urls'], args.runs):>8.2f} s")
+    print(f"{'python manage.py check':<44}{best_wall_time([sys.executable, 'manage.py', 'check'], args.runs):>8.2f} s")
+
+
+if __name__ == '__main__':
+    main()
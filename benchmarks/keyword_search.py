@@ -0,0 +1,48 @@
+"""
+Wall time of the daily keyword sweep: the former serial loop compared with search.run_searches.
+The API is simulated by a search that waits --latency seconds (about the round trip of a
+search.list call), so the numbers show the waiting, not the database writes.
+
+Usage (from the repository root):
+    python benchmarks/keyword_search.py [--keywords 100] [--latency 0.4] [--threads 8]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from vlp.api import search  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keywords', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.4)
+    parser.add_argument('--threads', type=int, default=search.SEARCH_THREADS)
+    args = parser.parse_args()
+
+    keywords = [f'keyword {index}' for index in range(args.keywords)]
+
+    def fake_search(keyword):
+        time.sleep(args.latency)
+        return [keyword]
+
+    start = time.perf_counter()
+    for keyword in keywords:
+        fake_search(keyword)
+    serial_seconds = time.perf_counter() - start
+
+    bucket = search.TokenBucket(args.keywords * search.SEARCH_COST, 0)
+    start = time.perf_counter()
+    results = list(search.run_searches(keywords, fake_search, bucket, threads=args.threads))
+    concurrent_seconds = time.perf_counter() - start
+    assert len(results) == len(keywords)
+
+    print(f"{args.keywords} keywords, {args.latency} s per search")
+    print(f"serial      {serial_seconds:6.1f} s")
+    print(f"{args.threads} threads   {concurrent_seconds:6.1f} s  ({serial_seconds / concurrent_seconds:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
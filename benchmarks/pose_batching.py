@@ -0,0 +1,66 @@
+"""
+CPU throughput of the pose inference at different batch sizes.
+Frames are sampled every 30 frames from the given videos (like hansposealgorithm.py) and run
+through MMPoseInferencer with pose.infer_batched. Needs the analysis environment with mmpose.
+
+Usage (from the repository root):
+    python benchmarks/pose_batching.py video.mp4 [video.mp4 ...] [--batch-sizes 1 4 8 16]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from vlp.api import pose  # noqa: E402
+
+
+def sample_frames(video_paths, step=30, max_frames=64):
+    '''Returns up to max_frames frames, every step-th frame of the videos'''
+    frames = []
+    for video_path in video_paths:
+        capture = cv2.VideoCapture(video_path)
+        frame_num = 0
+        while len(frames) < max_frames and capture.grab():
+            if frame_num % step == 0:
+                frames.append(capture.retrieve()[1])
+            frame_num += 1
+        capture.release()
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('videos', nargs='+')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--max-frames', type=int, default=64)
+    parser.add_argument('--model', default='rtmpose-l')
+    args = parser.parse_args()
+
+    from mmpose.apis import MMPoseInferencer
+    inferencer = MMPoseInferencer(args.model, device='cpu')
+
+    frames = sample_frames(args.videos, max_frames=args.max_frames)
+    keyed_frames = [(('benchmark', 0, frame_count), frame) for frame_count, frame in enumerate(frames)]
+    print(f"{len(frames)} frames, {frames[0].shape[1]}x{frames[0].shape[0]}")
+
+    # warm up, the first call initialises the models
+    list(pose.infer_batched(inferencer, keyed_frames[:2], batch_size=2))
+
+    baseline = None
+    print(f"{'batch size':>10}{'seconds':>10}{'frames/s':>10}{'speedup':>9}")
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        results = list(pose.infer_batched(inferencer, keyed_frames, batch_size=batch_size))
+        seconds = time.perf_counter() - start
+        assert [key for key, _, _ in results] == [key for key, _ in keyed_frames]
+
+        throughput = len(frames) / seconds
+        baseline = baseline or throughput
+        print(f"{batch_size:>10}{seconds:>10.2f}{throughput:>10.2f}{throughput / baseline:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
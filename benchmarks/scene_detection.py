@@ -0,0 +1,138 @@
+"""
+Compares the fast scene detection mode with the exact mode.
+Reports the analysed frames per second of both modes, the recall (share of the exact cuts the fast mode
+finds) and the precision (share of the fast cuts that are exact cuts), at the exact frame and within one frame.
+
+Usage (from the repository root):
+    python benchmarks/scene_detection.py [video.mp4 ...]
+Without arguments synthetic 720p videos with known cuts are generated: slowly changing gradients and
+random textures seen by a panning or zooming camera, whose motion adds up over the skipped frames.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from vlp.api.scenes import detect_scenes, FAST_ANALYSIS_WIDTH, FAST_FRAME_SKIP  # noqa: E402
+
+
+def write_synthetic_video(path, scene_lengths, width=1280, height=720, fps=30, seed=0):
+    '''Writes a video whose scenes are moving gradients with different colors and returns the cut frames'''
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    cuts = []
+    frame_num = 0
+    for scene_length in scene_lengths:
+        if frame_num:
+            cuts.append(frame_num)
+        color_a, color_b = rng.integers(0, 256, size=(2, 3)).astype(np.float32)
+        for i in range(scene_length):
+            shift = (i / scene_length) * 0.3
+            mix = np.clip(x * 0.7 + y * 0.3 + shift, 0, 1)
+            frame = color_a * (1 - mix) + color_b * mix
+            writer.write(frame.astype(np.uint8))
+            frame_num += 1
+    writer.release()
+    return cuts
+
+
+def write_moving_video(path, motion, scene_lengths, width=1280, height=720, fps=30, grain=32, speed=5, seed=0):
+    '''
+    Writes a video whose scenes are random textures seen by a camera that pans speed px per frame
+    or zooms in, and returns the cut frames
+    '''
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    cuts = []
+    frame_num = 0
+    for scene_length in scene_lengths:
+        if frame_num:
+            cuts.append(frame_num)
+        texture_width, texture_height = width + speed * scene_length, height
+        texture = cv2.resize(rng.integers(0, 256, size=(texture_height // grain, texture_width // grain, 3), dtype=np.uint8),
+                             (texture_width, texture_height), interpolation=cv2.INTER_CUBIC)
+        for i in range(scene_length):
+            if motion == 'pan':
+                frame = texture[:height, i * speed:i * speed + width]
+            else:
+                zoom = 1 + i * 0.004
+                crop_width, crop_height = round(width / zoom), round(height / zoom)
+                left, top = (texture_width - crop_width) // 2, (texture_height - crop_height) // 2
+                frame = cv2.resize(texture[top:top + crop_height, left:left + crop_width], (width, height),
+                                   interpolation=cv2.INTER_AREA)
+            writer.write(np.ascontiguousarray(frame))
+            frame_num += 1
+    writer.release()
+    return cuts
+
+
+def get_frame_count_and_fps(path):
+    capture = cv2.VideoCapture(path)
+    frames, fps = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return frames, fps
+
+
+def boundaries(scenes):
+    return [scene[0] for scene in scenes[1:]]
+
+
+def agreement(reference, found, tolerance):
+    '''Share of the reference cut times that have a found cut within tolerance seconds'''
+    if not reference:
+        return 1.0 if not found else 0.0
+    matched = sum(1 for cut in reference if any(abs(cut - other) <= tolerance for other in found))
+    return matched / len(reference)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('videos', nargs='*')
+    parser.add_argument('--analysis-width', type=int, default=FAST_ANALYSIS_WIDTH)
+    parser.add_argument('--frame-skip', type=int, default=FAST_FRAME_SKIP)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        videos = args.videos
+        if not videos:
+            videos = []
+            for seed, scene_lengths in enumerate([[95, 160, 47, 230], [300, 61, 122], [450]]):
+                path = os.path.join(directory, f'synthetic_{seed}.mp4')
+                write_synthetic_video(path, scene_lengths, seed=seed)
+                videos.append(path)
+            for motion in ['pan', 'zoom']:
+                path = os.path.join(directory, f'{motion}.mp4')
+                write_moving_video(path, motion, [150, 90, 200, 60])
+                videos.append(path)
+
+        print(f"{'video':<24}{'frames':>8}{'exact fps':>12}{'fast fps':>12}{'speedup':>9}{'exact cuts':>12}"
+              f"{'recall':>8}{'1 frame':>9}{'precision':>11}{'1 frame':>9}")
+        for video in videos:
+            frames, fps = get_frame_count_and_fps(video)
+
+            start = time.perf_counter()
+            exact = detect_scenes(video)
+            exact_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fast = detect_scenes(video, fast=True, analysis_width=args.analysis_width, frame_skip=args.frame_skip)
+            fast_seconds = time.perf_counter() - start
+
+            exact_cuts, fast_cuts = boundaries(exact), boundaries(fast)
+            print(f"{os.path.basename(video):<24}{frames:>8}{frames / exact_seconds:>12.0f}{frames / fast_seconds:>12.0f}"
+                  f"{exact_seconds / fast_seconds:>8.1f}x{len(exact_cuts):>12}"
+                  f"{agreement(exact_cuts, fast_cuts, 1e-6):>8.0%}"
+                  f"{agreement(exact_cuts, fast_cuts, 1 / fps + 1e-6):>9.0%}"
+                  f"{agreement(fast_cuts, exact_cuts, 1e-6):>11.0%}"
+                  f"{agreement(fast_cuts, exact_cuts, 1 / fps + 1e-6):>9.0%}")
+
+
+if __name__ == '__main__':
+    main()
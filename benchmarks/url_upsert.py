@@ -0,0 +1,97 @@
+"""
+Time to add a batch of urls with helpers.add_urls_to_db compared to the former implementation,
+which looked up all urls with one IN query and then bulk created the missing ones.
+The test database of the configured settings is used (an in-memory database for SQLite),
+--existing of the urls are inserted beforehand, so part of every run are conflicts.
+
+Usage (from the repository root):
+    python benchmarks/url_upsert.py [--urls 100000] [--existing 20000] [--settings server.settings]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'vlp'))
+
+
+def legacy_add_urls_to_db(urls, query=None):
+    '''add_urls_to_db before the chunked insert, kept here for comparison'''
+    from django.db import transaction
+    from django.db.models import Q
+    from api.models import URL, Query
+    from api.youtube import extract_video_id
+
+    new_urls = {}
+    for url in urls:
+        video_id = extract_video_id(url)
+        new_urls.setdefault(video_id or url, URL(url=url, video_id=video_id))
+
+    video_ids = [url.video_id for url in new_urls.values() if url.video_id]
+    existing = URL.objects.filter(Q(url__in=urls) | Q(video_id__in=video_ids)).values_list('url', 'video_id')
+    existing_urls = set()
+    existing_video_ids = set()
+    for url, video_id in existing:
+        existing_urls.add(url)
+        if video_id:
+            existing_video_ids.add(video_id)
+
+    new_urls = [url for url in new_urls.values() if url.url not in existing_urls and url.video_id not in existing_video_ids]
+    if query:
+        query_obj = Query.objects.get(keyword=query)
+        for url in new_urls:
+            url.came_from_keyword = query_obj
+
+    with transaction.atomic():
+        URL.objects.bulk_create(new_urls)
+
+
+def video_id(number):
+    '''An 11 character YouTube video id'''
+    return f'v{number:010d}'
+
+
+def run(name, add_urls, urls, existing):
+    from api.models import URL
+    from api.helpers import add_urls_to_db
+
+    URL.objects.all().delete()
+    add_urls_to_db(urls[:existing])
+    start = time.perf_counter()
+    try:
+        add_urls(urls)
+    except Exception as error:
+        print(f"{name:<10} failed: {type(error).__name__}: {error}")
+        return
+    seconds = time.perf_counter() - start
+    print(f"{name:<10}{seconds:8.2f} s  {URL.objects.count()} urls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--urls', type=int, default=100000)
+    parser.add_argument('--existing', type=int, default=20000)
+    parser.add_argument('--settings', default='server.settings')
+    args = parser.parse_args()
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = args.settings
+    import django
+    django.setup()
+    from django.db import connection
+    from api.helpers import add_urls_to_db
+    from api.youtube import watch_url
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        urls = [watch_url(video_id(number)) for number in range(args.urls)]
+        print(f"{args.urls} urls, {args.existing} already in the database ({connection.vendor})")
+        run('legacy', legacy_add_urls_to_db, urls, args.existing)
+        run('chunked', add_urls_to_db, urls, args.existing)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
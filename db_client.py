@@ -0,0 +1,355 @@
+from dotenv import load_dotenv
+from contextlib import contextmanager
+import os
+import threading
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
+import csv
+from vlp.api.youtube import extract_video_id
+load_dotenv()
+
+
+# Database connection parameters
+db_params = {
+    'dbname': 'defaultdb',
+    'user': 'doadmin',
+    'password': os.environ.get('DO_DATABASE_PASSWORD', None),
+    'host': 'vlp-database-docker-do-user-10555764-0.c.db.ondigitalocean.com',
+    'port': '25060'
+}
+
+# Header of the predictions csv files written by hansposealgorithm.py
+PREDICTION_CSV_COLUMNS = ['Video Name', 'Start Time (s)', 'End Time (s)', 'Classification']
+
+# Upper bound of open connections per process, a worker needs one plus one for the lease heartbeat
+MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 4))
+
+
+class DatabaseClient:
+    """
+    Shared database client of the analysis scripts.
+    Connections are taken from a pool, so a run pays the TLS handshake to the
+    managed Postgres a handful of times instead of once per statement.
+    Every `transaction()` block runs on one connection and cursor and is committed
+    at the end of the block or rolled back if it raises.
+    """
+
+    def __init__(self, params=None, min_connections=1, max_connections=MAX_CONNECTIONS):
+        self.params = params or db_params
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        # The pool is created on first use, so importing a script does not open connections
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self.min_connections, self.max_connections, **self.params)
+            return self._pool
+
+    @contextmanager
+    def transaction(self):
+        '''Yields a cursor, all statements executed on it are committed together'''
+        pool = self._get_pool()
+        connection = pool.getconn()
+        broken = False
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+            connection.commit()
+        except Exception:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                # The connection is lost (e.g. closed by the server), it is dropped and the original error is raised
+                broken = True
+            raise
+        finally:
+            pool.putconn(connection, close=broken or bool(connection.closed))
+
+    def close(self):
+        '''Closes all pooled connections'''
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    # Generic helpers
+    def fetch_all(self, query, params=None):
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def execute(self, query, params=None):
+        '''Executes a single statement and returns the number of affected rows'''
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+            return cursor.rowcount
+
+    def get_table_names(self):
+        return [row[0] for row in self.fetch_all("""
+        SELECT table_name
+        FROM information_schema.tables
+        WHERE table_schema = 'public'
+        """)]
+
+    # URL queue
+    def claim_urls(self, worker_id, batch_size, lease_seconds):
+        """
+        Claims up to batch_size unprocessed urls for worker_id and returns them as (id, url) rows.
+        Urls whose lease has expired (e.g. because the worker crashed) are claimed again.
+        FOR UPDATE SKIP LOCKED lets several workers claim at the same time without
+        waiting for each other or receiving the same url twice.
+        """
+        with self.transaction() as cursor:
+            cursor.execute("""
+            UPDATE api_url
+            SET lease_owner = %s,
+                lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM api_url
+                WHERE is_processed = FALSE
+                  AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, url
+            """, (worker_id, lease_seconds, batch_size))
+            return sorted(cursor.fetchall())
+
+    def renew_leases(self, worker_id, url_ids, lease_seconds):
+        '''Extends the leases of worker_id on the given urls, returns the number of renewed leases'''
+        if not url_ids:
+            return 0
+        return self.execute("""
+        UPDATE api_url
+        SET lease_expires_at = NOW() + make_interval(secs => %s)
+        WHERE id = ANY(%s) AND lease_owner = %s AND is_processed = FALSE
+        """, (lease_seconds, list(url_ids), worker_id))
+
+    def release_leases(self, worker_id, url_ids):
+        '''Gives unprocessed urls back to the queue so other workers can claim them right away'''
+        if not url_ids:
+            return 0
+        return self.execute("""
+        UPDATE api_url
+        SET lease_owner = NULL, lease_expires_at = NULL
+        WHERE id = ANY(%s) AND lease_owner = %s AND is_processed = FALSE
+        """, (list(url_ids), worker_id))
+
+    def record_download_failure(self, url_id, max_attempts, retry_seconds):
+        '''
+        Counts a failed download of a url. Below max_attempts the url can be claimed again after
+        retry_seconds, doubled with every attempt, otherwise it is given up and marked as processed.
+        The lease is dropped either way, so release_leases does not hand the url back right away.
+        Returns True if the url was given up.
+        '''
+        with self.transaction() as cursor:
+            cursor.execute("""
+            UPDATE api_url
+            SET download_attempts = COALESCE(download_attempts, 0) + 1,
+                is_processed = COALESCE(download_attempts, 0) + 1 >= %s,
+                lease_owner = NULL,
+                lease_expires_at = CASE WHEN COALESCE(download_attempts, 0) + 1 >= %s THEN NULL
+                                   ELSE NOW() + make_interval(secs => %s * power(2, COALESCE(download_attempts, 0))) END
+            WHERE id = %s
+            RETURNING is_processed
+            """, (max_attempts, max_attempts, retry_seconds, url_id))
+            row = cursor.fetchone()
+            return bool(row and row[0])
+
+    def mark_processed(self, urls=None, url_ids=None):
+        '''Flags the given urls (by url or by id) as processed and drops their leases'''
+        with self.transaction() as cursor:
+            rowcount = 0
+            if urls:
+                cursor.execute("""
+                UPDATE api_url
+                SET is_processed = TRUE, lease_owner = NULL, lease_expires_at = NULL
+                WHERE url = ANY(%s)
+                """, (list(urls),))
+                rowcount += cursor.rowcount
+            if url_ids:
+                cursor.execute("""
+                UPDATE api_url
+                SET is_processed = TRUE, lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = ANY(%s)
+                """, (list(url_ids),))
+                rowcount += cursor.rowcount
+            return rowcount
+
+    def add_urls(self, urls):
+        '''Inserts new unprocessed urls, urls or videos that are already known are skipped'''
+        with self.transaction() as cursor:
+            # Without a conflict target both the url and the video id constraint are respected
+            rows = execute_values(cursor, """
+            INSERT INTO api_url (url, video_id, is_processed)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING id
+            """, [(url, extract_video_id(url), False) for url in urls], fetch=True)
+            return len(rows)
+
+    def save_video_metadata(self, url_id, metadata):
+        '''Stores the metadata of a downloaded video (see vlp/api/downloads.py) on its url row'''
+        return self.execute("""
+        UPDATE api_url
+        SET duration = %s, fps = %s, width = %s, height = %s, filesize = %s, upload_date = %s
+        WHERE id = %s
+        """, (metadata.get('duration'), metadata.get('fps'), metadata.get('width'), metadata.get('height'),
+              metadata.get('filesize'), metadata.get('upload_date'), url_id))
+
+    # Analysis results
+    def has_timestamps(self, video_id):
+        '''True if the url with the id video_id already has timestamps'''
+        return bool(self.fetch_all("""
+        SELECT 1 FROM api_videotimestamps
+        WHERE video_id = %s
+        LIMIT 1
+        """, (video_id,)))
+
+    def insert_timestamps(self, video_id, scenes, skip_existing=True):
+        """
+        Inserts all scenes ([start, end] in seconds) of a video in one statement.
+        With skip_existing nothing is inserted if the video already has timestamps.
+        Returns the number of inserted rows.
+        """
+        with self.transaction() as cursor:
+            if skip_existing:
+                cursor.execute("""
+                SELECT 1 FROM api_videotimestamps
+                WHERE video_id = %s
+                LIMIT 1
+                """, (video_id,))
+                if cursor.fetchone():
+                    return 0
+
+            if not scenes:
+                return 0
+
+            rows = execute_values(cursor, """
+            INSERT INTO api_videotimestamps (video_id, start_time, end_time)
+            VALUES %s
+            RETURNING id
+            """, [(video_id, scene[0], scene[1]) for scene in scenes], fetch=True)
+            return len(rows)
+
+    def insert_predictions(self, predictions, page_size=1000):
+        """
+        Inserts (video name, start time, end time, classification) rows as predictions.
+        The url and the timestamp of every row are resolved in the same statement,
+        rows without a matching url or timestamp are skipped, as are rows of timestamps
+        that already have a prediction (e.g. when a video is analysed again), whatever their label.
+        Of several rows of one timestamp only one is inserted.
+        Returns the number of inserted predictions.
+        """
+        if not predictions:
+            return 0
+
+        with self.transaction() as cursor:
+            inserted = 0
+            for offset in range(0, len(predictions), page_size):
+                # One page per statement, RETURNING is needed to count the rows of the whole page
+                rows = execute_values(cursor, """
+                INSERT INTO api_prediction (video_timestamp_id, prediction)
+                SELECT DISTINCT ON (t.id) t.id, v.prediction
+                FROM (VALUES %s) AS v (video_name, start_time, end_time, prediction)
+                JOIN api_url u ON u.video_id = v.video_name
+                JOIN api_videotimestamps t
+                  ON t.video_id = u.id AND t.start_time = v.start_time AND t.end_time = v.end_time
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM api_prediction p
+                    WHERE p.video_timestamp_id = t.id
+                )
+                ORDER BY t.id, v.prediction
+                RETURNING id
+                """, [tuple(row) for row in predictions[offset:offset + page_size]],
+                    template='(%s, %s::double precision, %s::double precision, %s)',
+                    page_size=page_size, fetch=True)
+                inserted += len(rows)
+            return inserted
+
+    def copy_predictions_csv(self, csv_file):
+        """
+        Bulk ingest of a predictions csv file (see PREDICTION_CSV_COLUMNS).
+        The file is streamed into a temporary staging table with COPY, urls and timestamps
+        are resolved with one set-based join and all matched rows are inserted with a single
+        statement. Everything runs in one transaction.
+        Returns a summary dict with the number of rows, inserted predictions, duplicates
+        (matched rows of timestamps that already have a prediction) and the unmatched rows as
+        (video name, start time, end time, classification, reason) tuples.
+        """
+        header = next(csv.reader([csv_file.readline()]), [])
+        if [column.strip() for column in header] != PREDICTION_CSV_COLUMNS:
+            raise ValueError(f"Unexpected predictions csv header: {header}")
+
+        with self.transaction() as cursor:
+            cursor.execute("""
+            CREATE TEMP TABLE prediction_staging (
+                video_name TEXT,
+                start_time DOUBLE PRECISION,
+                end_time DOUBLE PRECISION,
+                prediction VARCHAR(2)
+            ) ON COMMIT DROP
+            """)
+
+            # The header has already been consumed, COPY streams the remaining lines
+            cursor.copy_expert("COPY prediction_staging FROM STDIN WITH (FORMAT csv)", csv_file)
+
+            # Video names are resolved through the video id index, every row to the first matching timestamp
+            cursor.execute("""
+            CREATE TEMP TABLE prediction_matches ON COMMIT DROP AS
+            SELECT s.video_name, s.start_time, s.end_time, s.prediction, u.id AS url_id, t.id AS timestamp_id
+            FROM prediction_staging s
+            LEFT JOIN api_url u ON u.video_id = s.video_name
+            LEFT JOIN LATERAL (
+                SELECT id FROM api_videotimestamps
+                WHERE video_id = u.id AND start_time = s.start_time AND end_time = s.end_time
+                LIMIT 1
+            ) t ON TRUE
+            """)
+
+            # A timestamp gets one prediction: timestamps that have one are skipped, whatever their label,
+            # and of several rows of one timestamp in the file only one is inserted
+            cursor.execute("""
+            INSERT INTO api_prediction (video_timestamp_id, prediction)
+            SELECT DISTINCT ON (m.timestamp_id) m.timestamp_id, m.prediction FROM prediction_matches m
+            WHERE m.timestamp_id IS NOT NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM api_prediction p
+                  WHERE p.video_timestamp_id = m.timestamp_id
+              )
+            ORDER BY m.timestamp_id, m.prediction
+            """)
+            inserted = cursor.rowcount
+
+            cursor.execute("""
+            SELECT video_name, start_time, end_time, prediction,
+                   CASE WHEN url_id IS NULL THEN 'url not found' ELSE 'timestamp not found' END
+            FROM prediction_matches
+            WHERE timestamp_id IS NULL
+            ORDER BY video_name, start_time
+            """)
+            unmatched = cursor.fetchall()
+
+            cursor.execute("SELECT COUNT(*) FROM prediction_staging")
+            rows = cursor.fetchone()[0]
+
+        duplicates = rows - inserted - len(unmatched)
+        return {'rows': rows, 'inserted': inserted, 'duplicates': duplicates, 'unmatched': unmatched}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    '''Returns the process wide DatabaseClient'''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = DatabaseClient()
+        return _client
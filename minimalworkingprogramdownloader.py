@@ -1,6 +1,6 @@
 import os
-import yt_dlp as youtube_dl
 from pytube import YouTube
+from vlp.api import downloads
 
 
 def download_video_pytube(url):
@@ -30,25 +30,11 @@ def download_video_pytube(url):
 # Download
 def download_video(url):
     """
-    This function creates a variable ydl_opts containing how the video should be downloaded 
-    and then uses the yt_dlp module to download the video into the download_directory
+    This function downloads the video with the yt_dlp module into the download_directory
+    and returns the file path together with the metadata of the video.
+    The extractor only runs once (see vlp/api/downloads.py).
     """
-    ydl_opts = {
-        'format': 'best[height<=720]',  # best quality up to 720p
-        'outtmpl': f'{download_directory}/%(id)s.%(ext)s',  # Save file as the video ID
-        'postprocessors': [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4',  # Ensure the video is in mp4 format
-        }]
-    }
-
-    # Create a YoutubeDL object with the options
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    
-    video_id = youtube_dl.YoutubeDL().extract_info(url, download=False)['id']
-    file_path = f"{download_directory}/{video_id}.mp4"
-    return file_path
+    return downloads.download_video(url, download_directory)
 
 
 if __name__ == "__main__":
@@ -60,6 +46,7 @@ if __name__ == "__main__":
     # new_youtube_url = 'https://www.youtube.com/shorts/MkzFodsSOHc'  # insert url here
     url = "https://www.youtube.com/watch?v=5ukw9wVRYg4"
 
-    file_path = download_video(url)
+    file_path, metadata = download_video(url)
+    print(file_path, metadata)
 
     
\ No newline at end of file
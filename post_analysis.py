@@ -1,96 +1,71 @@
 from dotenv import load_dotenv
 import os
 import psycopg2
-from psycopg2.extras import execute_values
+from db_client import get_client
 load_dotenv()
 import csv
 
 
-# Database connection parameters
-db_params = {
-    'dbname': 'defaultdb',
-    'user': 'doadmin',
-    'password': os.environ.get('DO_DATABASE_PASSWORD', None),
-    'host': 'vlp-database-docker-do-user-10555764-0.c.db.ondigitalocean.com',
-    'port': '25060'
-}
-
 def get_table_names():
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Query to get all table names
-        query = """
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = 'public'
-        """
-
-        # Execute the query
-        cursor.execute(query)
-
-        # Fetch all table names
-        tables = cursor.fetchall()
-
         # Print the table names
-        for table in tables:
-            print(table[0])
+        for table in get_client().get_table_names():
+            print(table)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
-def insert_csv_file_in_db(filepath=None):
+def read_predictions_csv(csv_file):
+    '''Returns the (video name, start time, end time, classification) rows of a predictions csv file'''
+    csv_reader = csv.DictReader(csv_file)
+    return [
+        (row['Video Name'], float(row['Start Time (s)']), float(row['End Time (s)']), row['Classification'])
+        for row in csv_reader
+    ]
+
+def insert_csv_file_in_db(filepath=None, bulk=True):
+    '''
+    Inserts the predictions of a csv file into the database.
+    The bulk mode streams the file into the database with COPY and matches all rows at once,
+    otherwise the rows are read in python and inserted in batches.
+    '''
     try:
         if not filepath:
             base_output_dir = os.path.join(os.getcwd(), 'output')
+            filepath = os.path.join(base_output_dir, 'predictions.csv')
+
+        if bulk:
+            with open(filepath, mode='r', newline='') as csv_file:
+                summary = get_client().copy_predictions_csv(csv_file)
+            print_ingest_summary(summary)
+            return summary
+
+        with open(filepath, mode='r') as csv_file:
+            predictions = read_predictions_csv(csv_file)
 
-            with open(os.path.join(base_output_dir, 'predictions.csv'), mode='r') as csv_file:
-                csv_reader = csv.DictReader(csv_file)
-                for row in csv_reader:
-                    video_id = row['Video Name']
-                    start_time = float(row['Start Time (s)'])
-                    end_time = float(row['End Time (s)'])
-                    prediction = row['Classification']
-                    insert_prediction_to_db(video_id, start_time, end_time, prediction)
-
-        else:
-            with open(filepath, mode='r') as csv_file:
-                csv_reader = csv.DictReader(csv_file)
-                for row in csv_reader:
-                    video_id = row['Video Name']
-                    start_time = float(row['Start Time (s)'])
-                    end_time = float(row['End Time (s)'])
-                    prediction = row['Classification']
-                    insert_prediction_to_db(video_id, start_time, end_time, prediction)
+        # All rows are matched and inserted in batches over one pooled connection
+        inserted = get_client().insert_predictions(predictions)
+        print(f"{inserted} of {len(predictions)} predictions inserted")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL or the file does not exist: {error}")
 
+def print_ingest_summary(summary, max_unmatched_rows=20):
+    print(f"{summary['inserted']} of {summary['rows']} predictions inserted, {summary.get('duplicates', 0)} already stored, "
+          f"{len(summary['unmatched'])} rows unmatched")
+    for video_name, start_time, end_time, prediction, reason in summary['unmatched'][:max_unmatched_rows]:
+        print(f"  {video_name} {start_time}-{end_time} {prediction}: {reason}")
+    if len(summary['unmatched']) > max_unmatched_rows:
+        print(f"  ... {len(summary['unmatched']) - max_unmatched_rows} more")
+
 
 def fetch_urls(print_output=False):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # SQL query to fetch URLs
-        fetch_query = """
+        rows = get_client().fetch_all("""
         SELECT * 
         FROM api_url
-        """
-        # Execute the fetch query
-        cursor.execute(fetch_query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         if print_output:
@@ -101,28 +76,13 @@ def fetch_urls(print_output=False):
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 def fetch_timestamps(print_output=False):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # SQL query to fetch timestamps for a given video ID
-        fetch_query = """
+        rows = get_client().fetch_all("""
         SELECT * 
         FROM api_videotimestamps
-        """
-        # Execute the fetch query
-        cursor.execute(fetch_query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         if print_output:
@@ -133,74 +93,22 @@ def fetch_timestamps(print_output=False):
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def insert_prediction_to_db(video_id, start_time, end_time, prediction):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Execute the query
-        cursor.execute("SELECT id FROM api_URL WHERE url LIKE %s", ('%' + video_id + '%',))
-        video_url_result = cursor.fetchone()
-
-        if not video_url_result:
-            print("Video URL not found.")
-            return
-        
-        video_url_id = video_url_result[0]
-         # Step 2: Find the corresponding VideoTimeStamps ID
-        cursor.execute(
-            "SELECT id FROM api_VideoTimeStamps WHERE video_id = %s AND start_time = %s AND end_time = %s",
-            (video_url_id, start_time, end_time)
-        )
-        video_timestamp_result = cursor.fetchone()
-        if not video_timestamp_result:
-            print("VideoTimeStamps entry not found.")
-            return
-
-        video_timestamp_id = video_timestamp_result[0]
-
-        # Step 3: Insert the new prediction
-        cursor.execute(
-            "INSERT INTO api_Prediction (video_timestamp_id, prediction) VALUES (%s, %s)",
-            (video_timestamp_id, prediction)
-        )
-
-        # Commit the transaction
-        connection.commit()
+        if not get_client().insert_predictions([(video_id, float(start_time), float(end_time), prediction)]):
+            print("Video URL or VideoTimeStamps entry not found.")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 def fetch_predictions(print_output=False):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # SQL query to fetch predictions
-        fetch_query = """
+        rows = get_client().fetch_all("""
         SELECT * 
         FROM api_prediction
-        """
-        # Execute the fetch query
-        cursor.execute(fetch_query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         if print_output:
@@ -211,12 +119,6 @@ def fetch_predictions(print_output=False):
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 if __name__ == "__main__":
     
@@ -227,4 +129,4 @@ if __name__ == "__main__":
     # insert_prediction_to_db("MkzFodsSOHc", "56.88", "58.16", "TE")
     # fetch_predictions(print_output=True)
 
-
+    get_client().close()
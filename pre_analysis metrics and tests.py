@@ -1,97 +1,40 @@
 from dotenv import load_dotenv
 import os
-import yt_dlp as youtube_dl
 import psycopg2
-from psycopg2.extras import execute_values
 from scenedetect import open_video, SceneManager
 from scenedetect.detectors import ContentDetector
+from db_client import get_client
+from vlp.api import downloads
 load_dotenv()
 
 
-# Database connection parameters
-db_params = {
-    'dbname': 'defaultdb',
-    'user': 'doadmin',
-    'password': os.environ.get('DO_DATABASE_PASSWORD', None),
-    'host': 'vlp-database-docker-do-user-10555764-0.c.db.ondigitalocean.com',
-    'port': '25060'
-}
-
 def get_table_names():
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Query to get all table names
-        query = """
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = 'public'
-        """
-
-        # Execute the query
-        cursor.execute(query)
-
-        # Fetch all table names
-        tables = cursor.fetchall()
-
         # Print the table names
-        for table in tables:
-            print(table[0])
+        for table in get_client().get_table_names():
+            print(table)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def connect_and_retrieve(query):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Execute the query
-        cursor.execute(query)
-
-        # Fetch all rows from the executed query
-        rows = cursor.fetchall()
-
         # Print the retrieved data
-        for row in rows:
+        for row in get_client().fetch_all(query):
             print(row)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
 def get_unprocessed_rows():
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # Query to get rows where is_processed is False
-        query = """
+        rows = get_client().fetch_all("""
         SELECT * FROM api_url
         WHERE is_processed = FALSE
-        """
-
-        # Execute the query
-        cursor.execute(query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         for row in rows:
@@ -102,29 +45,12 @@ def get_unprocessed_rows():
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def get_all_rows():
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Query to get rows where is_processed is False
-        query = """
+        rows = get_client().fetch_all("""
         SELECT * FROM api_url
-        """
-
-        # Execute the query
-        cursor.execute(query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         for row in rows:
@@ -135,189 +61,76 @@ def get_all_rows():
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def update_processed_rows():
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # Update query to set is_processed to True
-        update_query = """
+        rowcount = get_client().execute("""
         UPDATE api_url
         SET is_processed = TRUE
         WHERE is_processed = FALSE
-        """
-
-        # Execute the update query
-        cursor.execute(update_query)
+        """)
 
-        # Commit the transaction
-        connection.commit()
-
-        print(f"{cursor.rowcount} rows updated to is_processed = True")
+        print(f"{rowcount} rows updated to is_processed = True")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def update_processed_rows_by_url(url):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Update query to set is_processed to True
-        update_query = """
-        UPDATE api_url
-        SET is_processed = TRUE
-        WHERE url = (%s)
-        """ 
+        # Set is_processed to True and drop the lease
+        rowcount = get_client().mark_processed(urls=[url])
 
-        # Execute the update query
-        cursor.execute(update_query, (url,))
-
-        # Commit the transaction
-        connection.commit()
-
-        print(f"{cursor.rowcount} rows updated to is_processed = True")
+        print(f"{rowcount} rows updated to is_processed = True")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
 def add_new_url(youtube_url):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # SQL query to insert a new record
-        insert_query = """
-        INSERT INTO api_url (url, is_processed)
-        VALUES (%s, %s)
-        """
-        # Values to be inserted
-        values = (youtube_url, False)
-
-        # Execute the insert query
-        cursor.execute(insert_query, values)
-
-        # Commit the transaction
-        connection.commit()
-
-        print("New URL added successfully")
+        # add_urls skips urls and videos that are already known, it returns the number of inserted rows
+        if get_client().add_urls([youtube_url]):
+            print("New URL added successfully")
+        else:
+            print("URL already exists")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
-
 
 # Download
 def download_video(url):
     """
-    This function creates a variable ydl_opts containing how the video should be downloaded 
-    and then uses the yt_dlp module to download the video into the download_directory
+    This function downloads the video with the yt_dlp module into the download_directory
+    and returns the file path together with the metadata of the video.
+    The extractor only runs once (see vlp/api/downloads.py).
     """
-    ydl_opts = {
-        'format': 'best[height<=720]',  # best quality up to 720p
-        'outtmpl': f'{download_directory}/%(id)s.%(ext)s',  # Save file as the video ID
-        'postprocessors': [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4',  # Ensure the video is in mp4 format
-        }]
-    }
-
-    # Create a YoutubeDL object with the options
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    
-    video_id = youtube_dl.YoutubeDL().extract_info(url, download=False)['id']
-    file_path = f"{download_directory}/{video_id}.mp4"
-    return file_path
+    return downloads.download_video(url, download_directory)
 
 def make_test_url_false():
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # Query to get rows where is_processed is False
-        query = """
+        get_client().execute("""
         UPDATE api_url
         SET is_processed = FALSE
         WHERE url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
-        """
-
-        # Execute the query
-        cursor.execute(query)
-
-        connection.commit()
+        """)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def add_timestamp(video_id, start_time, end_time):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # SQL query to insert a new timestamp
-        insert_query = """
-        INSERT INTO api_videotimestamps (video_id, start_time, end_time)
-        VALUES (%s, %s, %s)
-        """
-        # Values to be inserted
-        values = (video_id, start_time, end_time)
-
-        # Execute the insert query
-        cursor.execute(insert_query, values)
-
-        # Commit the transaction
-        connection.commit()
+        get_client().insert_timestamps(video_id, [[start_time, end_time]], skip_existing=False)
 
         print("Timestamp added successfully")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 # Video Analysis
 def detect_video_scenes(input_video_path, threshold=30.0):
@@ -349,63 +162,24 @@ def detect_video_scenes(input_video_path, threshold=30.0):
 
 def add_multiple_timestamps(video_id, scenes):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Check if there are existing timestamps for the video
-        check_query = """
-        SELECT 1 FROM api_videotimestamps
-        WHERE video_id = %s
-        LIMIT 1
-        """
-        cursor.execute(check_query, (video_id,))
-        if cursor.fetchone():
+        # Timestamps are only inserted if the video has none yet
+        if not get_client().insert_timestamps(video_id, scenes) and scenes:
             print("Timestamps already exist for this video. Exiting.")
             return
 
-        # SQL query to insert multiple timestamps
-        insert_query = """
-        INSERT INTO api_videotimestamps (video_id, start_time, end_time)
-        VALUES %s
-        """
-        # Create a list of tuples for the values to be inserted
-        values = [(video_id, scene[0], scene[1]) for scene in scenes]
-
-        # Use psycopg2's execute_values for efficient bulk insert
-        execute_values(cursor, insert_query, values)
-
-        # Commit the transaction
-        connection.commit()
-
         print("Timestamps added successfully")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def fetch_timestamps(print_output=False):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # SQL query to fetch timestamps for a given video ID
-        fetch_query = """
+        rows = get_client().fetch_all("""
         SELECT * 
         FROM api_videotimestamps
-        """
-        # Execute the fetch query
-        cursor.execute(fetch_query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         if print_output:
@@ -416,28 +190,14 @@ def fetch_timestamps(print_output=False):
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
 def fetch_and_analyze_timestamps(print_output=False):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # SQL query to fetch timestamps for a given video ID
-        fetch_query = """
+        rows = get_client().fetch_all("""
         SELECT * 
         FROM api_videotimestamps
-        """
-        # Execute the fetch query
-        cursor.execute(fetch_query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Initialize counters for timestamps over and under 5 seconds
         over_5_seconds = 0
@@ -463,11 +223,6 @@ def fetch_and_analyze_timestamps(print_output=False):
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
 if __name__ == "__main__":
     # Definining download directory
@@ -480,4 +235,6 @@ if __name__ == "__main__":
     # rows = get_all_rows()
     # connect_and_retrieve("SELECT * FROM api_query")
     fetch_and_analyze_timestamps(print_output=True)
-    # print(rows)
\ No newline at end of file
+    # print(rows)
+
+    get_client().close()
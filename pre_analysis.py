@@ -1,98 +1,57 @@
 from dotenv import load_dotenv
 import os
+import socket
+import threading
 import yt_dlp as youtube_dl
 from pytube import YouTube
 import psycopg2
-from psycopg2.extras import execute_values
-from scenedetect import open_video, SceneManager
-from scenedetect.detectors import ContentDetector
+from db_client import get_client
+from vlp.api import downloads, scenes, result_cache
 load_dotenv()
 
 
-# Database connection parameters
-db_params = {
-    'dbname': 'defaultdb',
-    'user': 'doadmin',
-    'password': os.environ.get('DO_DATABASE_PASSWORD', None),
-    'host': 'vlp-database-docker-do-user-10555764-0.c.db.ondigitalocean.com',
-    'port': '25060'
-}
+# Seconds a claimed url stays reserved for a worker without a heartbeat
+LEASE_SECONDS = 15 * 60
 
-def get_table_names():
-    try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Query to get all table names
-        query = """
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = 'public'
-        """
+# Seconds between two lease renewals of the heartbeat thread
+HEARTBEAT_INTERVAL = 60
 
-        # Execute the query
-        cursor.execute(query)
+# A url whose download fails is claimed again after DOWNLOAD_RETRY_SECONDS, doubled with every failed attempt,
+# and given up (marked as processed) after MAX_DOWNLOAD_ATTEMPTS
+MAX_DOWNLOAD_ATTEMPTS = int(os.environ.get('MAX_DOWNLOAD_ATTEMPTS', 5))
+DOWNLOAD_RETRY_SECONDS = int(os.environ.get('DOWNLOAD_RETRY_SECONDS', 60 * 60))
 
-        # Fetch all table names
-        tables = cursor.fetchall()
+# The timestamps are detected like hansposealgorithm detects the scenes of its predictions (exact mode, same
+# threshold), the predictions are matched to the timestamps by their start and end time
+SCENE_THRESHOLD = 30.0
 
+def get_table_names():
+    try:
         # Print the table names
-        for table in tables:
-            print(table[0])
+        for table in get_client().get_table_names():
+            print(table)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def connect_and_retrieve(query):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Execute the query
-        cursor.execute(query)
-
-        # Fetch all rows from the executed query
-        rows = cursor.fetchall()
-
         # Print the retrieved data
-        for row in rows:
+        for row in get_client().fetch_all(query):
             print(row)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
 def get_unprocessed_rows(print_rows=True):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # Query to get rows where is_processed is False
-        query = """
+        rows = get_client().fetch_all("""
         SELECT * FROM api_url
         WHERE is_processed = FALSE
-        """
-
-        # Execute the query
-        cursor.execute(query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         if print_rows:
@@ -104,103 +63,124 @@ def get_unprocessed_rows(print_rows=True):
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
-def update_processed_rows():
+def get_worker_id():
+    '''Returns an identifier for this worker process, unique across the cluster nodes'''
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def claim_unprocessed_rows(worker_id, batch_size=10, lease_seconds=LEASE_SECONDS):
+    """
+    Claims up to batch_size unprocessed urls for worker_id and returns them as (id, url) rows.
+    Urls whose lease has expired (e.g. because the worker crashed) are claimed again.
+    """
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
+        return get_client().claim_urls(worker_id, batch_size, lease_seconds)
 
-        # Update query to set is_processed to True
-        update_query = """
-        UPDATE api_url
-        SET is_processed = TRUE
-        WHERE is_processed = FALSE
-        """
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error while connecting to PostgreSQL: {error}")
+        return []
+
+
+def renew_leases(worker_id, url_ids, lease_seconds=LEASE_SECONDS):
+    '''Extends the leases of worker_id on the given urls, returns the number of renewed leases'''
+    try:
+        return get_client().renew_leases(worker_id, url_ids, lease_seconds)
 
-        # Execute the update query
-        cursor.execute(update_query)
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error while connecting to PostgreSQL: {error}")
+        return 0
 
-        # Commit the transaction
-        connection.commit()
 
-        print(f"{cursor.rowcount} rows updated to is_processed = True")
+def release_leases(worker_id, url_ids):
+    '''Gives unprocessed urls back to the queue so other workers can claim them right away'''
+    try:
+        get_client().release_leases(worker_id, url_ids)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
+class LeaseHeartbeat(threading.Thread):
+    """
+    Background thread that renews the leases of the urls a worker is still holding,
+    so long downloads or analyses are not reclaimed by other workers.
+    """
 
-def update_processed_rows_by_url(url):
+    def __init__(self, worker_id, url_ids, interval=HEARTBEAT_INTERVAL, lease_seconds=LEASE_SECONDS):
+        super().__init__(daemon=True)
+        self.worker_id = worker_id
+        self.url_ids = set(url_ids)
+        self.interval = interval
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                url_ids = list(self.url_ids)
+            renew_leases(self.worker_id, url_ids, self.lease_seconds)
+
+    def done(self, url_id):
+        '''Stops renewing the lease of a url that has been processed'''
+        with self._lock:
+            self.url_ids.discard(url_id)
+
+    def stop(self):
+        '''Stops the heartbeat and releases the leases of all urls that were not processed'''
+        self._stopped.set()
+        self.join()
+        release_leases(self.worker_id, list(self.url_ids))
+
+
+def record_download_failure(url_id, max_attempts=MAX_DOWNLOAD_ATTEMPTS, retry_seconds=DOWNLOAD_RETRY_SECONDS):
+    '''Backs off a url whose download failed, or gives it up after max_attempts, see DatabaseClient.record_download_failure'''
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
+        return get_client().record_download_failure(url_id, max_attempts, retry_seconds)
+
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error while connecting to PostgreSQL: {error}")
+        return False
 
+
+def update_processed_rows():
+    try:
         # Update query to set is_processed to True
-        update_query = """
+        rowcount = get_client().execute("""
         UPDATE api_url
         SET is_processed = TRUE
-        WHERE url = (%s)
-        """ 
-
-        # Execute the update query
-        cursor.execute(update_query, (url,))
-
-        # Commit the transaction
-        connection.commit()
+        WHERE is_processed = FALSE
+        """)
 
-        print(f"{cursor.rowcount} rows updated to is_processed = True")
+        print(f"{rowcount} rows updated to is_processed = True")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
-def add_new_url(youtube_url):
+def update_processed_rows_by_url(url):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
+        # Set is_processed to True and drop the lease
+        rowcount = get_client().mark_processed(urls=[url])
 
-        # SQL query to insert a new record
-        insert_query = """
-        INSERT INTO api_url (url, is_processed)
-        VALUES (%s, %s)
-        """
-        # Values to be inserted
-        values = (youtube_url, False)
+        print(f"{rowcount} rows updated to is_processed = True")
 
-        # Execute the insert query
-        cursor.execute(insert_query, values)
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error while connecting to PostgreSQL: {error}")
 
-        # Commit the transaction
-        connection.commit()
 
-        print("New URL added successfully")
+def add_new_url(youtube_url):
+    try:
+        # add_urls skips urls and videos that are already known, it returns the number of inserted rows
+        if get_client().add_urls([youtube_url]):
+            print("New URL added successfully")
+        else:
+            print("URL already exists")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
 
 def download_video_pytube(url):
     """
@@ -230,173 +210,87 @@ def download_video_pytube(url):
 # Download
 def download_video(url):
     """
-    This function creates a variable ydl_opts containing how the video should be downloaded 
-    and then uses the yt_dlp module to download the video into the download_directory
+    This function downloads the video with the yt_dlp module into the download_directory
+    and returns the file path together with the metadata of the video.
+    The extractor only runs once (see vlp/api/downloads.py).
     """
-    ydl_opts = {
-        'format': 'best[height<=720]',  # best quality up to 720p
-        'outtmpl': f'{download_directory}/%(id)s.%(ext)s',  # Save file as the video ID
-        'postprocessors': [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4',  # Ensure the video is in mp4 format
-        }]
-    }
-
-    # Create a YoutubeDL object with the options
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    
-    video_id = youtube_dl.YoutubeDL().extract_info(url, download=False)['id']
-    file_path = f"{download_directory}/{video_id}.mp4"
-    return file_path
+    return downloads.download_video(url, download_directory)
 
-def make_test_url_false():
+def save_video_metadata(url_id, metadata):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
+        get_client().save_video_metadata(url_id, metadata)
 
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error while connecting to PostgreSQL: {error}")
+
+def make_test_url_false():
+    try:
         # Query to get rows where is_processed is False
-        query = """
+        get_client().execute("""
         UPDATE api_url
         SET is_processed = FALSE
         WHERE url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
-        """
-
-        # Execute the query
-        cursor.execute(query)
-
-        connection.commit()
+        """)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 def add_timestamp(video_id, start_time, end_time):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # SQL query to insert a new timestamp
-        insert_query = """
-        INSERT INTO api_videotimestamps (video_id, start_time, end_time)
-        VALUES (%s, %s, %s)
-        """
-        # Values to be inserted
-        values = (video_id, start_time, end_time)
-
-        # Execute the insert query
-        cursor.execute(insert_query, values)
-
-        # Commit the transaction
-        connection.commit()
+        get_client().insert_timestamps(video_id, [[start_time, end_time]], skip_existing=False)
 
         print("Timestamp added successfully")
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 # Video Analysis
-def detect_video_scenes(input_video_path, threshold=30.0):
+def detect_video_scenes(input_video_path, threshold=SCENE_THRESHOLD):
     '''
     detects the scenes in a video, seperated by cuts.
     Returns a list of timestamps in seconds.
+    Every frame is scored (exact mode, see vlp/api/scenes.py), as by sampling.stream_scenes in
+    hansposealgorithm, otherwise a cut found by one of them only would leave predictions unmatched.
+    The scenes are cached per video and parameters (see vlp/api/result_cache.py).
     '''
+    video_id = os.path.basename(input_video_path).split('.')[0]
+    return result_cache.get_cache().get_or_compute(
+        video_id, 'scenes', scenes.SCENES_VERSION, scenes.scene_params(threshold),
+        lambda: scenes.detect_scenes(input_video_path, threshold=threshold))
 
-    # Open the video file
-    video = open_video(input_video_path)
-
-    # Add ContentDetector algorithm with adjustable threshold
-    scene_manager = SceneManager()
-    scene_manager.add_detector(ContentDetector(threshold=threshold))
-
-    # Perform scene detection
-    scene_manager.detect_scenes(video)
-    scene_list = scene_manager.get_scene_list()
-
-    # convert list into the correct format
-    formatted_scene_list = []
-    for i, scene in enumerate(scene_list):
-        start_time = scene[0].get_seconds()
-        end_time = scene[1].get_seconds()
+def has_timestamps(video_id):
+    try:
+        return get_client().has_timestamps(video_id)
 
-        formatted_scene_list.append([start_time, end_time])
-    
-    return formatted_scene_list
+    except (Exception, psycopg2.Error) as error:
+        print(f"Error while connecting to PostgreSQL: {error}")
+        return False
 
 def add_multiple_timestamps(video_id, scenes):
+    '''Returns True once the video has its timestamps, False if they could not be stored'''
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
-        # Check if there are existing timestamps for the video
-        check_query = """
-        SELECT 1 FROM api_videotimestamps
-        WHERE video_id = %s
-        LIMIT 1
-        """
-        cursor.execute(check_query, (video_id,))
-        if cursor.fetchone():
+        # Timestamps are only inserted if the video has none yet
+        if not get_client().insert_timestamps(video_id, scenes) and scenes:
             print("Timestamps already exist for this video. Exiting.")
-            return
-
-        # SQL query to insert multiple timestamps
-        insert_query = """
-        INSERT INTO api_videotimestamps (video_id, start_time, end_time)
-        VALUES %s
-        """
-        # Create a list of tuples for the values to be inserted
-        values = [(video_id, scene[0], scene[1]) for scene in scenes]
-
-        # Use psycopg2's execute_values for efficient bulk insert
-        execute_values(cursor, insert_query, values)
-
-        # Commit the transaction
-        connection.commit()
+            return True
 
         print("Timestamps added successfully")
+        return True
 
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
-
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
+        return False
 
 
 def fetch_timestamps(print_output=False):
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
-        cursor = connection.cursor()
-
         # SQL query to fetch timestamps for a given video ID
-        fetch_query = """
+        rows = get_client().fetch_all("""
         SELECT * 
         FROM api_videotimestamps
-        """
-        # Execute the fetch query
-        cursor.execute(fetch_query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
+        """)
 
         # Print the rows
         if print_output:
@@ -407,15 +301,10 @@ def fetch_timestamps(print_output=False):
     except (Exception, psycopg2.Error) as error:
         print(f"Error while connecting to PostgreSQL: {error}")
 
-    finally:
-        # Close the database connection
-        if connection:
-            cursor.close()
-            connection.close()
-
 
 if __name__ == "__main__":
     MAX_NUMBER_OF_ROWS = 100
+    CLAIM_BATCH_SIZE = 10
 
     # Definining download directory
     download_directory = os.path.join(os.getcwd(), 'youtube-downloads')
@@ -424,24 +313,56 @@ if __name__ == "__main__":
     # new_youtube_url = 'https://www.youtube.com/shorts/MkzFodsSOHc'  # insert url here
     # add_new_url(new_youtube_url)
     # make_test_url_false()
-    rows = get_unprocessed_rows(print_rows=False)
-    rows = rows[:MAX_NUMBER_OF_ROWS]
-
-    for row in rows:
+    worker_id = get_worker_id()
+    number_of_processed_rows = 0
+
+    # Claim small batches so several workers can drain the queue in parallel
+    while number_of_processed_rows < MAX_NUMBER_OF_ROWS:
+        batch_size = min(CLAIM_BATCH_SIZE, MAX_NUMBER_OF_ROWS - number_of_processed_rows)
+        rows = claim_unprocessed_rows(worker_id, batch_size=batch_size)
+        if not rows:
+            break
+
+        heartbeat = LeaseHeartbeat(worker_id, [row[0] for row in rows])
+        heartbeat.start()
         try:
-            url = row[1]
-            file_path = download_video(url)
-            update_processed_rows_by_url(url)
-        except youtube_dl.utils.DownloadError:
-            print(f"Error downloading video from URL: {url}. PLEASE UPDATE PACKAGE")
-        except Exception as e:
-                # Check if the exception is a DownloadError
-            if isinstance(e, youtube_dl.utils.DownloadError):
-                print(f"Download error: {e}")
-            else:
-                print(f"An unexpected error occurred: {e}")
-            update_processed_rows_by_url(url)  # the video has an error, so we mark it as processed and
-            continue    
-        scenes = detect_video_scenes(file_path)
-        add_multiple_timestamps(row[0], scenes)
-    
\ No newline at end of file
+            for row in rows:
+                number_of_processed_rows += 1
+                url = row[1]
+                if has_timestamps(row[0]):
+                    # analysed before, e.g. by a worker that died before marking it, no need to download it again
+                    print(f"Timestamps already exist for {url}, skipping download and scene detection")
+                    update_processed_rows_by_url(url)
+                    heartbeat.done(row[0])
+                    continue
+                try:
+                    file_path, metadata = download_video(url)
+                    save_video_metadata(row[0], metadata)
+                except youtube_dl.utils.DownloadError:
+                    print(f"Error downloading video from URL: {url}. PLEASE UPDATE PACKAGE")
+                    # the url is retried after a backoff, so failing urls do not block the queue
+                    if record_download_failure(row[0]):
+                        print(f"Giving up {url} after {MAX_DOWNLOAD_ATTEMPTS} failed downloads")
+                    heartbeat.done(row[0])
+                    continue
+                except Exception as e:
+                        # Check if the exception is a DownloadError
+                    if isinstance(e, youtube_dl.utils.DownloadError):
+                        print(f"Download error: {e}")
+                    else:
+                        print(f"An unexpected error occurred: {e}")
+                    update_processed_rows_by_url(url)  # the video has an error, so we mark it as processed and
+                    heartbeat.done(row[0])
+                    continue
+
+                # The url is only marked as processed once its timestamps are stored. Until then the heartbeat
+                # renews its lease, if the worker dies the lease expires and another worker claims the url again,
+                # if the timestamps can not be stored the lease is released when the batch is done
+                scene_list = detect_video_scenes(file_path)
+                if add_multiple_timestamps(row[0], scene_list):
+                    update_processed_rows_by_url(url)
+                    heartbeat.done(row[0])
+        finally:
+            heartbeat.stop()
+
+    get_client().close()
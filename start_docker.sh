@@ -12,7 +12,13 @@ sleep 5  # Adjust sleep time as needed for Redis to start
 cd vlp
 
 # Start Celery worker
-celery -A server worker --loglevel=info &
+celery -A server worker -Q celery -n default@%h --loglevel=info &
+
+# Url pipeline workers (see CELERY_TASK_ROUTES): many processes for the I/O bound downloads,
+# few for the CPU bound analysis, which must not reserve more tasks than it runs
+# Both read and write the download directory, workers on other hosts need it mounted (VIDEO_DOWNLOAD_DIR)
+celery -A server worker -Q downloads -n downloads@%h --concurrency=${DOWNLOAD_CONCURRENCY:-8} --prefetch-multiplier=4 --loglevel=info &
+celery -A server worker -Q analysis -n analysis@%h --concurrency=${ANALYSIS_CONCURRENCY:-2} --prefetch-multiplier=1 --loglevel=info &
 
 # Start Celery Beat if needed
 celery -A server beat --loglevel=info &
@@ -0,0 +1,54 @@
+import os
+from datetime import datetime
+
+
+def get_ydl_opts(download_directory):
+    '''Returns the yt_dlp options: best quality up to 720p, saved as <video id>.mp4 in download_directory'''
+    return {
+        'format': 'best[height<=720]',  # best quality up to 720p
+        'outtmpl': f'{download_directory}/%(id)s.%(ext)s',  # Save file as the video ID
+        'postprocessors': [{
+            'key': 'FFmpegVideoConvertor',
+            'preferedformat': 'mp4',  # Ensure the video is in mp4 format
+        }]
+    }
+
+
+def extract_video_metadata(info, file_path=None):
+    '''
+    Returns the metadata of a yt_dlp info dict that is stored on the URL row.
+    The file size is taken from the downloaded file if it exists.
+    '''
+    upload_date = info.get('upload_date')  # YYYYMMDD
+    filesize = info.get('filesize') or info.get('filesize_approx')
+    if file_path and os.path.exists(file_path):
+        filesize = os.path.getsize(file_path)
+
+    return {
+        'video_id': info.get('id'),
+        'duration': info.get('duration'),
+        'fps': info.get('fps'),
+        'width': info.get('width'),
+        'height': info.get('height'),
+        'filesize': filesize,
+        'upload_date': datetime.strptime(upload_date, '%Y%m%d').date() if upload_date else None,
+    }
+
+
+def download_video(url, download_directory, ydl_class=None):
+    """
+    Downloads the video of url into download_directory and returns the file path together with
+    the metadata of the video (id, duration, fps, resolution, file size, upload date).
+    The extractor runs once, the metadata comes from the info dict of the download itself.
+    ydl_class replaces yt_dlp.YoutubeDL, e.g. with a local stand-in in the tests.
+    """
+    if ydl_class is None:
+        import yt_dlp as youtube_dl  # imported on first download, it is slow to import
+        ydl_class = youtube_dl.YoutubeDL
+
+    # Create a YoutubeDL object with the options
+    with ydl_class(get_ydl_opts(download_directory)) as ydl:
+        info = ydl.extract_info(url, download=True)
+
+    file_path = f"{download_directory}/{info['id']}.mp4"
+    return file_path, extract_video_metadata(info, file_path)
@@ -1,42 +1,44 @@
 import os
-import yt_dlp as youtube_dl
+import threading
+from typing import TYPE_CHECKING
 from server.settings import BASE_DIR, GOOGLE_DEV_API_KEY, DEBUG
-from moviepy.editor import VideoFileClip
-from scenedetect import open_video, SceneManager
-from scenedetect.detectors import ContentDetector
-from .models import URL, Query
-from django.db import transaction
-from googleapiclient.discovery import build
-from datetime import datetime
+from .models import URL, Query, VideoTimeStamps, Prediction, USEFUL_LABELS
+from .youtube import extract_video_id, watch_url
+from .stats import invalidate_graph_stats
+from django.db import transaction, connection
+from django.db.models import Q
+from django.utils import timezone
+from datetime import datetime, timedelta
 
+# moviepy, yt_dlp, scenedetect and the google api client are only imported by the functions that use them,
+# so the web server, manage.py commands and the tests do not pay for them at startup
+if TYPE_CHECKING:
+    from moviepy.editor import VideoFileClip
 
-# Definining download directory
-download_directory = os.path.join(BASE_DIR,'youtube-downloads')
+
+# Definining download directory, the analysis workers read the videos from it (see CELERY_TASK_ROUTES)
+download_directory = os.environ.get('VIDEO_DOWNLOAD_DIR', os.path.join(BASE_DIR,'youtube-downloads'))
 
 
 # Download
-def download_video(url):
+def download_video(url, ydl_class=None):
     """
-    This function creates a variable ydl_opts containing how the video should be downloaded 
-    and then uses the yt_dlp module to download the video into the download_directory
+    This function downloads the video with the yt_dlp module into the download_directory
+    and returns the file path together with the metadata of the video.
+    The extractor only runs once (see downloads.download_video).
     """
-    # ydl_opts specifies download paramter
-    ydl_opts = {
-        'format': 'best[height<=720]',  # best quality up to 720p
-        'outtmpl': f'{download_directory}/%(id)s.%(ext)s',  # Save file as the video ID
-        'postprocessors': [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4',  # Ensure the video is in mp4 format
-        }]
-    }
-
-    # Create a YoutubeDL object with the options
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    
-    video_id = youtube_dl.YoutubeDL().extract_info(url, download=False)['id']
-    file_path = f"{download_directory}/{video_id}.mp4"
-    return file_path
+    from . import downloads
+    return downloads.download_video(url, download_directory, ydl_class=ydl_class)
+
+
+# Fields of the URL model that are filled from the video metadata
+VIDEO_METADATA_FIELDS = ['duration', 'fps', 'width', 'height', 'filesize', 'upload_date']
+
+
+def save_video_metadata(url, metadata):
+    '''Stores the metadata of a downloaded video on its URL row'''
+    return URL.objects.filter(url=url).update(**{field: metadata.get(field) for field in VIDEO_METADATA_FIELDS})
+
 
 # Delete 
 def delete_file(file_path):
@@ -76,10 +78,11 @@ def delete_folder_from_video_path(video_path):
 # Video File clip and screenshots
 def get_video_file_clip(video_path):
     ''' This function returns a VideoFileClip object from the video path'''
+    from moviepy.editor import VideoFileClip
     video = VideoFileClip(video_path)
     return video
 
-def take_screenshot_at_second(video : VideoFileClip, second, output_dir):
+def take_screenshot_at_second(video : 'VideoFileClip', second, output_dir):
     """
     This function takes a screenshot of the video at a specific second and saves it to the output_path
     """
@@ -90,42 +93,31 @@ def take_screenshot_at_second(video : VideoFileClip, second, output_dir):
     return output_path
 
 
-def get_video_duration(video : VideoFileClip):
+def get_video_duration(video : 'VideoFileClip'):
     """
     This function returns the duration of a video in seconds
     """
     return video.duration
 
-def get_video_area(video : VideoFileClip):
+def get_video_area(video : 'VideoFileClip'):
     """
     This function returns the area of the video in pixels
     """
     return video.size[0] * video.size[1]
 
 
-def detect_video_scenes(input_video_path, threshold=30.0):
+def detect_video_scenes(input_video_path, threshold=30.0, fast=False):
     '''
     detects the scenes in a video, seperated by cuts.
     Returns a list of timestamps in seconds.
+    fast downscales and skips frames, see scenes.detect_scenes_fast.
     '''
+    from . import scenes
+    scene_list = scenes.detect_scenes(input_video_path, threshold=threshold, fast=fast)
 
-    # Open the video file
-    video = open_video(input_video_path)
-
-    # Add ContentDetector algorithm with adjustable threshold
-    scene_manager = SceneManager()
-    scene_manager.add_detector(ContentDetector(threshold=threshold))
-
-    # Perform scene detection
-    scene_manager.detect_scenes(video)
-    scene_list = scene_manager.get_scene_list()
-
-    # convert list into the correct format
+    # scenes shorter than 2 seconds are dropped
     formatted_scene_list = []
-    for i, scene in enumerate(scene_list):
-        start_time = scene[0].get_seconds()
-        end_time = scene[1].get_seconds()
-
+    for start_time, end_time in scene_list:
         if (end_time - start_time) < 2:
             continue
 
@@ -134,33 +126,154 @@ def detect_video_scenes(input_video_path, threshold=30.0):
     return formatted_scene_list
 
 
+def classify_video_scenes(input_video_path, scene_list):
+    '''
+    Classifies the scenes ([start, end] in seconds) of a video with the pose model (see pose.py),
+    scenes shorter than sampling.MIN_SCENE_SECONDS are not classified.
+    Returns [start, end, classification] for every classified scene.
+    '''
+    import cv2
+    from . import pose, sampling
 
-def add_urls_to_db(urls, query=None):
-    # Fetch existing URLs
-    existing_urls = URL.objects.filter(url__in=urls).values_list('url', flat=True)
+    capture = cv2.VideoCapture(input_video_path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    frame_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    capture.release()
 
-    # Determine new URLs to be added
-    new_urls = set([url for url in urls if url not in existing_urls]) # set for no duplicates
+    schedule = sampling.build_schedule([(round(start * fps), round(end * fps)) for start, end in scene_list], fps)
+    video_name = os.path.basename(input_video_path).split('.')[0]
+    scenes = (pose.Scene(video_name, scene_index, scene_list[scene_index][0], scene_list[scene_index][1], frames,
+                         frame_width, frame_height)
+              for scene_index, frames in sampling.read_scheduled_frames(input_video_path, schedule))
 
-    if query:
-        # Fetch the query object
-        query_obj = Query.objects.get(keyword=query)
+    keypoints = pose.infer_scenes_sampled(pose.get_inferencer(), scenes)
+    return [[start, end, classification] for _, start, end, classification in pose.label_scenes(keypoints)]
 
-        # Bulk create new URL objects with the query
-        with transaction.atomic():
-            URL.objects.bulk_create([URL(url=url, came_from_keyword=query_obj) for url in new_urls])
-    else:
-        # Bulk create new URL objects
+
+# URL queue, the Django side of db_client.claim_urls
+def claim_urls(owner, batch_size, lease_seconds):
+    '''
+    Claims up to batch_size unprocessed urls for owner and returns their ids.
+    Urls whose lease has expired are claimed again. On Postgres the rows are locked with
+    SKIP LOCKED, so concurrent claims never return the same url.
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        url_ids = list(URL.objects.select_for_update(skip_locked=True)
+                       .filter(Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now), is_processed=False)
+                       .order_by('id').values_list('id', flat=True)[:batch_size])
+        URL.objects.filter(id__in=url_ids).update(lease_owner=owner,
+                                                  lease_expires_at=now + timedelta(seconds=lease_seconds))
+    return url_ids
+
+
+def mark_url_processed(url_id):
+    '''Flags the url as processed and drops its lease'''
+    return URL.objects.filter(id=url_id).update(is_processed=True, lease_owner=None, lease_expires_at=None)
+
+
+def save_analysis_results(url_id, scene_list, predictions):
+    '''
+    Stores the scenes ([start, end]) of a video as VideoTimeStamps and its classified scenes
+    ([start, end, classification]) as their Predictions, with one bulk insert each, updates the
+    quality metric of the keyword of the video and marks the url as processed. Nothing is
+    inserted if the video already has timestamps, so a retried write does not duplicate rows.
+    Returns the number of inserted predictions.
+    '''
+    with transaction.atomic():
+        url = URL.objects.select_for_update().get(id=url_id)
+        inserted = 0
+        if not VideoTimeStamps.objects.filter(video=url).exists():
+            timestamps = VideoTimeStamps.objects.bulk_create(
+                [VideoTimeStamps(video=url, start_time=start, end_time=end) for start, end in scene_list])
+            timestamps = {(timestamp.start_time, timestamp.end_time): timestamp for timestamp in timestamps}
+            new_predictions = Prediction.objects.bulk_create(
+                [Prediction(video_timestamp=timestamps[(start, end)], prediction=classification)
+                 for start, end, classification in predictions if (start, end) in timestamps])
+            inserted = len(new_predictions)
+
+            # The classified scenes count towards the quality metric of the keyword the video was found for
+            if url.came_from_keyword_id and inserted:
+                Query.add_classified_scenes(url.came_from_keyword_id, inserted,
+                                            sum(prediction.prediction in USEFUL_LABELS for prediction in new_predictions))
+        mark_url_processed(url_id)
+
+    # bulk_create does not send the signals that invalidate the stats
+    invalidate_graph_stats()
+    return inserted
+
+
+# Urls per insert statement on databases without a parameter limit (Postgres allows 65535 parameters),
+# on SQLite the chunks are smaller, see url_chunk_size
+URL_CHUNK_SIZE = 2000
+
+# Parameters of one url row in the insert statement
+URL_INSERT_COLUMNS = ['url', 'video_id', 'is_processed', 'came_from_keyword_id']
+
+
+def url_chunk_size():
+    '''Urls per statement, so neither the insert nor the lookup of a chunk exceeds the parameter limit'''
+    max_params = connection.features.max_query_params
+    if max_params is None:
+        return URL_CHUNK_SIZE
+    return max(1, min(URL_CHUNK_SIZE, max_params // len(URL_INSERT_COLUMNS)))
+
+
+def insert_urls_ignore_conflicts(rows):
+    '''
+    Inserts (url, video_id, is_processed, came_from_keyword_id) rows with one statement and returns the ids
+    of the inserted rows. Rows that conflict with an existing url or video id are skipped by the database,
+    also if another process inserted them after they were looked up, so concurrent writers never fail
+    on the unique constraints. Works on Postgres and SQLite (3.35+).
+    '''
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(column) for column in URL_INSERT_COLUMNS)
+    values = ', '.join(['(%s)' % ', '.join(['%s'] * len(URL_INSERT_COLUMNS))] * len(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {quote(URL._meta.db_table)} ({columns}) VALUES {values} "
+                       f"ON CONFLICT DO NOTHING RETURNING {quote('id')}",
+                       [value for row in rows for value in row])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def add_urls_to_db(urls, query=None):
+    '''
+    Adds urls as unprocessed videos, urls of the same video (by canonical video id) only once.
+    The urls are inserted in chunks, every chunk with one insert that skips the urls already in
+    the model and one lookup of the ids of those.
+    Returns the ids of the inserted urls and the ids of the urls that already existed.
+    '''
+    # Canonical video id of every url, urls of the same video are only added once
+    new_urls = {}
+    for url in urls:
+        video_id = extract_video_id(url)
+        new_urls.setdefault(video_id or url, (url, video_id))
+    new_urls = list(new_urls.values())
+
+    query_id = Query.objects.get(keyword=query).id if query else None
+
+    inserted_ids = []
+    existing_ids = []
+    chunk_size = url_chunk_size()
+    for start in range(0, len(new_urls), chunk_size):
+        chunk = new_urls[start:start + chunk_size]
         with transaction.atomic():
-            URL.objects.bulk_create([URL(url=url) for url in new_urls])
+            inserted = insert_urls_ignore_conflicts([(url, video_id, False, query_id) for url, video_id in chunk])
 
-    # Fetch all URLs after insertion
-    # all_urls = URL.objects.filter(url__in=urls)
-    # response_data = [{'id': url.id, 'url': url.url} for url in all_urls]
+            # The urls that were skipped, matched by url or by video id (index lookups)
+            chunk_urls = [url for url, _ in chunk]
+            chunk_video_ids = [video_id for _, video_id in chunk if video_id]
+            matched = URL.objects.filter(Q(url__in=chunk_urls) | Q(video_id__in=chunk_video_ids)).values_list('id', flat=True)
+            inserted_set = set(inserted)
+            existing_ids.extend(url_id for url_id in matched if url_id not in inserted_set)
+        inserted_ids.extend(inserted)
+
+    return inserted_ids, existing_ids
 
 
 def add_url_to_db(url, query=None):
-    add_urls_to_db([url], query=query)
+    return add_urls_to_db([url], query=query)
 
 
 def mock_search_videos_and_add_to_db(query, video_amount = 50):
@@ -170,30 +283,64 @@ def mock_search_videos_and_add_to_db(query, video_amount = 50):
     pass
 
 
-if not DEBUG:
-    # Create a service object for interacting with the API
-    youtube = build('youtube', 'v3', developerKey = GOOGLE_DEV_API_KEY)
+def mock_search_video_ids(query, video_amount = 50):
+    '''
+    This function mocks the search_video_ids function, it finds no videos
+    '''
+    return []
+
+
+_youtube = threading.local()
 
+
+def get_youtube_client():
+    '''
+    Returns the service object for interacting with the API.
+    It is created on first use and reused afterwards, once per thread, because the
+    http client of the service object is not thread safe.
+    '''
+    if getattr(_youtube, 'client', None) is None:
+        from googleapiclient.discovery import build
+        _youtube.client = build('youtube', 'v3', developerKey = GOOGLE_DEV_API_KEY)
+    return _youtube.client
+
+
+def search_video_ids(query, video_amount = 50):
+    '''
+    Searches the youtube API for up to video_amount (default: 50) videos of a query and
+    returns their video ids, with a single search.list call and without touching the database
+    '''
+
+    # Make a request to the API's search.list method to retrieve videos
+    request = get_youtube_client().search().list(
+        part ='snippet',
+        q = query,
+        type = 'video',
+        maxResults = video_amount,
+        order='date'
+    )
+
+    response = request.execute()
+    return [item['id']['videoId'] for item in response['items']]
+
+
+def add_search_results_to_db(query, video_ids):
+    '''
+    Fills the videos found for a query into the URL model as unprocessed videos, all videos
+    of the response with one insert (see add_urls_to_db) and the query resolved once.
+    Returns the number of new and of already known videos.
+    '''
+    inserted_ids, existing_ids = add_urls_to_db([watch_url(video_id) for video_id in video_ids], query=query)
+    return len(inserted_ids), len(existing_ids)
+
+
+if not DEBUG:
     def search_videos_and_add_to_db(query, video_amount = 50):
         '''
         Accepts a query and video_amount (default: 50) to use the youtube API to search for videos 
         and then fills them into the URL model as unprocessed videos
         '''
-
-        # Make a request to the API's search.list method to retrieve videos
-        request = youtube.search().list(
-            part ='snippet',
-            q = query,
-            type = 'video',
-            maxResults = video_amount,
-            order='date'
-        )
-        
-        response = request.execute()
-        
-    # Adding the Urls into the URL model
-        for item in response['items']:
-            add_url_to_db(f"https://www.youtube.com/watch?v={item['id']['videoId']}", query=query)
+        return add_search_results_to_db(query, search_video_ids(query, video_amount))
 
 else:
     def search_videos_and_add_to_db(query, video_amount = 50):
@@ -203,6 +350,14 @@ else:
         print("MOCK SEARCH")
         pass
 
+def scheduled_keywords(count=100):
+    '''
+    The count keywords that are due first. The precomputed priority (Query.next_search_at) is read
+    in the order of its index, so only count rows are read however many keywords there are.
+    '''
+    return list(Query.objects.order_by('next_search_at', 'id')[:count])
+
+
 def add_keyword_to_Query(Keyword):
     '''
     This function adds an Keyword to the Query model 
@@ -0,0 +1,153 @@
+import os
+import re
+import uuid
+import codecs
+from contextlib import nullcontext
+from django.db import connection, transaction
+from django.utils import timezone
+from server.settings import BASE_DIR
+from .models import Query, KeywordImport
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Uploads up to this size are imported within the request, larger ones by the import_keywords_file task
+SYNC_IMPORT_BYTES = int(os.environ.get('KEYWORD_IMPORT_SYNC_BYTES', 256 * 1024))
+
+# Directory of the uploads waiting for the import task, it must be shared with the celery worker
+IMPORT_DIRECTORY = os.environ.get('KEYWORD_IMPORT_DIR', os.path.join(BASE_DIR, 'keyword-imports'))
+
+# Bytes read from the file at a time and distinct keywords per insert
+CHUNK_SIZE = 64 * 1024
+BATCH_SIZE = 500
+
+# Keywords are separated by commas, line breaks are separators too
+KEYWORD_SEPARATOR = re.compile(r'[,\r\n]')
+
+KEYWORD_MAX_LENGTH = Query._meta.get_field('keyword').max_length
+
+
+def normalize_keyword(keyword):
+    '''Strips whitespace and lowercases a keyword, like Query.clean_keyword'''
+    return keyword.strip().lower()
+
+
+def split_keywords(chunks):
+    '''
+    Decodes byte chunks of a utf-8 file incrementally and yields (bytes of the chunk, keywords completed
+    in the chunk). A keyword cut by a chunk boundary is yielded with the chunk it ends in.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    tail = ''
+    for chunk in chunks:
+        *keywords, tail = KEYWORD_SEPARATOR.split(tail + decoder.decode(chunk))
+        yield len(chunk), keywords
+    yield 0, KEYWORD_SEPARATOR.split(tail + decoder.decode(b'', final=True))
+
+
+def insert_keywords(keywords):
+    '''
+    Adds distinct normalized keywords to the Query model, keywords that exist or are inserted meanwhile
+    by someone else are skipped by the database (ON CONFLICT DO NOTHING, like helpers.add_urls_to_db).
+    Returns the number of new keywords, counted from the ids the inserts return, so keywords another
+    writer inserted are not counted. The statements stay below the parameter limit of the database.
+    '''
+    fields = [field for field in Query._meta.concrete_fields if not field.primary_key]
+    rows = []
+    for keyword in keywords:
+        query = Query(keyword=keyword)
+        rows.append([field.get_db_prep_save(field.pre_save(query, True), connection) for field in fields])
+
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(field.column) for field in fields)
+    max_params = connection.features.max_query_params
+    chunk_size = max(1, max_params // len(fields)) if max_params else len(rows)
+    added = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            values = ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(chunk))
+            cursor.execute(f"INSERT INTO {quote(Query._meta.db_table)} ({columns}) VALUES {values} "
+                           f"ON CONFLICT DO NOTHING RETURNING {quote('id')}",
+                           [value for row in chunk for value in row])
+            added += len(cursor.fetchall())
+    return added
+
+
+def import_keywords(chunks, progress=None, batch_size=BATCH_SIZE):
+    '''
+    Imports the keywords of a file given as byte chunks, without holding more than one batch in memory.
+    The keywords are normalized and deduplicated per batch, progress(stats) is called after every batch.
+    Returns the stats: bytes_read, keywords (duplicates included), added and skipped (too long).
+    '''
+    stats = {'bytes_read': 0, 'keywords': 0, 'added': 0, 'skipped': 0}
+    batch = {}
+    for size, keywords in split_keywords(chunks):
+        stats['bytes_read'] += size
+        for keyword in keywords:
+            keyword = normalize_keyword(keyword)
+            if not keyword:
+                continue
+            if len(keyword) > KEYWORD_MAX_LENGTH:
+                stats['skipped'] += 1
+                continue
+            stats['keywords'] += 1
+            batch[keyword] = None
+            if len(batch) >= batch_size:
+                stats['added'] += insert_keywords(list(batch))
+                batch = {}
+                if progress:
+                    progress(stats)
+
+    if batch:
+        stats['added'] += insert_keywords(list(batch))
+    return stats
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            yield chunk
+
+
+def store_upload(uploaded_file):
+    '''Writes an uploaded file chunk by chunk to IMPORT_DIRECTORY and returns its path'''
+    os.makedirs(IMPORT_DIRECTORY, exist_ok=True)
+    path = os.path.join(IMPORT_DIRECTORY, f'{uuid.uuid4().hex}.txt')
+    with open(path, 'wb') as file:
+        for chunk in uploaded_file.chunks(CHUNK_SIZE):
+            file.write(chunk)
+    return path
+
+
+def run_import(keyword_import, chunks, atomic=False):
+    '''
+    Imports the chunks of a KeywordImport and keeps its status and progress up to date.
+    With atomic all keywords are inserted in one transaction, so a failed import adds none,
+    otherwise every batch is committed on its own and the status of a failed import says how
+    many keywords were added before. A file that is not utf-8 fails the import, other errors
+    are raised after the import is marked failed.
+    '''
+    imports = KeywordImport.objects.filter(id=keyword_import.id)
+    imports.update(status=KeywordImport.RUNNING)
+    progress = {'added': 0}
+
+    def save_progress(stats):
+        progress.update(stats)
+        imports.update(**stats)
+
+    def fail(error):
+        kept = 'no keywords were added' if atomic else f"the {progress['added']} keywords before were added"
+        imports.update(status=KeywordImport.FAILED, error=f"{error}, {kept}", finished_at=timezone.now())
+
+    try:
+        with transaction.atomic() if atomic else nullcontext():
+            stats = import_keywords(chunks, progress=save_progress)
+    except UnicodeDecodeError as error:
+        fail(f"The file is not utf-8 encoded: {error}")
+        return
+    except Exception as error:
+        fail(error)
+        raise
+    imports.update(status=KeywordImport.DONE, finished_at=timezone.now(), **stats)
+    logger.info(f"Keyword import {keyword_import.id}: {stats['added']} of {stats['keywords']} keywords added")
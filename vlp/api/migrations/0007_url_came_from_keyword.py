@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_query'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='came_from_keyword',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.query'),
+        ),
+    ]
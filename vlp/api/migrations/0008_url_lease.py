@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_url_came_from_keyword'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='url',
+            index=models.Index(fields=['is_processed', 'lease_expires_at'], name='url_claim_idx'),
+        ),
+    ]
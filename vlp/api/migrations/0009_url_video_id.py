@@ -0,0 +1,73 @@
+import re
+
+from django.db import migrations, models, transaction
+
+
+# Number of urls loaded and updated per transaction while backfilling
+CHUNK_SIZE = 1000
+
+# A copy of api.youtube.VIDEO_ID_PATTERN as of this migration, later changes must not change the backfill
+VIDEO_ID_PATTERN = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])'
+)
+
+
+def extract_video_id(url):
+    match = VIDEO_ID_PATTERN.search(url or '')
+    return match.group(1) if match else None
+
+
+def backfill_video_ids(apps, schema_editor):
+    '''
+    Sets the video id of all existing urls, chunk by chunk in the order of their ids.
+    If several urls point to the same video only the oldest one gets the id, so the unique
+    constraint can be added afterwards: ids given to an earlier chunk are looked up in the
+    database, only the ids of the current chunk are held in memory.
+    '''
+    URL = apps.get_model('api', 'URL')
+    urls = URL.objects.using(schema_editor.connection.alias)
+
+    last_id = 0
+    while True:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            chunk = list(urls.filter(id__gt=last_id).order_by('id').only('id', 'url', 'video_id')[:CHUNK_SIZE])
+            if not chunk:
+                break
+
+            video_ids = {url.id: extract_video_id(url.url) for url in chunk if url.video_id is None}
+            taken = set(urls.filter(video_id__in={video_id for video_id in video_ids.values() if video_id})
+                        .values_list('video_id', flat=True))
+            updated_urls = []
+            for url in chunk:
+                video_id = video_ids.get(url.id)
+                if video_id and video_id not in taken:
+                    url.video_id = video_id
+                    taken.add(video_id)
+                    updated_urls.append(url)
+            urls.bulk_update(updated_urls, ['video_id'])
+
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    # Every backfill chunk is committed on its own, so big tables are not locked in one transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0008_url_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='video_id',
+            field=models.CharField(blank=True, max_length=11, null=True),
+        ),
+        migrations.RunPython(backfill_video_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='url',
+            name='video_id',
+            field=models.CharField(blank=True, max_length=11, null=True, unique=True),
+        ),
+    ]
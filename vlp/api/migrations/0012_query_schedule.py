@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:55
+
+import math
+import datetime
+from django.db import migrations, models
+
+
+# Number of keywords loaded and updated at a time while backfilling
+CHUNK_SIZE = 1000
+
+# models.keyword_due_time as of this migration, copied so later changes of the model code do not change it
+SEARCH_INTERVAL = datetime.timedelta(days=1)
+QUALITY_WEIGHT = 3
+NEVER_SEARCHED = datetime.datetime(1, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def keyword_due_time(last_processed, use_counter, quality_metric):
+    if last_processed is None or last_processed.year == 1:
+        return NEVER_SEARCHED
+    return last_processed + SEARCH_INTERVAL * (1 + math.log1p(use_counter)) / (1 + QUALITY_WEIGHT * float(quality_metric))
+
+
+def backfill_next_search_at(apps, schema_editor):
+    '''Schedules the existing keywords, chunk by chunk'''
+    Query = apps.get_model('api', 'Query')
+    queries = Query.objects.using(schema_editor.connection.alias)
+
+    last_id = 0
+    while True:
+        chunk = list(queries.filter(id__gt=last_id).order_by('id')
+                     .only('id', 'last_processed', 'use_counter', 'quality_metric')[:CHUNK_SIZE])
+        if not chunk:
+            break
+        for query in chunk:
+            query.next_search_at = keyword_due_time(query.last_processed, query.use_counter, query.quality_metric)
+        queries.bulk_update(chunk, ['next_search_at'])
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_keywordimport'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='query',
+            options={'ordering': ['next_search_at', 'id']},
+        ),
+        migrations.AddField(
+            model_name='query',
+            name='classified_scenes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='query',
+            name='next_search_at',
+            field=models.DateTimeField(default=datetime.datetime(1, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddField(
+            model_name='query',
+            name='useful_scenes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='query',
+            index=models.Index(fields=['next_search_at', 'id'], name='query_schedule_idx'),
+        ),
+        migrations.RunPython(backfill_next_search_at, migrations.RunPython.noop),
+    ]
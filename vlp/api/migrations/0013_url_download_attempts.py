@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_query_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='download_attempts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_url_download_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='last_failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='query',
+            name='search_failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
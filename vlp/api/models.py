@@ -1,6 +1,9 @@
-from django.db import models
+import math
+from decimal import Decimal
+from django.db import models, transaction
 from django.utils import timezone
-from datetime import datetime
+from datetime import datetime, timedelta, timezone as dt_timezone
+from .youtube import extract_video_id
 
 class Video(models.Model):
     # Store the YouTube URL
@@ -45,12 +48,41 @@ class URL(models.Model):
     # Store the URL
     url = models.URLField(unique=True)
 
+    # Canonical YouTube id of the url, used for lookups and to detect the same video behind different urls
+    video_id = models.CharField(max_length=11, unique=True, blank=True, null=True)
+
     is_processed = models.BooleanField(default=False)
 
     came_from_keyword = models.ForeignKey('Query', on_delete=models.CASCADE, blank=True, null=True, default=None)
 
+    # Metadata of the downloaded video (see downloads.extract_video_metadata)
+    duration = models.FloatField(blank=True, null=True)
+    fps = models.FloatField(blank=True, null=True)
+    width = models.PositiveIntegerField(blank=True, null=True)
+    height = models.PositiveIntegerField(blank=True, null=True)
+    filesize = models.PositiveBigIntegerField(blank=True, null=True)
+    upload_date = models.DateField(blank=True, null=True)
+
+    # Lease of the analysis worker that currently processes the url (see pre_analysis.claim_unprocessed_rows)
+    lease_owner = models.CharField(max_length=255, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+
+    # Failed downloads of the url, it is retried with a backoff and given up after some attempts
+    # (see db_client.record_download_failure). Nullable, so rows inserted by raw SQL need no value
+    download_attempts = models.PositiveIntegerField(blank=True, null=True)
+
     def __str__(self):
         return self.url + " " + str(self.is_processed) + " " + str(self.id)
+
+    def save(self, *args, **kwargs):
+        if not self.video_id:
+            self.video_id = extract_video_id(self.url)
+        super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_processed', 'lease_expires_at'], name='url_claim_idx'),
+        ]
     
 class VideoTimeStamps(models.Model):
     # Store the video
@@ -65,6 +97,32 @@ class VideoTimeStamps(models.Model):
     def __str__(self):
         return self.video.url + " " + str(self.start_time) + " " + str(self.end_time)
 
+# Keyword scheduling: a keyword is due SEARCH_INTERVAL after its last search. The interval grows with the
+# number of searches of the keyword and shrinks with its quality metric, the share of useful scenes
+# (USEFUL_LABELS) among the classified scenes of its videos, a quality of 1 searches QUALITY_WEIGHT + 1 times as often
+SEARCH_INTERVAL = timedelta(days=1)
+QUALITY_WEIGHT = 3
+USEFUL_LABELS = ('sh', 'sm')
+
+# Due time of keywords that were never searched, they come first
+NEVER_SEARCHED = datetime(1, 1, 1, tzinfo=dt_timezone.utc)
+
+# A keyword whose search failed is not due before SEARCH_INTERVAL after the failure, doubled with every failure
+# in a row up to MAX_FAILURE_DOUBLINGS times, so a keyword the API rejects does not take quota in every run
+MAX_FAILURE_DOUBLINGS = 5
+
+
+def keyword_due_time(last_processed, use_counter, quality_metric, search_failures=0, last_failed_at=None):
+    '''The time a keyword is due for its next search, see SEARCH_INTERVAL'''
+    if last_processed is None or last_processed.year == 1:
+        due_time = NEVER_SEARCHED
+    else:
+        due_time = last_processed + SEARCH_INTERVAL * (1 + math.log1p(use_counter)) / (1 + QUALITY_WEIGHT * float(quality_metric))
+    if search_failures and last_failed_at:
+        due_time = max(due_time, last_failed_at + SEARCH_INTERVAL * 2 ** min(search_failures - 1, MAX_FAILURE_DOUBLINGS))
+    return due_time
+
+
 class Query(models.Model):
     
     keyword = models.CharField(max_length=255, unique=True)
@@ -72,13 +130,50 @@ class Query(models.Model):
     use_counter = models.PositiveIntegerField(default=0)
     quality_metric = models.DecimalField(default = 0, decimal_places=4, max_digits=8)
 
+    # Classified scenes of the videos found for the keyword and the useful ones among them (see USEFUL_LABELS)
+    classified_scenes = models.PositiveIntegerField(default=0)
+    useful_scenes = models.PositiveIntegerField(default=0)
+
+    # Failed searches since the last successful one and the time of the last one, they delay the next search
+    search_failures = models.PositiveIntegerField(default=0)
+    last_failed_at = models.DateTimeField(null=True, blank=True)
+
+    # Precomputed priority of the scheduler (see keyword_due_time), the keywords due first are searched first
+    next_search_at = models.DateTimeField(default=NEVER_SEARCHED)
+
     def __str__(self):
         return f"{self.keyword}: {self.last_processed} :{self.use_counter}"
 
+    def schedule(self):
+        '''Updates next_search_at from the last search, the use counter, the quality metric and failed searches'''
+        self.next_search_at = keyword_due_time(self.last_processed, self.use_counter, self.quality_metric,
+                                               self.search_failures, self.last_failed_at)
+
     def update_used_keyword(self, count=1):
         self.use_counter += count
         self.last_processed = timezone.now()
-        self.save(update_fields=['use_counter', 'last_processed'])
+        self.search_failures = 0
+        self.schedule()
+        self.save(update_fields=['use_counter', 'last_processed', 'search_failures', 'next_search_at'])
+
+    def record_failed_search(self):
+        '''Delays the next search of a keyword whose search failed, see MAX_FAILURE_DOUBLINGS'''
+        self.search_failures += 1
+        self.last_failed_at = timezone.now()
+        self.schedule()
+        self.save(update_fields=['search_failures', 'last_failed_at', 'next_search_at'])
+
+    @classmethod
+    def add_classified_scenes(cls, query_id, scenes, useful_scenes):
+        '''Adds the classified scenes of a video found for a keyword to its quality metric and reschedules it'''
+        with transaction.atomic():
+            query = cls.objects.select_for_update().get(id=query_id)
+            query.classified_scenes += scenes
+            query.useful_scenes += useful_scenes
+            if query.classified_scenes:
+                query.quality_metric = Decimal(query.useful_scenes / query.classified_scenes).quantize(Decimal('0.0001'))
+            query.schedule()
+            query.save(update_fields=['classified_scenes', 'useful_scenes', 'quality_metric', 'next_search_at'])
 
     def clean_keyword(self):
         """
@@ -88,12 +183,55 @@ class Query(models.Model):
 
     def save(self, *args, **kwargs):
         self.clean_keyword()
+        self.schedule()
         super().save(*args, **kwargs)
 
     class Meta:
-        ordering = ['-last_processed', 'use_counter']
-        unique_together = ('keyword',)  
+        # The order the scheduler searches the keywords in
+        ordering = ['next_search_at', 'id']
+        unique_together = ('keyword',)
+        indexes = [
+            # The next keywords to search are read in index order (see helpers.scheduled_keywords)
+            models.Index(fields=['next_search_at', 'id'], name='query_schedule_idx'),
+        ]
     
+class KeywordImport(models.Model):
+    """
+    A keyword file uploaded on /upload/, imported by keyword_import.run_import. Large files are imported
+    by a Celery job, the progress is stored here and served by /upload/status/<id>/.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=PENDING)
+
+    file_name = models.CharField(max_length=255)
+
+    # The stored upload of a background import, deleted once it is imported
+    path = models.CharField(max_length=1024, blank=True, null=True)
+
+    total_bytes = models.PositiveBigIntegerField(default=0)
+    bytes_read = models.PositiveBigIntegerField(default=0)
+
+    # Keywords read (duplicates included), newly added to Query and skipped for being too long
+    keywords = models.PositiveIntegerField(default=0)
+    added = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.file_name}: {self.status} {self.bytes_read}/{self.total_bytes}"
+
 class Prediction(models.Model):
     video_timestamp = models.ForeignKey(VideoTimeStamps, on_delete=models.CASCADE)
 
@@ -0,0 +1,63 @@
+import os
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Number of analysis processes
+WORKERS = int(os.environ.get('ANALYSIS_WORKERS', 1))
+
+# Intra-op threads of every analysis process (torch, OpenMP, OpenCV)
+THREADS_PER_WORKER = int(os.environ.get('ANALYSIS_THREADS_PER_WORKER', max(1, (os.cpu_count() or 1) // WORKERS)))
+
+
+def limit_threads(threads):
+    '''
+    Limits the threads a process uses for a single operation, so N workers with T threads
+    do not oversubscribe a node with N * cpu_count threads.
+    '''
+    for variable in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[variable] = str(threads)
+
+    import cv2
+    cv2.setNumThreads(threads)
+
+    # torch is only limited if the analysis already loaded it
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(threads)
+
+
+def _init_worker(threads, initializer, initargs):
+    limit_threads(threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_in_pool(function, items, workers=WORKERS, threads_per_worker=THREADS_PER_WORKER,
+                initializer=None, initargs=()):
+    """
+    Runs function(item) for every item in a pool of worker processes and yields (item, result)
+    as soon as each item is finished, not in the order of items.
+    initializer runs once in every worker, e.g. to load a model that is reused for all items
+    of that worker. If function raises, (item, exception) is yielded and the other items go on.
+    With a single worker everything runs in the current process.
+    """
+    if workers <= 1:
+        _init_worker(threads_per_worker, initializer, initargs)
+        for item in items:
+            try:
+                yield item, function(item)
+            except Exception as error:
+                yield item, error
+        return
+
+    # spawn instead of fork, forked torch and OpenCV thread pools can deadlock
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(threads_per_worker, initializer, initargs)) as executor:
+        futures = {executor.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as error:
+                yield futures[future], error
@@ -0,0 +1,425 @@
+import os
+import json
+from collections import namedtuple, OrderedDict, deque
+import cv2
+import numpy as np
+
+# COCO keypoints: 0-4 head, 5/6 shoulders, 7-10 arms and hands, 13/14 knees
+NUM_KEYPOINTS = 17
+
+# Quality codes of rate_frames, 0 is a person that is not visible
+LOW, MEDIUM, HIGH = 1, 2, 3
+QUALITY_LABELS = np.array(['', 'low', 'medium', 'high'])
+
+# Versions of the result cache (see result_cache.py), increase them when the predictions or the rules change
+KEYPOINTS_VERSION = 1
+RULES_VERSION = 1
+
+# mmpose model alias of the pose inferencer
+POSE_MODEL = os.environ.get('POSE_MODEL', 'rtmpose-l')
+
+# Number of frames per inferencer call of the batched path
+BATCH_SIZE = int(os.environ.get('POSE_BATCH_SIZE', 8))
+
+# Sampled frames inferred per scene (POSE_SAMPLING, see infer_scenes_adaptive):
+#   early-exit  in frame order until a frame has more than one visible person, the labels are those of 'all'
+#   all         every sampled frame (see infer_scenes)
+#   coarse      every COARSE_STRIDE-th frame first and the frames in between only if they can change the
+#               label, infers the fewest frames but the labels can differ from those of 'all'
+SAMPLING = os.environ.get('POSE_SAMPLING', 'early-exit')
+SAMPLING_MODES = ('early-exit', 'all', 'coarse')
+
+# The coarse pass of the coarse mode infers every COARSE_STRIDE-th sampled frame of a scene.
+# With a SCENE_BUDGET at most that many frames of a scene are inferred in the adaptive modes,
+# spread over the scene, which trades exact labels for speed. 0 infers as many frames as the label needs
+COARSE_STRIDE = int(os.environ.get('POSE_COARSE_STRIDE', 3))
+SCENE_BUDGET = int(os.environ.get('POSE_SCENE_BUDGET', 0))
+
+# The sampled frames of one scene, frames are dropped from the scenes that process_scenes returns
+Scene = namedtuple('Scene', ['video', 'number', 'start_time', 'end_time', 'frames', 'frame_width', 'frame_height'])
+
+
+_inferencer = None
+
+
+def get_inferencer():
+    '''Returns the pose inferencer of the process, the model is loaded on first use'''
+    global _inferencer
+    if _inferencer is None:
+        from mmpose.apis import MMPoseInferencer  # torch and mmpose are only imported where the model is used
+        _inferencer = MMPoseInferencer(POSE_MODEL)
+    return _inferencer
+
+
+def stack_people(people_per_frame):
+    '''
+    Stacks the pose predictions of several frames into arrays padded to the largest number of people:
+    keypoint scores (frames x people x 17), bboxes (frames x people x 4), bbox scores and a mask of
+    the real (not padded) people (frames x people).
+    '''
+    frames = len(people_per_frame)
+    max_people = max((len(people) for people in people_per_frame), default=0)
+    scores = np.zeros((frames, max_people, NUM_KEYPOINTS))
+    bboxes = np.zeros((frames, max_people, 4))
+    bbox_scores = np.zeros((frames, max_people))
+    present = np.zeros((frames, max_people), dtype=bool)
+    for frame, people in enumerate(people_per_frame):
+        for index, person in enumerate(people):
+            scores[frame, index] = person['keypoint_scores']
+            bboxes[frame, index] = person['bbox'][0]
+            bbox_scores[frame, index] = person['bbox_score']
+            present[frame, index] = True
+    return scores, bboxes, bbox_scores, present
+
+
+def rate_frames(people_per_frame, frame_width, frame_height):
+    '''
+    Counts the visible people of every frame from its pose predictions and rates the quality
+    of every visible person, for all frames of a scene at once.
+    people_per_frame holds the list of instances mmpose returns for every image (keypoint_scores, bbox, bbox_score).
+    Returns the people counts (frames) and the quality codes (frames x people, see QUALITY_LABELS),
+    0 marks people that are not visible.
+    '''
+    scores, bboxes, bbox_scores, present = stack_people(people_per_frame)
+    frame_area = frame_width * frame_height
+    min_bbox_area = frame_area / 60  # figure should be bigger than 1/60 of frame area
+
+    bbox_area = (bboxes[..., 2] - bboxes[..., 0]) * (bboxes[..., 3] - bboxes[..., 1])
+    visible_head_points = (scores[..., :5] >= 0.7).sum(axis=-1)
+    visible_other_points = (scores[..., 5:] >= 0.35).sum(axis=-1)
+    visible = (present & (bbox_area >= min_bbox_area) & (bbox_area < frame_area) & (bbox_scores >= 0.4)
+               & (visible_head_points + visible_other_points >= 5))
+
+    shoulders_visible = (scores[..., 5] >= 0.5) | (scores[..., 6] >= 0.5)
+    knees_visible = (scores[..., 13] >= 0.5) | (scores[..., 14] >= 0.5)
+    arms_hands_visible = (scores[..., 5:11] >= 0.5).sum(axis=-1) >= 3
+    large = bbox_area / frame_area > 1 / 30
+    qualities = np.where(shoulders_visible & knees_visible & large, HIGH,
+                         np.where(arms_hands_visible & large, MEDIUM, LOW))
+
+    return visible.sum(axis=1), np.where(visible, qualities, 0)
+
+
+def quality_labels(qualities):
+    '''Returns the labels of the visible people of quality codes, frame by frame'''
+    return QUALITY_LABELS[qualities[qualities > 0]].tolist()
+
+
+def infer_frames(inferencer, frames, batch_size=1):
+    '''
+    Runs the pose inferencer on BGR frames held in memory, batch_size frames per forward pass.
+    Returns the predicted people of every frame, in the order of frames.
+    '''
+    predictions = []
+    for result in inferencer(list(frames), batch_size=batch_size):
+        predictions.extend(result['predictions'])
+    return predictions
+
+
+def infer_batched(inferencer, keyed_frames, batch_size=BATCH_SIZE):
+    '''
+    Yields (key, frame, people) for every (key, frame) of keyed_frames. The frames are collected
+    into batches of batch_size, independent of the scene or video they belong to, so the per call
+    overhead of the inferencer is paid once per batch. keyed_frames is consumed lazily.
+    '''
+    batch = []
+    for key, frame in keyed_frames:
+        batch.append((key, frame))
+        if len(batch) == batch_size:
+            yield from _infer_batch(inferencer, batch, batch_size)
+            batch = []
+    if batch:
+        yield from _infer_batch(inferencer, batch, batch_size)
+
+
+def _infer_batch(inferencer, batch, batch_size):
+    predictions = infer_frames(inferencer, [frame for _, frame in batch], batch_size)
+    return [(key, frame, people) for (key, frame), people in zip(batch, predictions)]
+
+
+def write_debug_output(output_dir, frame_count, frame, people):
+    '''Saves a sampled frame as png and its predictions as json, like the former on-disk pipeline'''
+    cv2.imwrite(os.path.join(output_dir, f'{frame_count}.png'), frame)
+    with open(os.path.join(output_dir, f'{frame_count}.json'), 'w') as file:
+        json.dump(people, file, default=lambda value: value.tolist())  # numpy values
+
+
+def process_scene(inferencer, scene_frames, frame_width, frame_height, debug_output_dir=None, batch_size=1):
+    '''
+    Runs the pose inference on the sampled frames of a scene and returns the number of visible
+    people per frame and the qualities of all visible people.
+    The frames are passed to the inferencer as arrays and the predictions are used in memory,
+    with debug_output_dir the frames and predictions are written there as well.
+    '''
+    people_per_frame = infer_frames(inferencer, scene_frames, batch_size)
+    if debug_output_dir:
+        for frame_count, people in enumerate(people_per_frame):
+            write_debug_output(debug_output_dir, frame_count, scene_frames[frame_count], people)
+
+    people_counts, qualities = rate_frames(people_per_frame, frame_width, frame_height)
+    return people_counts.tolist(), quality_labels(qualities)
+
+
+def infer_scenes(inferencer, scenes, batch_size=BATCH_SIZE, debug_output_dir=None):
+    '''
+    Runs the pose inference on the sampled frames of many scenes, possibly of many videos.
+    The sampled frames of consecutive scenes share inference batches, every result is mapped
+    back to its (video, scene, frame) origin.
+    Yields (scene, people per frame) in the order of scenes, as soon as all frames of a scene
+    are processed. With debug_output_dir the frames and predictions are written
+    to <debug_output_dir>/<video>/scene_<number>.
+    '''
+    pending = OrderedDict()  # (video, scene number) -> [scene, frames left, people per frame]
+
+    def keyed_frames():
+        for scene in scenes:
+            scene_key = (scene.video, scene.number)
+            pending[scene_key] = [scene._replace(frames=None), len(scene.frames), []]
+            for frame_count, frame in enumerate(scene.frames):
+                yield scene_key + (frame_count,), frame
+
+    def finished_scenes():
+        while pending and next(iter(pending.values()))[1] == 0:
+            scene, _, people_per_frame = pending.popitem(last=False)[1]
+            yield scene, people_per_frame
+
+    for (video, scene_number, frame_count), frame, people in infer_batched(inferencer, keyed_frames(), batch_size):
+        state = pending[(video, scene_number)]
+        if debug_output_dir:
+            scene_dir = os.path.join(debug_output_dir, str(video), f'scene_{scene_number}')
+            os.makedirs(scene_dir, exist_ok=True)
+            write_debug_output(scene_dir, frame_count, frame, people)
+
+        state[1] -= 1
+        state[2].append(people)
+        yield from finished_scenes()
+
+    # scenes without frames at the end
+    yield from finished_scenes()
+
+
+def coarse_frames(frame_count, coarse_stride=COARSE_STRIDE, budget=SCENE_BUDGET):
+    '''The frames of the coarse pass, every coarse_stride-th one, or budget frames spread over the scene'''
+    coarse = list(range(0, frame_count, coarse_stride))
+    if budget and len(coarse) > budget:
+        coarse = sorted(set(np.linspace(0, frame_count - 1, budget).round().astype(int).tolist()))
+    return coarse
+
+
+def refine_frames(frame_count, coarse, frame_qualities):
+    '''
+    The frames between the coarse frames, most promising gaps first: a gap between two high quality
+    frames can complete a run of three, a gap between frames without a person can not.
+    frame_qualities maps the coarse frames to the best quality code of their people.
+    '''
+    bounds = list(zip(coarse, coarse[1:] + [frame_count]))
+    priority = [frame_qualities[start] + frame_qualities.get(end, frame_qualities[start]) for start, end in bounds]
+    order = sorted(range(len(bounds)), key=lambda gap: -priority[gap])
+    return [index for gap in order for index in range(bounds[gap][0] + 1, bounds[gap][1])]
+
+
+class AdaptiveScene:
+    '''
+    The inference state of a scene in infer_scenes_adaptive: the frames still to infer (planned),
+    the people of the inferred frames and whether the label of the scene is settled (done).
+    '''
+
+    def __init__(self, scene, coarse, coarse_stride, budget):
+        self.scene = scene
+        self.coarse = coarse
+        self.budget = budget
+        self.people_per_frame = {}  # frame index -> people
+        self.planned = deque(coarse_frames(len(scene.frames), coarse_stride if coarse else 1, budget))
+        self.coarse_planned = list(self.planned)
+        self.refining = False
+        self.done = not self.planned
+
+    def label(self):
+        '''The label of the inferred frames and the best quality code of every inferred frame'''
+        indices = sorted(self.people_per_frame)
+        people_counts, qualities = rate_frames([self.people_per_frame[index] for index in indices],
+                                               self.scene.frame_width, self.scene.frame_height)
+        label = classify_scene(people_counts, quality_labels(qualities))
+        return label, dict(zip(indices, qualities.max(axis=1, initial=0).tolist()))
+
+    def update(self):
+        '''Settles the scene or plans its next frames, called after every batch with frames of the scene'''
+        label, frame_qualities = self.label()
+        if label == 'mu':
+            # more than one person in a frame, no other frame can change the label
+            self.planned.clear()
+        elif self.coarse and not self.planned and not self.refining and label not in ('nh', 'sh'):
+            refine = refine_frames(len(self.scene.frames), self.coarse_planned, frame_qualities)
+            if self.budget:
+                refine = refine[:max(self.budget - len(self.coarse_planned), 0)]
+            self.planned.extend(refine)
+            self.refining = True
+        elif self.refining and label == 'sh':
+            self.planned.clear()
+        self.done = not self.planned
+
+    def result(self):
+        return self.scene._replace(frames=None), [self.people_per_frame[index] for index in sorted(self.people_per_frame)]
+
+
+def infer_scenes_adaptive(inferencer, scenes, batch_size=BATCH_SIZE, debug_output_dir=None, coarse=False,
+                          coarse_stride=COARSE_STRIDE, budget=SCENE_BUDGET):
+    """
+    Like infer_scenes, but infers only as many sampled frames of a scene as its label needs.
+    By default the frames are inferred in frame order until one has more than one visible person,
+    since 'mu' can not change any more, so the labels are the same as with infer_scenes.
+    With coarse the coarse pass infers every coarse_stride-th frame (see coarse_frames). Its label is
+    kept if it is 'nh' or 'sh', otherwise the frames in between are refined, starting with the gaps
+    that can raise the quality label (see refine_frames), until the label is 'sh' or 'mu'.
+    With a budget at most budget frames of a scene are inferred.
+    Like in infer_scenes the frames of consecutive scenes share inference batches, a scene plans its
+    next frames from the results of the previous batch.
+    Yields (scene, people per frame) in the order of scenes, with the people of the inferred frames in frame order.
+    """
+    scenes = iter(scenes)
+    active = deque()  # the scenes that are not yielded yet, in order
+    scenes_left = True
+    while True:
+        batch = []
+
+        def take(state):
+            while state.planned and len(batch) < batch_size:
+                batch.append((state, state.planned.popleft()))
+
+        for state in active:
+            take(state)
+        while scenes_left and len(batch) < batch_size:
+            scene = next(scenes, None)
+            if scene is None:
+                scenes_left = False
+                break
+            state = AdaptiveScene(scene, coarse, coarse_stride, budget)
+            active.append(state)
+            take(state)
+
+        if not batch:
+            # every scene left is done
+            yield from (state.result() for state in active)
+            return
+
+        frames = [state.scene.frames[frame_count] for state, frame_count in batch]
+        for (state, frame_count), frame, people in zip(batch, frames, infer_frames(inferencer, frames, batch_size)):
+            state.people_per_frame[frame_count] = people
+            if debug_output_dir:
+                scene_dir = os.path.join(debug_output_dir, str(state.scene.video), f'scene_{state.scene.number}')
+                os.makedirs(scene_dir, exist_ok=True)
+                write_debug_output(scene_dir, frame_count, frame, people)
+        for state in {id(state): state for state, _ in batch}.values():
+            state.update()
+
+        while active and active[0].done:
+            yield active.popleft().result()
+
+
+def infer_scenes_sampled(inferencer, scenes, batch_size=BATCH_SIZE, debug_output_dir=None, sampling=SAMPLING):
+    '''Runs infer_scenes or infer_scenes_adaptive, as set by the sampling mode (see SAMPLING)'''
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode {sampling!r}, expected one of {', '.join(SAMPLING_MODES)}")
+    if sampling == 'all':
+        return infer_scenes(inferencer, scenes, batch_size, debug_output_dir)
+    return infer_scenes_adaptive(inferencer, scenes, batch_size, debug_output_dir, coarse=sampling == 'coarse')
+
+
+def process_scenes(inferencer, scenes, batch_size=BATCH_SIZE, debug_output_dir=None):
+    '''
+    Batched version of process_scene for many scenes, see infer_scenes.
+    Yields (scene, people_counts, frame_qualities) in the order of scenes.
+    '''
+    for scene, people_per_frame in infer_scenes(inferencer, scenes, batch_size, debug_output_dir):
+        people_counts, qualities = rate_frames(people_per_frame, scene.frame_width, scene.frame_height)
+        yield scene, people_counts.tolist(), quality_labels(qualities)
+
+
+def classify_scene(people_counts, frame_qualities):
+    '''Classifies a scene by its number of visible people and, for single people, by the frame quality'''
+    people_counts = np.asarray(people_counts)
+    frame_qualities = np.asarray(frame_qualities, dtype=str)
+
+    # classify after number of human figure(single, multiple, nohuman)
+    if not people_counts.any():
+        return 'nh'  # nh
+    if (people_counts > 1).any():
+        return 'mu' # multiple
+
+    # further subdivision in single category, by three consecutive qualities of at least high/medium
+    if has_run_of_three(frame_qualities == 'high'):
+        return 'sh' # single high
+    if has_run_of_three((frame_qualities == 'medium') | (frame_qualities == 'high')):
+        return 'sm' # single medium
+    return 'sl' # single low
+
+
+def has_run_of_three(mask):
+    '''True if mask has three consecutive True values'''
+    return bool((mask[:-2] & mask[1:-1] & mask[2:]).any())
+
+
+def label_scenes(keypoints):
+    '''Labels scenes from their keypoints, [(scene, people per frame)] -> [[video, start time, end time, label]]'''
+    results = []
+    for scene, people_per_frame in keypoints:
+        people_counts, qualities = rate_frames(people_per_frame, scene.frame_width, scene.frame_height)
+        classification = classify_scene(people_counts, quality_labels(qualities))
+        results.append([scene.video, scene.start_time, scene.end_time, classification])
+    return results
+
+
+def analyze_videos_cached(videos, get_inferencer, cache, params, batch_size=BATCH_SIZE, debug_output_dir=None,
+                          sampling='all'):
+    """
+    Labels the scenes of videos, given as (video name, function yielding the sampled Scenes), through
+    the result cache: cached labels are returned as they are, cached keypoints are only labelled
+    again (e.g. after a RULES_VERSION change) and only the remaining videos are sampled and inferred.
+    params are the scene detection, sampling and model parameters, they are part of the cache keys.
+    get_inferencer is only called if a video has to be inferred. The scenes are inferred with the sampling
+    mode (see infer_scenes_sampled), the mode and its settings have to be part of params.
+    Returns the [video, start time, end time, label] rows of all videos in the order of videos.
+    """
+    results = {}
+    uncached = []
+    for video_name, sample_scenes in videos:
+        labels = cache.get(video_name, 'labels', RULES_VERSION, dict(params, keypoints_version=KEYPOINTS_VERSION))
+        if labels is not None:
+            results[video_name] = labels
+            continue
+        keypoints = cache.get(video_name, 'keypoints', KEYPOINTS_VERSION, params)
+        if keypoints is not None:
+            results[video_name] = _label_and_cache(cache, params, video_name, keypoints)
+            continue
+        uncached.append((video_name, sample_scenes))
+
+    if uncached:
+        scenes = (scene for _, sample_scenes in uncached for scene in sample_scenes())
+        keypoints = OrderedDict((video_name, []) for video_name, _ in uncached)
+
+        def store(video_name):
+            cache.set(video_name, 'keypoints', KEYPOINTS_VERSION, params, keypoints[video_name])
+            results[video_name] = _label_and_cache(cache, params, video_name, keypoints[video_name])
+
+        for scene, people_per_frame in infer_scenes_sampled(get_inferencer(), scenes, batch_size, debug_output_dir,
+                                                            sampling):
+            # the frames are not needed for labelling and would bloat the cache
+            keypoints[scene.video].append((scene._replace(frames=[]), people_per_frame))
+            # scenes arrive in the order of the videos, so every video before this one is complete
+            for video_name in keypoints:
+                if video_name == scene.video:
+                    break
+                if video_name not in results:
+                    store(video_name)
+
+        for video_name in keypoints:
+            if video_name not in results:
+                store(video_name)
+
+    return [row for video_name, _ in videos for row in results[video_name]]
+
+
+def _label_and_cache(cache, params, video_name, keypoints):
+    labels = label_scenes(keypoints)
+    cache.set(video_name, 'labels', RULES_VERSION, dict(params, keypoints_version=KEYPOINTS_VERSION), labels)
+    return labels
@@ -0,0 +1,147 @@
+import os
+import time
+import json
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+# Directory of the cache database, it lives on the analysis node next to the downloads
+CACHE_DIR = os.environ.get('ANALYSIS_CACHE_DIR', os.path.join(os.getcwd(), 'analysis-cache'))
+
+# Entries are evicted when the cache grows beyond MAX_BYTES (least recently used first) or is older than MAX_AGE_DAYS
+MAX_BYTES = int(os.environ.get('ANALYSIS_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+MAX_AGE_DAYS = float(os.environ.get('ANALYSIS_CACHE_MAX_AGE_DAYS', 30))
+
+
+def params_hash(params):
+    '''Stable hash of a dict of stage parameters'''
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Persistent cache of analysis results (scene lists, per-frame keypoints, scene labels).
+    Entries are keyed by (video id, stage, algorithm version, parameter hash), so a stage is only
+    computed again if its algorithm version or one of its parameters changed.
+    Values are pickled into a SQLite database, which several analysis processes can share.
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_BYTES, max_age_days=MAX_AGE_DAYS):
+        self.path = path or os.path.join(CACHE_DIR, 'results.sqlite3')
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self._local = threading.local()
+
+    def _connection(self):
+        # one connection per thread, the database is created on first use
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # The total size of the entries is kept up to date by triggers, so evict() does not sum up the table.
+            # Caches created before the triggers existed are summed up once.
+            connection.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS results (
+                video_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                version TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (video_id, stage, version, params_hash)
+            );
+            CREATE INDEX IF NOT EXISTS results_used_at_idx ON results (used_at);
+            CREATE INDEX IF NOT EXISTS results_created_at_idx ON results (created_at);
+            CREATE TABLE IF NOT EXISTS total_size (id INTEGER PRIMARY KEY CHECK (id = 1), size INTEGER NOT NULL);
+            INSERT OR IGNORE INTO total_size SELECT 1, COALESCE(SUM(size), 0) FROM results;
+            CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results
+            BEGIN UPDATE total_size SET size = size + NEW.size; END;
+            CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF size ON results
+            BEGIN UPDATE total_size SET size = size + NEW.size - OLD.size; END;
+            CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results
+            BEGIN UPDATE total_size SET size = size - OLD.size; END;
+            COMMIT;
+            """)
+            self._local.connection = connection
+        return connection
+
+    def get(self, video_id, stage, version, params):
+        '''Returns the cached value or None'''
+        key = (video_id, stage, str(version), params_hash(params))
+        with self._connection() as connection:
+            row = connection.execute("""
+            SELECT value FROM results
+            WHERE video_id = ? AND stage = ? AND version = ? AND params_hash = ?
+            """, key).fetchone()
+            if row is None:
+                return None
+            connection.execute("""
+            UPDATE results SET used_at = ?
+            WHERE video_id = ? AND stage = ? AND version = ? AND params_hash = ?
+            """, (time.time(),) + key)
+        return pickle.loads(row[0])
+
+    def set(self, video_id, stage, version, params, value):
+        '''Stores value (anything but None) and evicts old entries if the cache is too large'''
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute("""
+            INSERT INTO results (video_id, stage, version, params_hash, value, size, created_at, used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (video_id, stage, version, params_hash) DO UPDATE
+            SET value = excluded.value, size = excluded.size, created_at = excluded.created_at, used_at = excluded.used_at
+            """, (video_id, stage, str(version), params_hash(params), value, len(value), now, now))
+        self.evict()
+
+    def get_or_compute(self, video_id, stage, version, params, compute):
+        '''Returns the cached value, or computes, stores and returns it'''
+        value = self.get(video_id, stage, version, params)
+        if value is None:
+            value = compute()
+            self.set(video_id, stage, version, params, value)
+        return value
+
+    def evict(self):
+        '''Deletes entries older than max_age_days, then the least recently used ones beyond max_bytes'''
+        with self._connection() as connection:
+            connection.execute('DELETE FROM results WHERE created_at < ?',
+                               (time.time() - self.max_age_days * 24 * 60 * 60,))
+            total_size = connection.execute('SELECT size FROM total_size').fetchone()[0]
+            if total_size <= self.max_bytes:
+                return
+
+            evicted = []
+            for rowid, size in connection.execute('SELECT rowid, size FROM results ORDER BY used_at'):
+                if total_size <= self.max_bytes:
+                    break
+                evicted.append((rowid,))
+                total_size -= size
+            connection.executemany('DELETE FROM results WHERE rowid = ?', evicted)
+
+    def invalidate(self, video_id, stage=None):
+        '''Deletes the entries of a video, of all stages or of one stage'''
+        with self._connection() as connection:
+            if stage is None:
+                connection.execute('DELETE FROM results WHERE video_id = ?', (video_id,))
+            else:
+                connection.execute('DELETE FROM results WHERE video_id = ? AND stage = ?', (video_id, stage))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    '''Returns the process wide ResultCache'''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
@@ -0,0 +1,177 @@
+import os
+import math
+import cv2
+from scenedetect.detectors import ContentDetector
+from .scenes import detection_frame
+
+# Frames of a scene are sampled SAMPLES_PER_SECOND times per second of video, whatever its frame rate
+SAMPLES_PER_SECOND = float(os.environ.get('POSE_SAMPLES_PER_SECOND', 1))
+
+# Longer scenes are sampled more sparsely, so that no scene has more than MAX_SAMPLES_PER_SCENE samples
+MAX_SAMPLES_PER_SCENE = int(os.environ.get('POSE_MAX_SAMPLES_PER_SCENE', 32))
+
+# Scenes shorter than this are not analysed
+MIN_SCENE_SECONDS = 5
+
+# Part of the result cache keys (see hansposealgorithm.ANALYSIS_PARAMS), increase it when the sampled frames change
+SAMPLING_VERSION = 2
+
+
+def sample_interval(fps, samples_per_second=SAMPLES_PER_SECOND):
+    '''Frames between two samples, at most every frame is sampled'''
+    return max(fps / samples_per_second, 1.0)
+
+
+def sample_offset(sample_index, interval):
+    '''Offset of a sample from the first frame of its scene, rounded to the nearest frame'''
+    return math.floor(sample_index * interval + 0.5)
+
+
+class SceneSampler:
+    """
+    Selects the samples of a scene while its frames are read, without knowing its length.
+    Every interval frames a frame is a sample candidate. When a scene has more than 2 * max_samples
+    candidates only every 2nd, 4th, ... candidate is kept, the stride doubles whenever the kept
+    candidates exceed 2 * max_samples. At the end max_samples of the kept candidates are selected,
+    evenly spread from the first to the last one, so a long scene gets exactly max_samples samples.
+    At most 2 * max_samples frames are held, and the result is the same as with sample_offsets.
+    """
+
+    def __init__(self, interval, max_samples=MAX_SAMPLES_PER_SCENE):
+        self.interval = interval
+        self.max_samples = max_samples
+        self.stride = 1
+        self.candidates = 0
+        self.kept = []  # (candidate index, frame)
+
+    def add(self, offset, frame=None):
+        '''Offers the frame at offset from the first frame of the scene, frames must be offered in order'''
+        if offset != sample_offset(self.candidates, self.interval):
+            return
+        if self.candidates % self.stride == 0:
+            self.kept.append((self.candidates, frame))
+            while self.max_samples and len(self.kept) > 2 * self.max_samples:
+                self.stride *= 2
+                self.kept = [(index, frame) for index, frame in self.kept if index % self.stride == 0]
+        self.candidates += 1
+
+    @property
+    def samples(self):
+        '''The selected (candidate index, frame) pairs'''
+        if not self.max_samples or len(self.kept) <= self.max_samples:
+            return self.kept
+        if self.max_samples == 1:
+            return self.kept[:1]
+        step = (len(self.kept) - 1) / (self.max_samples - 1)
+        return [self.kept[sample_offset(index, step)] for index in range(self.max_samples)]
+
+    @property
+    def frames(self):
+        return [frame for _, frame in self.samples]
+
+
+def sample_offsets(frame_count, fps, samples_per_second=SAMPLES_PER_SECOND, max_samples=MAX_SAMPLES_PER_SCENE):
+    '''Offsets of the samples of a scene of frame_count frames from its first frame, see SceneSampler'''
+    sampler = SceneSampler(sample_interval(fps, samples_per_second), max_samples)
+    candidate = 0
+    while sample_offset(candidate, sampler.interval) < frame_count:
+        sampler.add(sample_offset(candidate, sampler.interval))
+        candidate += 1
+    return [sample_offset(index, sampler.interval) for index, _ in sampler.samples]
+
+
+def build_schedule(scene_ranges, fps, samples_per_second=SAMPLES_PER_SECOND, max_samples=MAX_SAMPLES_PER_SCENE,
+                   min_scene_seconds=MIN_SCENE_SECONDS):
+    '''
+    Returns the sampling schedule of a video as (scene index, [frame numbers]) pairs, ordered by frame.
+    scene_ranges are (start frame, end frame) pairs, scenes shorter than min_scene_seconds are left out.
+    '''
+    schedule = []
+    for scene_index, (start_frame, end_frame) in enumerate(scene_ranges):
+        if (end_frame - start_frame) / fps < min_scene_seconds:
+            continue
+        offsets = sample_offsets(end_frame - start_frame, fps, samples_per_second, max_samples)
+        schedule.append((scene_index, [start_frame + offset for offset in offsets]))
+    return schedule
+
+
+def read_scheduled_frames(video_path, schedule):
+    """
+    Walks the video once from the first frame and yields (scene index, frames) for every scene of
+    the schedule (see build_schedule) as soon as its last sampled frame is read.
+    Frames that are not sampled are only grabbed, so they are decoded but never converted,
+    and no seeking is needed between scenes.
+    If the video ends early the remaining scenes are yielded with the frames read so far.
+    """
+    capture = cv2.VideoCapture(video_path)
+    try:
+        frame_num = 0
+        end_of_video = False
+        for scene_index, frame_numbers in schedule:
+            frames = []
+            for sample_frame in frame_numbers:
+                # skip to the sampled frame without converting the frames in between
+                while not end_of_video and frame_num < sample_frame:
+                    end_of_video = not capture.grab()
+                    frame_num += 1
+                if end_of_video or not capture.grab():
+                    end_of_video = True
+                    break
+                frame_num += 1
+                success, frame = capture.retrieve()
+                if success:
+                    frames.append(frame)
+            yield scene_index, frames
+    finally:
+        capture.release()
+
+
+def stream_scenes(video_path, threshold=30.0, samples_per_second=SAMPLES_PER_SECOND,
+                  max_samples=MAX_SAMPLES_PER_SCENE, min_scene_seconds=MIN_SCENE_SECONDS):
+    """
+    Scene detection and frame sampling in one decode of the video.
+    Every frame is read once and fed to ContentDetector, the samples of the current scene are
+    selected by a SceneSampler. When a cut is confirmed the scene is yielded as (scene index,
+    start frame, end frame, frames) right away, or its frames are discarded if it is shorter than
+    min_scene_seconds. The scenes, their indices and the sampled frames are the same as with
+    detect_scenes_exact followed by build_schedule and read_scheduled_frames. As with
+    SceneManager, a video without any cut has no scenes.
+    """
+    capture = cv2.VideoCapture(video_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        interval = sample_interval(fps, samples_per_second)
+        detector = ContentDetector(threshold=threshold)
+
+        scene_index = 0
+        scene_start = 0
+        sampler = SceneSampler(interval, max_samples)
+        frame_num = 0
+        while True:
+            success, frame = capture.read()
+            if not success:
+                break
+
+            # ContentDetector reports a cut on the frame that starts the new scene
+            for cut in detector.process_frame(frame_num, detection_frame(frame)):
+                if (cut - scene_start) / fps >= min_scene_seconds:
+                    yield scene_index, scene_start, cut, sampler.frames
+                scene_index += 1
+                scene_start = cut
+                sampler = SceneSampler(interval, max_samples)
+
+            sampler.add(frame_num - scene_start, frame)
+            frame_num += 1
+
+        for cut in detector.post_process(frame_num):
+            if (cut - scene_start) / fps >= min_scene_seconds:
+                yield scene_index, scene_start, cut, sampler.frames
+            scene_index += 1
+            scene_start = cut
+            sampler = SceneSampler(interval, max_samples)
+
+        # the last scene ends with the video
+        if scene_index > 0 and (frame_num - scene_start) / fps >= min_scene_seconds:
+            yield scene_index, scene_start, frame_num, sampler.frames
+    finally:
+        capture.release()
@@ -0,0 +1,169 @@
+import cv2
+from scenedetect import open_video, SceneManager
+from scenedetect.scene_manager import compute_downscale_factor
+from scenedetect.detectors import ContentDetector
+
+# Version of the result cache (see result_cache.py), increase it when the detected scenes change,
+# also those of sampling.stream_scenes, whose scenes the cached keypoints are keyed by
+SCENES_VERSION = 3
+
+# Fast mode defaults: frames are analysed at this width and only every (FAST_FRAME_SKIP + 1)th frame is scored
+FAST_ANALYSIS_WIDTH = 160
+FAST_FRAME_SKIP = 3
+
+# Frames a scene has at least, the default min_scene_len of ContentDetector that the exact mode uses
+MIN_SCENE_FRAMES = 15
+
+
+def detect_scenes(input_video_path, threshold=30.0, fast=False, analysis_width=FAST_ANALYSIS_WIDTH,
+                  frame_skip=FAST_FRAME_SKIP):
+    '''
+    Detects the scenes of a video, seperated by cuts, and returns them as [start, end] in seconds.
+    The exact mode runs ContentDetector on every frame, the fast mode (see detect_scenes_fast)
+    on downscaled and skipped frames.
+    '''
+    if fast:
+        return detect_scenes_fast(input_video_path, threshold, analysis_width, frame_skip)
+    return detect_scenes_exact(input_video_path, threshold)
+
+
+def scene_params(threshold=30.0, fast=False, analysis_width=FAST_ANALYSIS_WIDTH, frame_skip=FAST_FRAME_SKIP):
+    '''The parameters of detect_scenes that change its result, the fast mode settings only count in fast mode'''
+    params = {'threshold': threshold, 'fast': fast}
+    if fast:
+        params.update(analysis_width=analysis_width, frame_skip=frame_skip)
+    return params
+
+
+def detect_scenes_exact(input_video_path, threshold=30.0):
+    '''Runs ContentDetector on every frame of the video'''
+
+    # Open the video file
+    video = open_video(input_video_path)
+
+    # Add ContentDetector algorithm with adjustable threshold
+    scene_manager = SceneManager()
+    scene_manager.add_detector(ContentDetector(threshold=threshold))
+
+    # Perform scene detection
+    scene_manager.detect_scenes(video)
+    scene_list = scene_manager.get_scene_list()
+
+    return [[scene[0].get_seconds(), scene[1].get_seconds()] for scene in scene_list]
+
+
+def detect_scenes_fast(input_video_path, threshold=30.0, analysis_width=FAST_ANALYSIS_WIDTH,
+                       frame_skip=FAST_FRAME_SKIP):
+    """
+    Fast scene detection: every (frame_skip + 1)th frame is decoded, resized to analysis_width
+    and scored by ContentDetector, the frames in between are only grabbed.
+    A scored frame above the threshold is only a candidate: the motion of a moving camera adds up
+    over the skipped frames, so on such footage most scored frames are. The frames of the gap before
+    every candidate are re-checked like the exact mode does (see confirm_cuts), and only candidates
+    with a cut frame in their gap are kept. On footage with a lot of motion the fast mode reads
+    about as many frames as the exact mode.
+    Returns the same [start, end] list as detect_scenes_exact.
+    """
+    capture = cv2.VideoCapture(input_video_path)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video: {input_video_path}")
+
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        step = frame_skip + 1
+        # Without a minimum scene length every scored frame above the threshold is reported
+        detector = ContentDetector(threshold=threshold, min_scene_len=0)
+
+        candidates = []
+        frame_num = 0
+        while capture.grab():
+            if frame_num % step == 0:
+                _, frame = capture.retrieve()
+                candidates += detector.process_frame(frame_num, resize_frame(frame, analysis_width))
+            frame_num += 1
+    finally:
+        capture.release()
+
+    cuts = confirm_cuts(input_video_path, candidates, threshold, step)
+    return cuts_to_scenes(cuts, frame_num, fps)
+
+
+def confirm_cuts(input_video_path, candidates, threshold, step, min_scene_len=MIN_SCENE_FRAMES):
+    '''
+    Re-checks the step frames before every candidate cut at the full frame rate, with frames downscaled
+    like the exact mode does. A frame of the gap is a cut if it differs from its predecessor and its
+    predecessor did not differ from the frame before, as the exact mode merges runs of changing frames
+    (e.g. a fast moving camera) instead of cutting them. Candidates without such a frame are dropped,
+    as are cuts less than min_scene_len frames after the previous cut or the start of the video.
+    The video is read forward once, frames outside of the gaps are only grabbed, without seeking.
+    When two gaps overlap the second one starts after the frames the first one read.
+    '''
+    capture = cv2.VideoCapture(input_video_path)
+    cuts = []
+    try:
+        frame_num = 0  # the next frame of the capture
+        previous = None  # the last frame read, if it is frame_num - 1
+        previous_above = None  # whether it differs from its predecessor, None if that was not read
+        for candidate in candidates:
+            # A fresh detector without a minimum scene length reports every frame above the threshold
+            detector = ContentDetector(threshold=threshold, min_scene_len=0)
+            # the predecessor of the first frame of the gap is scored too
+            first_frame = max(candidate - step - 1, 0)
+            while frame_num < first_frame and capture.grab():
+                frame_num += 1
+                previous = previous_above = None
+            if frame_num > first_frame and previous is not None:
+                detector.process_frame(frame_num - 1, previous)
+            else:
+                previous_above = None
+
+            while frame_num <= candidate:
+                success, frame = capture.read()
+                if not success:
+                    break
+                # the first frame of a detector has no predecessor to differ from
+                has_predecessor = previous is not None
+                previous = detection_frame(frame)
+                reported = detector.process_frame(frame_num, previous)
+                above = bool(reported) if has_predecessor else None
+                cut = above and previous_above is False
+                previous_above = above
+                frame_num += 1
+                if cut:
+                    if frame_num - 1 - (cuts[-1] if cuts else 0) >= min_scene_len:
+                        cuts.append(frame_num - 1)
+                    break
+    finally:
+        capture.release()
+
+    return cuts
+
+
+def resize_frame(frame, width):
+    '''Downscales a frame to width, keeping the aspect ratio. Smaller frames are returned unchanged.'''
+    height, frame_width = frame.shape[:2]
+    if not width or frame_width <= width:
+        return frame
+    return cv2.resize(frame, (width, max(1, round(height * width / frame_width))), interpolation=cv2.INTER_AREA)
+
+
+def detection_frame(frame):
+    '''Downscales a frame like SceneManager does before scene detection (auto downscale)'''
+    height, width = frame.shape[:2]
+    downscale_factor = compute_downscale_factor(max(width, height))
+    if downscale_factor <= 1.0:
+        return frame
+    size = (max(1, round(width / downscale_factor)), max(1, round(height / downscale_factor)))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+
+
+def cuts_to_scenes(cuts, total_frames, fps):
+    '''
+    Converts cut frame numbers to [start, end] scenes in seconds.
+    Like SceneManager.get_scene_list a video without cuts has no scenes.
+    '''
+    if not cuts:
+        return []
+
+    boundaries = [0] + list(cuts) + [total_frames]
+    return [[start / fps, end / fps] for start, end in zip(boundaries, boundaries[1:]) if end > start]
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import random
+import threading
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from googleapiclient.errors import HttpError
+
+try:
+    import zoneinfo
+except ImportError:  # Python 3.8, installed with Django
+    from backports import zoneinfo
+
+logger = logging.getLogger(__name__)
+
+# YouTube Data API quota in units per day, a search.list call costs SEARCH_COST units
+DAILY_QUOTA = int(os.environ.get('YOUTUBE_DAILY_QUOTA', 10000))
+SEARCH_COST = 100
+
+# The quota is reset at midnight Pacific time, the units used per day are counted in Redis, shared by all
+# processes (see SharedQuota), the keys expire after QUOTA_KEY_SECONDS
+QUOTA_TIMEZONE = zoneinfo.ZoneInfo('America/Los_Angeles')
+QUOTA_KEY_PREFIX = 'youtube-search-quota'
+QUOTA_KEY_SECONDS = 2 * 24 * 60 * 60
+
+# Searches that run at the same time, they mostly wait for the API
+SEARCH_THREADS = int(os.environ.get('SEARCH_THREADS', 8))
+
+# Transient errors are retried after about 1, 2, 4, 8 seconds (with jitter)
+MAX_RETRIES = 4
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+
+# Reasons of a 403 that mean the quota is used up, rateLimitExceeded is a short term limit and is retried
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+TRANSIENT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError', 'internalError'}
+
+
+class QuotaExceeded(Exception):
+    '''The daily quota of the API is used up, no search can run before it is reset'''
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket of one process. It holds up to capacity tokens and refills refill_per_second
+    tokens per second. The quota of the API is counted by SharedQuota, which all processes share.
+    """
+
+    def __init__(self, capacity, refill_per_second, clock=time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        '''Takes tokens if there are enough, returns False otherwise without waiting'''
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+            self.updated_at = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+class SharedQuota:
+    """
+    The daily quota of the API, shared by all worker processes and restarts: the units used on a
+    quota day are counted in Redis and taken with an atomic increment, which is taken back if it
+    goes beyond daily_quota. Has the try_acquire of TokenBucket.
+    """
+
+    def __init__(self, client, daily_quota=DAILY_QUOTA, clock=lambda: datetime.now(QUOTA_TIMEZONE)):
+        self.client = client
+        self.daily_quota = daily_quota
+        self.clock = clock
+
+    def key(self):
+        '''The Redis key of the current quota day'''
+        return f"{QUOTA_KEY_PREFIX}:{self.clock().astimezone(QUOTA_TIMEZONE).date().isoformat()}"
+
+    def used(self):
+        return int(self.client.get(self.key()) or 0)
+
+    def try_acquire(self, tokens=1):
+        '''Takes tokens if the quota of the day has enough left, returns False otherwise without waiting'''
+        key = self.key()
+        self.client.set(key, 0, ex=QUOTA_KEY_SECONDS, nx=True)
+        if self.client.incrby(key, tokens) > self.daily_quota:
+            self.client.decrby(key, tokens)
+            return False
+        return True
+
+
+_quota_bucket = None
+_quota_bucket_lock = threading.Lock()
+
+
+def get_quota_bucket():
+    '''
+    Returns the quota of the process, counted in the Redis of SEARCH_QUOTA_REDIS_URL (see SharedQuota).
+    Without that setting (development) every process counts its own quota, refilled over a day.
+    '''
+    global _quota_bucket
+    with _quota_bucket_lock:
+        if _quota_bucket is None:
+            from django.conf import settings
+            if settings.SEARCH_QUOTA_REDIS_URL:
+                import redis
+                _quota_bucket = SharedQuota(redis.Redis.from_url(settings.SEARCH_QUOTA_REDIS_URL))
+            else:
+                logger.warning("SEARCH_QUOTA_REDIS_URL is not set, the search quota is counted per process")
+                _quota_bucket = TokenBucket(DAILY_QUOTA, DAILY_QUOTA / (24 * 60 * 60))
+        return _quota_bucket
+
+
+def error_reason(error):
+    '''The reason of an HttpError of the API (e.g. quotaExceeded), or None'''
+    try:
+        errors = json.loads(error.content.decode('utf-8'))['error'].get('errors', [])
+        return errors[0].get('reason') if errors else None
+    except (ValueError, KeyError, AttributeError, TypeError):
+        return None
+
+
+def is_transient(error):
+    '''True for errors that can succeed when retried: server errors, rate limits and network errors'''
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500 or error.resp.status == 429 or error_reason(error) in TRANSIENT_REASONS
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def search_with_retries(search, keyword, bucket, stop, max_retries=MAX_RETRIES, sleep=time.sleep):
+    '''
+    Runs search(keyword), retrying transient errors with jittered exponential backoff.
+    Every call takes SEARCH_COST tokens from bucket. Raises QuotaExceeded if the bucket is empty
+    or the API reports the quota as used up, other errors are raised after the last retry.
+    '''
+    for attempt in range(max_retries + 1):
+        if stop.is_set():
+            raise QuotaExceeded('quota exceeded by another search')
+        if not bucket.try_acquire(SEARCH_COST):
+            raise QuotaExceeded('daily search quota used up')
+        try:
+            return search(keyword)
+        except Exception as error:
+            if isinstance(error, HttpError) and error_reason(error) in QUOTA_REASONS:
+                raise QuotaExceeded(str(error)) from error
+            if attempt == max_retries or not is_transient(error):
+                raise
+        delay = min(RETRY_BASE_SECONDS * 2 ** attempt, RETRY_MAX_SECONDS)
+        sleep(delay * random.uniform(0.5, 1.5))
+
+
+def run_searches(keywords, search, bucket=None, threads=SEARCH_THREADS, max_retries=MAX_RETRIES, sleep=time.sleep):
+    """
+    Runs search(keyword) for all keywords in a pool of threads and yields (keyword, result) as soon
+    as a search is done, result is the return value of search or the exception of a failed search.
+    Once the quota is used up no further search is started, the searches that did not run are not
+    yielded, so their keywords can be searched again in the next run.
+    search only calls the API, the results are written to the database by the caller.
+    """
+    bucket = bucket or get_quota_bucket()
+    stop = threading.Event()
+
+    def run(keyword):
+        try:
+            return search_with_retries(search, keyword, bucket, stop, max_retries, sleep)
+        except QuotaExceeded:
+            stop.set()
+            raise
+
+    stop_logged = False
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(run, keyword): keyword for keyword in keywords}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except QuotaExceeded as error:
+                if not stop_logged:
+                    logger.warning(f"YouTube API quota exceeded, the remaining keywords are searched in the next run: {error}")
+                    stop_logged = True
+            except Exception as error:
+                yield futures[future], error
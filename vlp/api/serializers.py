@@ -37,8 +37,8 @@ class VideoSerializer(serializers.ModelSerializer):
 class QuerySerializer(serializers.ModelSerializer):
     class Meta:
         model = Query
-        fields = ['keyword', 'last_processed', 'use_counter', 'quality_metric']
-        read_only_fields = ['last_processed', 'use_counter', 'quality_metric']
+        fields = ['keyword', 'last_processed', 'use_counter', 'quality_metric', 'next_search_at']
+        read_only_fields = ['last_processed', 'use_counter', 'quality_metric', 'next_search_at']
 
 class VideoTimeStampsSerializer(serializers.ModelSerializer):
     video_url = serializers.CharField(source='video.url', read_only=True)
@@ -53,30 +53,29 @@ class PredictionSerializer(serializers.ModelSerializer):
         model = Prediction
         fields = ['video_timestamp', 'prediction']
 
-class CustomVideoTimeStampsSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = VideoTimeStamps
-        fields = ['start_time', 'end_time']
-
-class CustomPredictionSerializer(serializers.ModelSerializer):
-    video_timestamp = CustomVideoTimeStampsSerializer()
+class GroupedPredictionSerializer(serializers.ModelSerializer):
+    """
+    All predictions of a video in a columnar shape:
+    {"video_url": ..., "start_time": [...], "end_time": [...], "prediction": [...]}
+    Expects the scenes to be prefetched into `predicted_scenes` (see GroupedPredictionViewSet).
+    """
+    video_url = serializers.CharField(source='url', read_only=True)
+    start_time = serializers.SerializerMethodField()
+    end_time = serializers.SerializerMethodField()
+    prediction = serializers.SerializerMethodField()
 
     class Meta:
-        model = Prediction
-        fields = ['video_timestamp', 'prediction']
+        model = URL
+        fields = ['video_url', 'start_time', 'end_time', 'prediction']
 
-class GroupedPredictionSerializer(serializers.ModelSerializer):
-    video_url = serializers.CharField(source='video.url', read_only=True)
-    predictions = serializers.SerializerMethodField()
+    def get_start_time(self, obj):
+        return [scene.start_time for scene in obj.predicted_scenes]
 
-    class Meta:
-        model = VideoTimeStamps
-        fields = ['video_url', 'predictions']
+    def get_end_time(self, obj):
+        return [scene.end_time for scene in obj.predicted_scenes]
 
-    def get_predictions(self, obj):
-        video_timestamps = VideoTimeStamps.objects.filter(video=obj.video)
-        predictions = Prediction.objects.filter(video_timestamp__in=video_timestamps)
-        return CustomPredictionSerializer(predictions, many=True).data
+    def get_prediction(self, obj):
+        return [scene.prediction_label for scene in obj.predicted_scenes]
 
 class URLSerializer(serializers.ModelSerializer):
     came_from_keyword = serializers.SerializerMethodField()
@@ -1,9 +1,15 @@
 # signals.py
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
-from .models import Video
+from .models import Video, VideoTimeStamps, Prediction
+from .stats import invalidate_graph_stats
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+@receiver([post_save, post_delete], sender=VideoTimeStamps)
+@receiver([post_save, post_delete], sender=Prediction)
+def invalidate_graph_stats_on_change(sender, **kwargs):
+    '''Cached dashboard stats are invalidated whenever timestamps or predictions change'''
+    invalidate_graph_stats()
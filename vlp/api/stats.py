@@ -0,0 +1,79 @@
+from django.core.cache import cache
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Max, Q
+from .models import VideoTimeStamps, Prediction
+
+
+# Buckets of the scene duration histogram in seconds as (label, lower bound, upper bound), bounds are [lower, upper)
+DURATION_BUCKETS = [
+    ('<2', None, 2),
+    ('2-5', 2, 5),
+    ('5-10', 5, 10),
+    ('>10', 10, None),
+]
+
+# The stats are recomputed at the latest after this many seconds, even if no change was detected
+CACHE_TIMEOUT = 60 * 60
+
+GENERATION_CACHE_KEY = 'graph_stats_generation'
+
+
+def duration_counts():
+    '''Counts the scenes per duration bucket with a single aggregate query'''
+    duration = ExpressionWrapper(F('end_time') - F('start_time'), output_field=FloatField())
+
+    aggregates = {}
+    for i, (label, lower, upper) in enumerate(DURATION_BUCKETS):
+        bucket = Q()
+        if lower is not None:
+            bucket &= Q(duration__gte=lower)
+        if upper is not None:
+            bucket &= Q(duration__lt=upper)
+        aggregates[f'bucket_{i}'] = Count('id', filter=bucket)
+
+    counts = VideoTimeStamps.objects.annotate(duration=duration).aggregate(**aggregates)
+    return {
+        'labels': [label for label, _, _ in DURATION_BUCKETS],
+        'counts': [counts[f'bucket_{i}'] for i in range(len(DURATION_BUCKETS))],
+    }
+
+
+def prediction_counts():
+    '''Counts the predictions per class'''
+    rows = Prediction.objects.values('prediction').annotate(count=Count('id')).order_by('prediction')
+    return {
+        'labels': [row['prediction'] if row['prediction'] is not None else 'None' for row in rows],
+        'counts': [row['count'] for row in rows],
+    }
+
+
+def invalidate_graph_stats():
+    '''
+    Drops the cached stats, called by the save and delete signals of timestamps and predictions and after
+    bulk inserts. It reaches the web workers through the shared cache of production (see CACHES), with the
+    local memory cache of development only the calling process.
+    '''
+    try:
+        cache.incr(GENERATION_CACHE_KEY)
+    except ValueError:
+        cache.set(GENERATION_CACHE_KEY, 1, None)
+
+
+def get_graph_stats():
+    """
+    Returns the duration and prediction histograms of the /graph/ dashboard.
+    The stats are cached; the cache key contains the highest timestamp and prediction id,
+    so rows inserted without signals (bulk_create, the analysis scripts) are picked up as well.
+    """
+    generation = cache.get(GENERATION_CACHE_KEY, 0)
+    latest_timestamp = VideoTimeStamps.objects.aggregate(latest=Max('id'))['latest']
+    latest_prediction = Prediction.objects.aggregate(latest=Max('id'))['latest']
+    cache_key = f'graph_stats:{generation}:{latest_timestamp}:{latest_prediction}'
+
+    stats = cache.get(cache_key)
+    if stats is None:
+        stats = {
+            'durations': duration_counts(),
+            'predictions': prediction_counts(),
+        }
+        cache.set(cache_key, stats, CACHE_TIMEOUT)
+    return stats
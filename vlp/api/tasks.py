@@ -1,45 +1,132 @@
-from celery import shared_task
+import os
+from celery import shared_task, chain, Task
 from .helpers import download_video, delete_file, create_folder_from_video_path, delete_folder_from_video_path, \
                     take_screenshot_at_second, get_video_file_clip, get_video_duration, get_video_area, \
-                    search_videos_and_add_to_db, detect_video_scenes, mock_search_videos_and_add_to_db
-from .models import Query, Video, URL
+                    search_videos_and_add_to_db, detect_video_scenes, mock_search_videos_and_add_to_db, \
+                    save_video_metadata, classify_video_scenes, claim_urls, mark_url_processed, save_analysis_results, \
+                    search_video_ids, mock_search_video_ids, add_search_results_to_db, scheduled_keywords
+from .search import run_searches, TokenBucket, DAILY_QUOTA
+from .keyword_import import run_import, read_chunks
+from .models import Query, Video, URL, KeywordImport
 from django.utils import timezone
+from django.db import DatabaseError
 from django.db.models import F,Subquery, OuterRef
 from server.settings import AUTH_PASSWORD_FOR_REQUESTS, DEBUG
-from googleapiclient.errors import HttpError
 
 
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Urls claimed per process_urls run, each runs through the pipeline stages below
+PIPELINE_BATCH_SIZE = int(os.environ.get('PIPELINE_BATCH_SIZE', 10))
+
+# A claimed url is claimed again after this time if its pipeline never finished (e.g. a worker died)
+PIPELINE_LEASE_SECONDS = int(os.environ.get('PIPELINE_LEASE_SECONDS', 6 * 60 * 60))
+
+# Scene detection runs ContentDetector on every frame, SCENE_DETECTION=fast downscales and skips frames, see scenes.py
+FAST_SCENE_DETECTION = os.environ.get('SCENE_DETECTION', 'exact') == 'fast'
+
 
 @shared_task
 def query_search():
-    logger.warn("Searching for videos with  first 100 Keywords in Query")
-    # Subquery to get the top 100 keywords' IDs
-    top_100_keywords = Query.objects.order_by('last_processed', 'use_counter')[:100]
-    logger.warning(top_100_keywords)
-    logger.warning("Subquery with top 100 Keywords")
-    for keyword in top_100_keywords:
-        try:
-            if DEBUG:
-                mock_search_videos_and_add_to_db(keyword.keyword)
-                print("Mock search")
-            else:
-                search_videos_and_add_to_db(keyword.keyword)
-
-        except HttpError as e:
-            if e.resp.status == 403 and 'quotaExceeded' in str(e):
-                logger.warning("YouTube API quota exceeded: " + str(e))
-                break
-            else:
-                # Handle other HttpErrors
-                logger.warning("HTTP error: " + str(e))
-                break
+    '''
+    Searches videos for the 100 keywords due first (see Query.next_search_at) and adds them to the URL model.
+    The API calls run concurrently within the daily quota (see search.run_searches), the results
+    are written here as the searches finish. Keywords whose search did not run keep their
+    last_processed, so they are searched again in the next run, those whose search failed are
+    delayed (see Query.record_failed_search).
+    '''
+    logger.warning("Searching for videos with  first 100 Keywords in Query")
+    top_100_keywords = {keyword.keyword: keyword for keyword in scheduled_keywords(100)}
+    # Mock searches do not call the API, they get a bucket of their own instead of the quota of the API
+    if DEBUG:
+        search, bucket = mock_search_video_ids, TokenBucket(DAILY_QUOTA, 0)
+    else:
+        search, bucket = search_video_ids, None
+
+    for keyword, result in run_searches(list(top_100_keywords), search, bucket):
+        if isinstance(result, Exception):
+            logger.warning(f"Search for keyword '{keyword}' failed: {result}")
+            top_100_keywords[keyword].record_failed_search()
+            continue
+
+        new, known = add_search_results_to_db(keyword, result)
         # Updating keyword in query
         if not DEBUG:
-            keyword.update_used_keyword()
-            keyword.save()  # I think we can delete this line
-        logger.warning(f"Keyword '{keyword.keyword}' queried and urls added to db")
-    
\ No newline at end of file
+            top_100_keywords[keyword].update_used_keyword()
+        logger.warning(f"Keyword '{keyword}' queried, {new} new and {known} known urls")
+
+
+class PipelineTask(Task):
+    '''
+    Base of the url pipeline stages. Every stage gets the job dict of the previous one (url_id, path,
+    scenes, predictions) and returns it with its own result added, the last stage (write_results)
+    returns the number of saved predictions. If a stage fails for good,
+    after its retries, the url is marked as processed like in pre_analysis.py, so a broken
+    video is not claimed again and again, and the downloaded file is deleted.
+    '''
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        job = args[0] if args else kwargs['job']
+        logger.warning(f"{self.name} failed for url {job['url_id']}: {exc}")
+        mark_url_processed(job['url_id'])
+        if job.get('path'):
+            delete_file(job['path'])
+
+
+@shared_task(bind=True)
+def process_urls(self, batch_size=PIPELINE_BATCH_SIZE):
+    '''
+    Claims a batch of unprocessed urls and starts the pipeline of every url:
+    download (downloads queue) -> scene detection -> pose classification (analysis queue)
+    -> bulk write of the timestamps and predictions. The queues are set in CELERY_TASK_ROUTES.
+    Only the path of the video is passed from the download to the analysis, so the workers of both
+    queues need the same download directory.
+    '''
+    url_ids = claim_urls(f"celery-{self.request.id}", batch_size, PIPELINE_LEASE_SECONDS)
+    for url_id in url_ids:
+        chain(download_url.s({'url_id': url_id}), detect_scenes.s(), classify_scenes.s(), write_results.s()).apply_async()
+    logger.info(f"Pipeline started for {len(url_ids)} urls")
+    return url_ids
+
+
+# Downloads fail mostly for network reasons, they are retried after 30 s, 60 s, 120 s (with jitter)
+@shared_task(base=PipelineTask, autoretry_for=(Exception,), max_retries=3, retry_backoff=30, retry_backoff_max=600,
+             retry_jitter=True)
+def download_url(job):
+    url = URL.objects.get(id=job['url_id']).url
+    file_path, metadata = download_video(url)
+    save_video_metadata(url, metadata)
+    return dict(job, path=file_path)
+
+
+@shared_task(base=PipelineTask, acks_late=True, autoretry_for=(OSError,), max_retries=2, retry_backoff=True)
+def detect_scenes(job):
+    return dict(job, scenes=detect_video_scenes(job['path'], fast=FAST_SCENE_DETECTION))
+
+
+@shared_task(base=PipelineTask, acks_late=True, autoretry_for=(OSError,), max_retries=2, retry_backoff=True)
+def classify_scenes(job):
+    predictions = classify_video_scenes(job['path'], job['scenes'])
+    # the video is not needed any more
+    delete_file(job['path'])
+    return dict(job, path=None, predictions=predictions)
+
+
+@shared_task(base=PipelineTask, autoretry_for=(DatabaseError,), max_retries=5, retry_backoff=True)
+def write_results(job):
+    '''Saves the scenes and predictions of the job and returns the number of inserted predictions'''
+    inserted = save_analysis_results(job['url_id'], job['scenes'], job['predictions'])
+    logger.info(f"Url {job['url_id']}: {len(job['scenes'])} scenes and {inserted} predictions saved")
+    return inserted
+
+
+@shared_task(acks_late=True)
+def import_keywords_file(import_id):
+    '''Imports a keyword file stored by the upload view (see keyword_import.py) and deletes it afterwards'''
+    keyword_import = KeywordImport.objects.get(id=import_id)
+    try:
+        run_import(keyword_import, read_chunks(keyword_import.path))
+    finally:
+        delete_file(keyword_import.path)
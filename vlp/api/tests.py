@@ -1,11 +1,40 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client
+from django.core.cache import cache
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
 import os
-from .helpers import download_directory, download_video, delete_file, add_url_to_db, add_urls_to_db, add_keyword_to_Query
+from .helpers import download_directory, download_video, delete_file, add_url_to_db, add_urls_to_db, add_keyword_to_Query, \
+                     save_video_metadata
+from .youtube import extract_video_id
+from .stats import get_graph_stats
+from .scenes import detect_scenes
+from . import pose, sampling, scenes, parallel, tasks, search, helpers, keyword_import, views, models
+from .result_cache import ResultCache
 from server.settings import BASE_DIR
-from .tasks import process_video_without_human, query_search
-from .models import URL, Query
-from datetime import datetime
+from server.celery import app as celery_app
+from .tasks import query_search, process_urls
+from .models import URL, Query, VideoTimeStamps, Prediction, KeywordImport
+from datetime import datetime, date, timedelta, timezone as dt_timezone
+from decimal import Decimal
 from django.utils import timezone
+import tempfile
+import sqlite3
+import time
+import json
+import threading
+from types import SimpleNamespace
+import httplib2
+from googleapiclient.errors import HttpError
+import functools
+from unittest import mock, skipUnless
+import subprocess
+import sys
+import io
+import csv
+import importlib
+from contextlib import redirect_stdout
+import cv2
+import numpy as np
 from .tasks import logger
 
 
@@ -40,6 +69,600 @@ class PysceneTest(TestCase):
         assert(len(preds) > 0)
 '''
 
+class FakeYoutubeDL:
+    '''Local stand-in for yt_dlp.YoutubeDL, writes a small file instead of downloading the video'''
+    extract_calls = 0
+
+    def __init__(self, ydl_opts):
+        self.ydl_opts = ydl_opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def extract_info(self, url, download=True):
+        FakeYoutubeDL.extract_calls += 1
+        info = {'id': 'AsrP4ji_Dtw', 'ext': 'mp4', 'duration': 12.5, 'fps': 30, 'width': 1280, 'height': 720,
+                'filesize_approx': 99, 'upload_date': '20240601'}
+        if download:
+            with open(self.ydl_opts['outtmpl'] % info, 'wb') as file:
+                file.write(b'0' * 1234)
+        return info
+
+
+class DownloadMetadataTest(TestCase):
+    '''Test that a download extracts the video info once and that the metadata is stored on the URL'''
+
+    def test_download_video_with_metadata(self):
+        video_url = 'https://www.youtube.com/shorts/AsrP4ji_Dtw'
+        add_url_to_db(video_url)
+        FakeYoutubeDL.extract_calls = 0
+
+        file_path, metadata = download_video(video_url, ydl_class=FakeYoutubeDL)
+        try:
+            self.assertEqual(FakeYoutubeDL.extract_calls, 1)
+            self.assertEqual(file_path, f"{download_directory}/AsrP4ji_Dtw.mp4")
+            self.assertTrue(os.path.exists(file_path))
+            self.assertEqual(metadata['video_id'], 'AsrP4ji_Dtw')
+            self.assertEqual(metadata['filesize'], 1234)
+        finally:
+            delete_file(file_path)
+
+        save_video_metadata(video_url, metadata)
+        url = URL.objects.get(url=video_url)
+        self.assertEqual((url.duration, url.fps, url.width, url.height), (12.5, 30, 1280, 720))
+        self.assertEqual(url.filesize, 1234)
+        self.assertEqual(url.upload_date, date(2024, 6, 1))
+
+
+def write_test_video(path, scene_colors, frames_per_scene=90, fps=30, size=(320, 180)):
+    '''Writes a video with one scene per color, every scene is a slowly moving gradient'''
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    gradient = np.linspace(0, 1, size[0], dtype=np.float32)[None, :, None]
+    for color in scene_colors:
+        for i in range(frames_per_scene):
+            mix = np.clip(gradient * 0.5 + i / frames_per_scene * 0.2, 0, 1)
+            frame = np.broadcast_to(np.array(color, dtype=np.float32) * (1 - mix), (size[1], size[0], 3))
+            writer.write(np.ascontiguousarray(frame, dtype=np.uint8))
+    writer.release()
+
+
+def write_moving_test_video(path, motion, cut_frame=100, frames=200, fps=30, size=(640, 360), grain=16, seed=0):
+    '''
+    Writes a video of a random texture seen by a camera that pans (2.5 px per frame) or zooms in,
+    with a hard cut to another texture at cut_frame. The motion adds up over skipped frames.
+    '''
+    rng = np.random.default_rng(seed)
+    width, height = size
+    textures = [cv2.resize(rng.integers(0, 256, size=(height * 2 // grain, width * 3 // grain, 3), dtype=np.uint8),
+                           (width * 3, height * 2), interpolation=cv2.INTER_CUBIC) for _ in range(2)]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for i in range(frames):
+        texture = textures[i >= cut_frame]
+        if motion == 'pan':
+            left = round(i * 2.5)
+            frame = texture[:height, left:left + width]
+        else:
+            crop_width, crop_height = round(width * 2 / (1 + i * 0.004)), round(height * 2 / (1 + i * 0.004))
+            left, top = (width * 3 - crop_width) // 2, (height * 2 - crop_height) // 2
+            frame = cv2.resize(texture[top:top + crop_height, left:left + crop_width], size, interpolation=cv2.INTER_AREA)
+        writer.write(np.ascontiguousarray(frame))
+    writer.release()
+
+
+class SceneDetectionTest(TestCase):
+    '''Test that the fast scene detection finds the same cuts as the exact mode'''
+
+    def test_fast_mode_matches_exact_mode(self):
+        with tempfile.TemporaryDirectory() as directory:
+            video_path = os.path.join(directory, 'scenes.mp4')
+            write_test_video(video_path, [(255, 40, 40), (40, 255, 40), (40, 40, 255)])
+
+            exact = detect_scenes(video_path)
+            fast = detect_scenes(video_path, fast=True, frame_skip=6)
+
+        self.assertEqual([scene[0] for scene in exact], [0.0, 3.0, 6.0])
+        self.assertEqual(fast, exact)
+
+    def test_fast_mode_with_camera_motion(self):
+        # the coarse scores of a moving camera are above the threshold, only the cut is confirmed
+        for motion in ['pan', 'zoom']:
+            with self.subTest(motion=motion), tempfile.TemporaryDirectory() as directory:
+                video_path = os.path.join(directory, f'{motion}.mp4')
+                write_moving_test_video(video_path, motion)
+
+                exact = detect_scenes(video_path)
+                fast = detect_scenes(video_path, fast=True)
+
+            self.assertEqual([scene[0] for scene in exact], [0.0, 100 / 30])
+            self.assertEqual(fast, exact)
+
+    def test_confirm_cuts_reads_forward(self):
+        with tempfile.TemporaryDirectory() as directory:
+            video_path = os.path.join(directory, 'scenes.mp4')
+            write_test_video(video_path, [(255, 40, 40), (40, 255, 40), (40, 40, 255), (255, 255, 40)], frames_per_scene=10)
+
+            # candidates that are not confirmed (8, 28) are dropped, overlapping gaps (8, 12) and gaps apart,
+            # without a single seek
+            with mock.patch.object(cv2.VideoCapture, 'set', side_effect=AssertionError('seek')):
+                cuts = scenes.confirm_cuts(video_path, [8, 12, 24, 28, 36], 30.0, step=7, min_scene_len=0)
+                self.assertEqual(cuts, [10, 20, 30])
+
+                # like the exact mode, no scene is shorter than min_scene_len
+                self.assertEqual(scenes.confirm_cuts(video_path, [12, 24, 36], 30.0, step=7, min_scene_len=15), [20])
+
+
+class FrameSamplingTest(TestCase):
+    '''Test that the sequential sampler returns the frames a seek and read per scene returns'''
+
+    def test_read_scheduled_frames(self):
+        with tempfile.TemporaryDirectory() as directory:
+            video_path = os.path.join(directory, 'scenes.mp4')
+            write_test_video(video_path, [(255, 40, 40), (40, 255, 40), (40, 40, 255)], frames_per_scene=160)
+            scene_ranges = [(0, 160), (160, 250), (250, 320), (320, 480)]  # the middle scenes are shorter than 5 seconds
+
+            schedule = sampling.build_schedule(scene_ranges, fps=30)
+            sampled = dict(sampling.read_scheduled_frames(video_path, schedule))
+
+            capture = cv2.VideoCapture(video_path)
+            for scene_index, frame_numbers in schedule:
+                for frame_number, frame in zip(frame_numbers, sampled[scene_index]):
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                    self.assertTrue(np.array_equal(capture.read()[1], frame))
+            capture.release()
+
+        self.assertEqual([scene_index for scene_index, _ in schedule], [0, 3])
+        self.assertEqual([len(sampled[0]), len(sampled[3])], [6, 6])
+
+    def test_stream_scenes_matches_two_passes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            video_path = os.path.join(directory, 'scenes.mp4')
+            write_test_video(video_path, [(255, 40, 40), (40, 255, 40), (200, 200, 40), (40, 40, 255)],
+                             frames_per_scene=160)
+            short_path = os.path.join(directory, 'short.mp4')
+            write_test_video(short_path, [(255, 40, 40), (40, 255, 40), (40, 40, 255)], frames_per_scene=90)
+
+            for path in [video_path, short_path]:
+                scene_ranges = [(round(start * 30), round(end * 30)) for start, end in detect_scenes(path)]
+                schedule = sampling.build_schedule(scene_ranges, fps=30)
+                two_passes = list(sampling.read_scheduled_frames(path, schedule))
+                one_pass = list(sampling.stream_scenes(path))
+
+                self.assertEqual([(index, scene_ranges[index]) for index, _ in two_passes],
+                                 [(index, (start, end)) for index, start, end, _ in one_pass])
+                for (_, frames), (_, _, _, streamed_frames) in zip(two_passes, one_pass):
+                    self.assertEqual(len(frames), len(streamed_frames))
+                    self.assertTrue(all(np.array_equal(a, b) for a, b in zip(frames, streamed_frames)))
+
+            self.assertEqual(len(one_pass), 0)  # every scene of short.mp4 is 3 seconds long
+
+    def test_time_based_schedule(self):
+        # the same number of samples per second, whatever the frame rate
+        self.assertEqual(sampling.sample_offsets(300, fps=30), list(range(0, 300, 30)))
+        self.assertEqual(sampling.sample_offsets(600, fps=60), list(range(0, 600, 60)))
+        offsets = sampling.sample_offsets(250, fps=25, samples_per_second=2)
+        self.assertEqual((len(offsets), offsets[:4]), (20, [0, 13, 25, 38]))
+        self.assertEqual(sampling.sample_offsets(10, fps=30, samples_per_second=60), list(range(10)))
+
+        # long scenes are sampled evenly with exactly max_samples, from the first to the last kept candidate
+        for seconds in (33, 64, 65, 100, 1000):
+            offsets = sampling.sample_offsets(30 * seconds, fps=30, max_samples=32)
+            self.assertEqual(len(offsets), 32)
+            self.assertEqual(offsets[0], 0)
+            self.assertGreater(offsets[-1], 30 * seconds * 0.95)
+            self.assertLessEqual(max(np.diff(offsets)) - min(np.diff(offsets)), min(np.diff(offsets)))
+        self.assertEqual(sampling.sample_offsets(30 * 100, fps=30, max_samples=1), [0])
+
+    def test_stream_scenes_max_samples(self):
+        with tempfile.TemporaryDirectory() as directory:
+            video_path = os.path.join(directory, 'scenes.mp4')
+            write_test_video(video_path, [(255, 40, 40), (40, 255, 40), (40, 40, 255)], frames_per_scene=300)
+            scene_ranges = [(round(start * 30), round(end * 30)) for start, end in detect_scenes(video_path)]
+            schedule = sampling.build_schedule(scene_ranges, fps=30, samples_per_second=2, max_samples=8)
+            two_passes = list(sampling.read_scheduled_frames(video_path, schedule))
+            one_pass = list(sampling.stream_scenes(video_path, samples_per_second=2, max_samples=8))
+
+        self.assertEqual(schedule[0], (0, [0, 30, 90, 120, 150, 180, 240, 270]))
+        self.assertEqual([len(frames) for _, frames in two_passes], [8, 8, 8])
+        self.assertEqual([len(frames) for _, _, _, frames in one_pass], [8, 8, 8])
+        for (_, frames), (_, _, _, streamed_frames) in zip(two_passes, one_pass):
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(frames, streamed_frames)))
+
+
+def make_person(bbox, bbox_score=0.9, keypoint_score=0.9):
+    '''Returns a person like the instances of an mmpose prediction'''
+    return {'keypoints': [[0.0, 0.0]] * 17, 'keypoint_scores': [keypoint_score] * 17,
+            'bbox': [bbox], 'bbox_score': bbox_score}
+
+
+class FakeInferencer:
+    '''Local stand-in for MMPoseInferencer, returns the people of people_per_frame for the frames in call order'''
+
+    def __init__(self, people_per_frame):
+        self.people_per_frame = people_per_frame
+        self.inputs = []
+        self.batch_sizes = []
+
+    def __call__(self, inputs, batch_size=1, **kwargs):
+        for start in range(0, len(inputs), batch_size):
+            batch = inputs[start:start + batch_size]
+            first = len(self.inputs)
+            self.inputs.extend(batch)
+            self.batch_sizes.append(len(batch))
+            yield {'visualization': [], 'predictions': self.people_per_frame[first:first + len(batch)]}
+
+
+class PoseSceneTest(TestCase):
+    '''Test that process_scene passes the frames in memory and rates the returned predictions'''
+
+    def setUp(self):
+        self.frames = [np.zeros((180, 320, 3), dtype=np.uint8) for _ in range(3)]
+        big_person = make_person([10, 10, 110, 170])
+        small_person = make_person([0, 0, 5, 5])
+        self.inferencer = FakeInferencer([[big_person], [big_person, big_person], [small_person]])
+
+    def test_process_scene_in_memory(self):
+        people_counts, frame_qualities = pose.process_scene(self.inferencer, self.frames, 320, 180)
+        self.assertTrue(all(isinstance(frame, np.ndarray) for frame in self.inferencer.inputs))
+        self.assertEqual(people_counts, [1, 2, 0])
+        self.assertEqual(frame_qualities, ['high', 'high', 'high'])
+
+    def test_process_scene_debug_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pose.process_scene(self.inferencer, self.frames, 320, 180, debug_output_dir=directory)
+            self.assertEqual(sorted(os.listdir(directory)), ['0.json', '0.png', '1.json', '1.png', '2.json', '2.png'])
+
+    def test_process_scenes_batched_across_videos(self):
+        big_person = make_person([10, 10, 110, 170])
+        scenes = [pose.Scene('a', 0, 0.0, 6.0, self.frames[:2], 320, 180),
+                  pose.Scene('a', 2, 6.0, 12.0, [], 320, 180),
+                  pose.Scene('b', 0, 0.0, 7.0, self.frames * 2, 320, 180)]
+        inferencer = FakeInferencer([[big_person]] * 2 + [[big_person, big_person]] * 6)
+
+        results = list(pose.process_scenes(inferencer, scenes, batch_size=3))
+
+        self.assertEqual(inferencer.batch_sizes, [3, 3, 2])
+        self.assertEqual([(scene.video, scene.number) for scene, _, _ in results], [('a', 0), ('a', 2), ('b', 0)])
+        self.assertEqual([people_counts for _, people_counts, _ in results], [[1, 1], [], [2] * 6])
+        self.assertEqual([pose.classify_scene(*result[1:]) for result in results], ['sl', 'nh', 'mu'])
+
+
+class AdaptiveSamplingTest(TestCase):
+    '''Test that adaptive sampling stops a scene early, by default without changing its label, and batches across scenes'''
+
+    def setUp(self):
+        self.frames = [np.zeros((180, 320, 3), dtype=np.uint8)] * 12
+        self.person = make_person([10, 10, 110, 170])
+
+    def infer(self, people_per_frame, **kwargs):
+        inferencer = FakeInferencer(people_per_frame)
+        scene = pose.Scene('a', 0, 0.0, 12.0, self.frames[:len(people_per_frame)], 320, 180)
+        results = list(pose.infer_scenes_adaptive(inferencer, [scene], batch_size=4, **kwargs))
+        return pose.label_scenes(results)[0][3], len(inferencer.inputs)
+
+    def test_multiple_people_stop_early(self):
+        people_per_frame = [[self.person, self.person]] * 12
+        self.assertEqual(self.infer(people_per_frame), ('mu', 4))
+        self.assertEqual(self.infer(people_per_frame, coarse=True), ('mu', 4))
+
+    def test_nobody(self):
+        # only the coarse mode takes the label of its coarse pass
+        self.assertEqual(self.infer([[]] * 12), ('nh', 12))
+        self.assertEqual(self.infer([[]] * 12, coarse=True, coarse_stride=3), ('nh', 4))
+
+    def test_refine_single_person(self):
+        # FakeInferencer answers in call order: the coarse frames 0, 3, 6, 9 get the first four
+        # predictions, with frame 6 medium they have no run of three high frames, the refined 1 and 2 complete one
+        medium_person = dict(self.person, keypoint_scores=[0.9] * 13 + [0.2, 0.2, 0.9, 0.9])
+        people_per_frame = [[self.person]] * 12
+        people_per_frame[2] = [medium_person]
+        self.assertEqual(self.infer(people_per_frame), ('sh', 12))
+        self.assertEqual(self.infer(people_per_frame, coarse=True, coarse_stride=3), ('sh', 8))
+
+    def test_budget(self):
+        self.assertEqual(self.infer([[self.person]] * 12, budget=5)[1], 5)
+
+    def test_batches_across_scenes(self):
+        inferencer = FakeInferencer([[], [], [], [self.person, self.person], [self.person], [self.person]])
+        scenes = [pose.Scene('a', 0, 0.0, 3.0, self.frames[:3], 320, 180),
+                  pose.Scene('a', 1, 3.0, 9.0, self.frames[:6], 320, 180),
+                  pose.Scene('b', 0, 0.0, 2.0, self.frames[:2], 320, 180),
+                  pose.Scene('b', 1, 2.0, 2.0, [], 320, 180)]
+        results = list(pose.infer_scenes_adaptive(inferencer, scenes, batch_size=4))
+
+        # the 'mu' scene stops after its first frame, the next scene fills the batch
+        self.assertEqual(inferencer.batch_sizes, [4, 2])
+        self.assertEqual([label for _, _, _, label in pose.label_scenes(results)], ['nh', 'mu', 'sl', 'nh'])
+
+    def test_labels_of_all_frames(self):
+        rng = np.random.default_rng(0)
+        choices = [[], [self.person], [self.person, self.person],
+                   [dict(self.person, keypoint_scores=[0.9] * 13 + [0.2, 0.2, 0.9, 0.9])]]
+        scenes, people_per_frame = [], []
+        for number in range(40):
+            frame_count = int(rng.integers(0, 12))
+            kinds = rng.choice(len(choices), size=frame_count, p=[0.2, 0.6, 0.05, 0.15])
+            scene_people = [choices[kind] for kind in kinds]
+            frames = [np.full((1, 1, 3), len(people_per_frame) + index, dtype=np.int32) for index in range(frame_count)]
+            people_per_frame.extend(scene_people)
+            scenes.append(pose.Scene('a', number, 0.0, 1.0, frames, 320, 180))
+
+        class IndexedInferencer:
+            '''Answers by the frame, the frames hold their index in people_per_frame'''
+            def __call__(self, inputs, batch_size=1, **kwargs):
+                yield {'predictions': [people_per_frame[int(frame[0, 0, 0])] for frame in inputs]}
+
+        expected = pose.label_scenes(pose.infer_scenes(IndexedInferencer(), scenes, batch_size=4))
+        self.assertEqual(pose.label_scenes(pose.infer_scenes_adaptive(IndexedInferencer(), scenes, batch_size=4)), expected)
+
+
+def legacy_rate_people(people, frame_width, frame_height):
+    '''The per person rules of process_scene before they were vectorized'''
+    frame_area = frame_width * frame_height
+    min_bbox_area = frame_area / 60
+    visible_people = 0
+    frame_qualities = []
+    for person in people:
+        scores = person['keypoint_scores']
+        bbox = person['bbox'][0]
+        bbox_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+        visible_points = sum(score >= 0.7 for score in scores[:5]) + sum(score >= 0.35 for score in scores[5:])
+        if bbox_area >= min_bbox_area and bbox_area < frame_area and person['bbox_score'] >= 0.4 and visible_points >= 5:
+            visible_people += 1
+            shoulders_visible = scores[5] >= 0.5 or scores[6] >= 0.5
+            knees_visible = scores[13] >= 0.5 or scores[14] >= 0.5
+            arms_hands_visible = sum(scores[i] >= 0.5 for i in [5, 6, 7, 8, 9, 10]) >= 3
+            if shoulders_visible and knees_visible and bbox_area/frame_area > 1/30:
+                frame_qualities.append("high")
+            elif arms_hands_visible and bbox_area/frame_area > 1/30:
+                frame_qualities.append("medium")
+            else:
+                frame_qualities.append("low")
+    return visible_people, frame_qualities
+
+
+def legacy_classify_scene(people_counts, frame_qualities):
+    '''The scene classification of process_video before it was vectorized'''
+    if all(count == 0 for count in people_counts):
+        return 'nh'
+    if any(count > 1 for count in people_counts):
+        return 'mu'
+    high_count = sum(1 for i in range(len(frame_qualities) - 2) if all(q == "high" for q in frame_qualities[i:i+3]))
+    medium_count = sum(1 for i in range(len(frame_qualities) - 2) if all(q in ["medium", "high"] for q in frame_qualities[i:i+3]))
+    if high_count > 0:
+        return 'sh'
+    if medium_count > 0:
+        return 'sm'
+    return 'sl'
+
+
+class VectorizedRulesTest(TestCase):
+    '''Parity of the NumPy keypoint filtering and classification with the former per person rules'''
+
+    def random_person(self, rng, frame_width, frame_height):
+        # scores and sizes are drawn around the thresholds, including the exact threshold values
+        scores = rng.choice([0.0, 0.2, 0.35, 0.5, 0.6, 0.7, 0.9], size=17).tolist()
+        width, height = rng.uniform(0, frame_width), rng.uniform(0, frame_height)
+        x, y = rng.uniform(0, frame_width - width), rng.uniform(0, frame_height - height)
+        return {'keypoint_scores': scores, 'bbox': ([x, y, x + width, y + height],),
+                'bbox_score': float(rng.choice([0.3, 0.4, 0.8]))}
+
+    def test_parity_with_legacy_rules(self):
+        rng = np.random.default_rng(0)
+        labels = set()
+        for _ in range(400):
+            frame_width, frame_height = [(1280, 720), (720, 1280), (320, 180)][rng.integers(3)]
+            # mostly single people, so the quality windows decide the label
+            people_per_frame = [[self.random_person(rng, frame_width, frame_height)
+                                 for _ in range(rng.choice([0, 1, 1, 1, 2]))] for _ in range(rng.integers(0, 12))]
+
+            legacy = [legacy_rate_people(people, frame_width, frame_height) for people in people_per_frame]
+            legacy_counts = [count for count, _ in legacy]
+            legacy_qualities = [quality for _, qualities in legacy for quality in qualities]
+
+            people_counts, qualities = pose.rate_frames(people_per_frame, frame_width, frame_height)
+            self.assertEqual(people_counts.tolist(), legacy_counts)
+            self.assertEqual(pose.quality_labels(qualities), legacy_qualities)
+
+            label = pose.classify_scene(people_counts, pose.quality_labels(qualities))
+            self.assertEqual(label, legacy_classify_scene(legacy_counts, legacy_qualities))
+            labels.add(label)
+
+        self.assertEqual(labels, {'nh', 'mu', 'sh', 'sm', 'sl'})
+
+
+class LazyImportTest(TestCase):
+    '''Test that the web server does not import the video and analysis libraries'''
+
+    def test_views_import_light(self):
+        code = ("import sys, django; django.setup(); import api.views; "
+                "print(','.join(m for m in ['moviepy.editor', 'yt_dlp', 'scenedetect', 'cv2', "
+                "'googleapiclient.discovery'] if m in sys.modules))")
+        result = subprocess.run([sys.executable, '-c', code], cwd=BASE_DIR, capture_output=True, text=True,
+                                env=dict(os.environ, DJANGO_SETTINGS_MODULE='server.settings'))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '')
+
+
+class ParallelRunnerTest(TestCase):
+    '''Test that the process pool returns every result, failures included, with its item'''
+
+    def test_run_in_pool(self):
+        items = ['/videos/a.mp4', '/videos/b.mp4', None, '/videos/c.mp4']
+        for workers in [1, 2]:
+            results = dict(parallel.run_in_pool(os.path.basename, items, workers=workers, threads_per_worker=1))
+            self.assertEqual(results['/videos/b.mp4'], 'b.mp4')
+            self.assertIsInstance(results[None], TypeError)
+            self.assertEqual(len(results), 4)
+
+
+class ResultCacheTest(TestCase):
+    '''Test that analysis results are cached per video, stage, version and parameters, and evicted'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(os.path.join(self.directory.name, 'results.sqlite3'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_set(self):
+        self.cache.set('video', 'scenes', 1, {'threshold': 30}, [[0.0, 6.0]])
+        self.assertEqual(self.cache.get('video', 'scenes', 1, {'threshold': 30}), [[0.0, 6.0]])
+        self.assertIsNone(self.cache.get('video', 'scenes', 1, {'threshold': 27}))
+        self.assertIsNone(self.cache.get('video', 'scenes', 2, {'threshold': 30}))
+        self.assertIsNone(self.cache.get('other', 'scenes', 1, {'threshold': 30}))
+
+    def test_eviction(self):
+        self.cache.max_bytes = 2500
+        for video in ['a', 'b', 'c']:
+            self.cache.set(video, 'keypoints', 1, {}, b'x' * 1000)
+            self.cache.get('a', 'keypoints', 1, {})
+        # b was used least recently
+        self.assertIsNone(self.cache.get('b', 'keypoints', 1, {}))
+        self.assertIsNotNone(self.cache.get('a', 'keypoints', 1, {}))
+
+        self.cache.max_age_days = 0
+        self.cache.evict()
+        self.assertIsNone(self.cache.get('a', 'keypoints', 1, {}))
+
+    def test_total_size(self):
+        def total_size():
+            connection = self.cache._connection()
+            tracked = connection.execute('SELECT size FROM total_size').fetchone()[0]
+            summed = connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            self.assertEqual(tracked, summed)
+            return tracked
+
+        self.cache.set('a', 'keypoints', 1, {}, b'x' * 1000)
+        self.cache.set('b', 'keypoints', 1, {}, b'x' * 1000)
+        first = total_size()
+        # replacing an entry counts its new size only
+        self.cache.set('a', 'keypoints', 1, {}, b'x' * 2000)
+        self.assertEqual(total_size(), first + 1000)
+        self.cache.invalidate('a')
+        self.assertEqual(total_size(), first // 2)
+        self.cache.max_age_days = 0
+        self.cache.evict()
+        self.assertEqual(total_size(), 0)
+
+    def test_total_size_of_existing_cache(self):
+        # a cache written before the size was tracked
+        path = os.path.join(self.directory.name, 'old.sqlite3')
+        with sqlite3.connect(path) as connection:
+            connection.execute("""
+            CREATE TABLE results (video_id TEXT NOT NULL, stage TEXT NOT NULL, version TEXT NOT NULL,
+                                  params_hash TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL,
+                                  created_at REAL NOT NULL, used_at REAL NOT NULL,
+                                  PRIMARY KEY (video_id, stage, version, params_hash))
+            """)
+            connection.execute("INSERT INTO results VALUES ('a', 'keypoints', '1', 'hash', x'00', 1500, ?, ?)",
+                               (time.time(), time.time()))
+        connection.close()
+        cache = ResultCache(path, max_bytes=2000)
+        cache.set('b', 'keypoints', 1, {}, b'x' * 1000)
+        # the old entry counts, so it is evicted
+        self.assertEqual(cache._connection().execute('SELECT video_id FROM results').fetchall(), [('b',)])
+
+    def test_analyze_videos_cached(self):
+        frames = [np.zeros((180, 320, 3), dtype=np.uint8)] * 3
+        big_person = make_person([10, 10, 110, 170])
+        sampled = []
+
+        def sample_scenes(video):
+            sampled.append(video)
+            return [pose.Scene(video, 0, 0.0, 6.0, frames, 320, 180)]
+
+        videos = [(video, functools.partial(sample_scenes, video)) for video in ['a', 'b']]
+        inferencer = FakeInferencer([[big_person]] * 3 + [[big_person, big_person]] * 3)
+        expected = [['a', 0.0, 6.0, 'sh'], ['b', 0.0, 6.0, 'mu']]
+        self.assertEqual(pose.analyze_videos_cached(videos, lambda: inferencer, self.cache, {}), expected)
+        self.assertEqual(sampled, ['a', 'b'])
+
+        # cached videos are neither sampled nor inferred, not even after a rules change
+        no_inferencer = mock.Mock(side_effect=AssertionError('inferencer loaded'))
+        self.assertEqual(pose.analyze_videos_cached(videos, no_inferencer, self.cache, {}), expected)
+        with mock.patch.object(pose, 'RULES_VERSION', pose.RULES_VERSION + 1):
+            self.assertEqual(pose.analyze_videos_cached(videos, no_inferencer, self.cache, {}), expected)
+        self.assertEqual(sampled, ['a', 'b'])
+
+        # other parameters are analysed again
+        inferencer = FakeInferencer([[big_person]] * 6)
+        pose.analyze_videos_cached(videos[1:], lambda: inferencer, self.cache, {'model': 'other'})
+        self.assertEqual(sampled, ['a', 'b', 'b'])
+
+
+class UrlPipelineTest(TestCase):
+    '''Test the url pipeline end to end in eager mode, with synthetic videos instead of downloads'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.downloads = []
+        celery_app.conf.update(task_always_eager=True, task_eager_propagates=True)
+        add_urls_to_db(['https://www.youtube.com/watch?v=aaaaaaaaaaa', 'https://www.youtube.com/watch?v=bbbbbbbbbbb'])
+
+        person = make_person([10, 10, 110, 170])
+        patches = [mock.patch.object(tasks, 'download_video', self.download),
+                   mock.patch.object(pose, 'get_inferencer', lambda: FakeInferencer([[person]] * 100))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        celery_app.conf.update(task_always_eager=False, task_eager_propagates=False)
+        self.directory.cleanup()
+
+    def download(self, url):
+        '''Stand-in for helpers.download_video, writes a synthetic video with two 6 second scenes'''
+        self.downloads.append(url)
+        path = os.path.join(self.directory.name, f'{extract_video_id(url)}.mp4')
+        write_test_video(path, [(255, 40, 40), (40, 40, 255)], frames_per_scene=180)
+        return path, {'duration': 12.0, 'fps': 30.0, 'width': 320, 'height': 180}
+
+    def test_process_urls(self):
+        url_ids = process_urls.delay().get()
+
+        self.assertEqual(len(url_ids), 2)
+        self.assertFalse(URL.objects.filter(is_processed=False).exists())
+        self.assertFalse(URL.objects.filter(lease_owner__isnull=False).exists())
+        self.assertEqual(set(URL.objects.values_list('fps', flat=True)), {30.0})
+        for url in URL.objects.all():
+            timestamps = VideoTimeStamps.objects.filter(video=url).order_by('start_time')
+            self.assertEqual([(t.start_time, t.end_time) for t in timestamps], [(0.0, 6.0), (6.0, 12.0)])
+            self.assertEqual(list(Prediction.objects.filter(video_timestamp__video=url).values_list('prediction', flat=True)),
+                             ['sh', 'sh'])
+        self.assertEqual(os.listdir(self.directory.name), [])  # the videos are deleted after the analysis
+
+        # nothing left to claim
+        self.assertEqual(process_urls.delay().get(), [])
+        self.assertEqual(len(self.downloads), 2)
+
+    def test_retries_and_failures(self):
+        calls = []
+
+        def flaky_download(url):
+            calls.append(url)
+            if url.endswith('a') and len(calls) == 1:
+                raise IOError('connection reset')
+            if url.endswith('b'):
+                raise IOError('video unavailable')
+            return self.download(url)
+
+        # eager retries only run if the errors are not propagated
+        celery_app.conf.task_eager_propagates = False
+        with mock.patch.object(tasks, 'download_video', flaky_download):
+            results = [tasks.download_url.delay({'url_id': url_id}) for url_id in tasks.claim_urls('test', 10, 60)]
+
+        # a is downloaded at the second try, b fails for good after its retries and is not claimed again
+        self.assertEqual([result.successful() for result in results], [True, False])
+        self.assertEqual(calls.count('https://www.youtube.com/watch?v=aaaaaaaaaaa'), 2)
+        self.assertEqual(calls.count('https://www.youtube.com/watch?v=bbbbbbbbbbb'), 1 + tasks.download_url.max_retries)
+        self.assertTrue(URL.objects.get(video_id='bbbbbbbbbbb').is_processed)
+        self.assertEqual(tasks.claim_urls('test', 10, 60), [])
+
+
 class AddUrlToDB(TestCase):
     """Test the add_url_to_db by adding a Url to the URL model and then checking if it exists and adding duplicate urls, checking if only one exists"""
     
@@ -58,6 +681,60 @@ class AddUrlToDB(TestCase):
         self.assertEqual(query_count, 1)
 
 
+class AddUrlsUpsertTest(TestCase):
+    '''Test that add_urls_to_db inserts in chunks, skips existing urls and returns the ids of both'''
+
+    def test_inserted_and_existing_ids(self):
+        existing_ids, _ = add_urls_to_db(['https://www.youtube.com/watch?v=aaaaaaaaaaa', 'https://example.com/video'])
+        urls = ['https://youtu.be/aaaaaaaaaaa', 'https://example.com/video'] + \
+               [f'https://www.youtube.com/watch?v=b{index:010d}' for index in range(20)]
+
+        with mock.patch.object(helpers, 'URL_CHUNK_SIZE', 7):
+            inserted_ids, known_ids = add_urls_to_db(urls)
+
+        self.assertEqual(sorted(known_ids), sorted(existing_ids))
+        self.assertEqual(len(inserted_ids), 20)
+        self.assertEqual(set(URL.objects.filter(video_id__startswith='b').values_list('id', flat=True)), set(inserted_ids))
+        self.assertEqual(URL.objects.count(), 22)
+
+    def test_concurrent_insert(self):
+        # urls inserted by another writer between the lookup and the insert are reported as existing
+        url = 'https://www.youtube.com/watch?v=ccccccccccc'
+        insert = helpers.insert_urls_ignore_conflicts
+
+        def insert_after_other_writer(rows):
+            URL.objects.create(url=url)
+            return insert(rows)
+
+        with mock.patch.object(helpers, 'insert_urls_ignore_conflicts', insert_after_other_writer):
+            inserted_ids, existing_ids = add_urls_to_db([url])
+        self.assertEqual((inserted_ids, existing_ids), ([], [URL.objects.get(url=url).id]))
+
+
+class VideoIdTest(TestCase):
+    """Test the extraction of the canonical video id and the deduplication of urls through it"""
+
+    def test_extract_video_id(self):
+        self.assertEqual(extract_video_id('https://www.youtube.com/watch?v=dQw4w9WgXcQ'), 'dQw4w9WgXcQ')
+        self.assertEqual(extract_video_id('https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=10'), 'dQw4w9WgXcQ')
+        self.assertEqual(extract_video_id('https://www.youtube.com/shorts/AsrP4ji_Dtw'), 'AsrP4ji_Dtw')
+        self.assertEqual(extract_video_id('https://youtu.be/AsrP4ji_Dtw?si=abc'), 'AsrP4ji_Dtw')
+        self.assertIsNone(extract_video_id('https://www.youtube.com/watch?v=AsrP4ji_Dtwxyz'))
+        self.assertIsNone(extract_video_id('https://example.com/AsrP4ji_Dtw'))
+
+    def test_add_url_sets_video_id(self):
+        add_url_to_db('https://www.youtube.com/shorts/AsrP4ji_Dtw')
+        self.assertTrue(URL.objects.filter(video_id='AsrP4ji_Dtw').exists())
+
+    def test_add_same_video_with_different_urls(self):
+        add_urls_to_db(['https://www.youtube.com/shorts/AsrP4ji_Dtw', 'https://youtu.be/AsrP4ji_Dtw'])
+        add_url_to_db('https://www.youtube.com/watch?v=AsrP4ji_Dtw')
+
+        # Only the first url of the video is stored
+        self.assertEqual(URL.objects.filter(video_id='AsrP4ji_Dtw').count(), 1)
+        self.assertEqual(URL.objects.get(video_id='AsrP4ji_Dtw').url, 'https://www.youtube.com/shorts/AsrP4ji_Dtw')
+
+
 class AddKeywordQuery(TestCase):
     """Test the add_Keyword_to_Query by adding a keyword to the Query model and then checking if it exists, then adding a keyword twice to the Query model and then checking if only one exists"""
     
@@ -91,6 +768,284 @@ class AddKeywordQuery(TestCase):
 
 
 
+class KeywordImportTest(TestCase):
+    '''Test the streaming keyword import and the upload view, in the request and as a background job'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patch = mock.patch.object(keyword_import, 'IMPORT_DIRECTORY', self.directory.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_split_keywords(self):
+        # keywords and a multi byte character cut by chunk boundaries, a byte order mark and line breaks
+        content = '\ufeffyoga, Übung,squat\r\npush up,'.encode('utf-8')
+        chunks = [content[:5], content[5:11], content[11:]]
+        keywords = [keyword for _, chunk_keywords in keyword_import.split_keywords(chunks) for keyword in chunk_keywords]
+        self.assertEqual([k.strip() for k in keywords if k.strip()], ['yoga', 'Übung', 'squat', 'push up'])
+
+    def test_import_keywords(self):
+        Query.objects.create(keyword='yoga')
+        content = ('Yoga, squat ,SQUAT,,lunge,' + 'x' * 300 + ',plank,squat').encode()
+        progress = []
+        stats = keyword_import.import_keywords([content[:10], content[10:]], progress=lambda stats: progress.append(dict(stats)),
+                                               batch_size=2)
+
+        self.assertEqual(stats, {'bytes_read': len(content), 'keywords': 6, 'added': 3, 'skipped': 1})
+        self.assertEqual(sorted(Query.objects.values_list('keyword', flat=True)), ['lunge', 'plank', 'squat', 'yoga'])
+        self.assertEqual([p['added'] for p in progress], [1, 2, 3])
+
+    def test_upload_in_request(self):
+        upload = SimpleUploadedFile('keywords.txt', b'Workout, yoga,workout')
+        response = Client().post('/upload/', {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(Query.objects.values_list('keyword', flat=True)), ['workout', 'yoga'])
+
+        status = Client().get(f'/upload/status/{KeywordImport.objects.get().id}/').json()
+        self.assertEqual((status['status'], status['keywords'], status['added']), ('done', 3, 2))
+        self.assertEqual(Client().get('/upload/status/0/').status_code, 404)
+
+    def test_upload_in_background(self):
+        celery_app.conf.update(task_always_eager=True, task_eager_propagates=True)
+        self.addCleanup(celery_app.conf.update, task_always_eager=False, task_eager_propagates=False)
+        keywords = [f'keyword {number}' for number in range(2000)]
+        upload = SimpleUploadedFile('keywords.txt', ','.join(keywords).encode())
+
+        with mock.patch.object(views, 'SYNC_IMPORT_BYTES', 1000), self.captureOnCommitCallbacks(execute=True):
+            Client().post('/upload/', {'file': upload})
+
+        keyword_import = KeywordImport.objects.get()
+        self.assertEqual((keyword_import.status, keyword_import.added, keyword_import.bytes_read),
+                         (KeywordImport.DONE, 2000, keyword_import.total_bytes))
+        self.assertEqual(Query.objects.count(), 2000)
+        self.assertEqual(os.listdir(self.directory.name), [])  # the stored upload is deleted
+
+    def test_upload_not_utf8(self):
+        # keywords filling more than one read chunk, then a byte that is not utf-8
+        content = ','.join(f'keyword {number}' for number in range(10000)).encode() + ',Übung'.encode('latin-1')
+        self.assertGreater(len(content), keyword_import.CHUNK_SIZE)
+
+        # in the request nothing is added
+        Client().post('/upload/', {'file': SimpleUploadedFile('keywords.txt', content)})
+        failed = KeywordImport.objects.get()
+        self.assertEqual(failed.status, KeywordImport.FAILED)
+        self.assertIn('utf-8', failed.error)
+        self.assertIn('no keywords were added', failed.error)
+        self.assertEqual(Query.objects.count(), 0)
+
+        # in the background the batches before are kept, the status says so
+        celery_app.conf.update(task_always_eager=True, task_eager_propagates=True)
+        self.addCleanup(celery_app.conf.update, task_always_eager=False, task_eager_propagates=False)
+        with mock.patch.object(views, 'SYNC_IMPORT_BYTES', 1000), self.captureOnCommitCallbacks(execute=True):
+            Client().post('/upload/', {'file': SimpleUploadedFile('keywords.txt', content)})
+        failed = KeywordImport.objects.exclude(id=failed.id).get()
+        self.assertEqual(failed.status, KeywordImport.FAILED)
+        self.assertGreater(failed.added, 0)
+        self.assertEqual(Query.objects.count(), failed.added)
+        self.assertIn(f'the {failed.added} keywords before were added', failed.error)
+
+    def test_added_excludes_concurrent_inserts(self):
+        # a keyword inserted by another writer after the batch was read is not counted as added
+        Query.objects.create(keyword='squat')
+        self.assertEqual(keyword_import.insert_keywords(['yoga', 'squat', 'lunge']), 2)
+        self.assertEqual(keyword_import.insert_keywords(['yoga', 'squat', 'lunge']), 0)
+
+
+def http_error(status, reason):
+    '''An HttpError like the ones of the YouTube API'''
+    content = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+    return HttpError(httplib2.Response({'status': status}), content.encode())
+
+
+class FakeSearchAPI:
+    '''Local stand-in for the YouTube API client, search().list(q=...).execute() finds 3 videos per keyword'''
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}  # keyword -> errors raised by its first calls
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def search(self):
+        return self
+
+    def list(self, q, maxResults, **kwargs):
+        return SimpleNamespace(execute=functools.partial(self.execute, q, min(maxResults, 3)))
+
+    def execute(self, keyword, video_amount):
+        with self.lock:
+            self.calls.append(keyword)
+            errors = self.errors.get(keyword)
+            error = errors.pop(0) if errors else None
+        if error:
+            raise error
+        return {'items': [{'id': {'videoId': f'{keyword:_<5.5}{index:06d}'}} for index in range(video_amount)]}
+
+
+class KeywordSearchTest(TestCase):
+    '''Test the concurrent keyword search against a fake of the search API'''
+
+    def setUp(self):
+        self.keywords = ['k0', 'k1', 'k2', 'k3', 'k4', 'k5']
+        for keyword in self.keywords:
+            add_keyword_to_Query(keyword)
+
+    def run_query_search(self, api, quota=10000):
+        bucket = search.TokenBucket(quota, 0)
+        with mock.patch.object(tasks, 'DEBUG', False), mock.patch('api.helpers.get_youtube_client', lambda: api), \
+                mock.patch.object(search, 'get_quota_bucket', lambda: bucket), \
+                mock.patch.object(search, 'RETRY_BASE_SECONDS', 0):
+            query_search()
+        return set(Query.objects.filter(use_counter=1).values_list('keyword', flat=True))
+
+    def test_retries_and_failures(self):
+        api = FakeSearchAPI({'k1': [http_error(503, 'backendError'), ConnectionError('reset')],
+                             'k2': [http_error(400, 'badRequest')]})
+        searched = self.run_query_search(api)
+
+        # k1 succeeds at the third call, k2 is not retried and is delayed
+        self.assertEqual(searched, {'k0', 'k1', 'k3', 'k4', 'k5'})
+        self.assertEqual(api.calls.count('k1'), 3)
+        self.assertEqual(api.calls.count('k2'), 1)
+        self.assertEqual(URL.objects.filter(came_from_keyword__keyword='k1').count(), 3)
+        self.assertEqual(URL.objects.count(), 15)
+
+        k2 = Query.objects.get(keyword='k2')
+        self.assertEqual(k2.search_failures, 1)
+        self.assertGreaterEqual(k2.next_search_at, k2.last_failed_at + models.SEARCH_INTERVAL)
+        # it no longer comes before keywords that were never searched
+        add_keyword_to_Query('k6')
+        self.assertEqual([query.keyword for query in helpers.scheduled_keywords(1)], ['k6'])
+
+        # every failure in a row doubles the delay, up to MAX_FAILURE_DOUBLINGS times, a search resets it
+        for failures in range(1, 10):
+            k2.record_failed_search()
+            self.assertEqual(k2.next_search_at - k2.last_failed_at,
+                             models.SEARCH_INTERVAL * 2 ** min(failures, models.MAX_FAILURE_DOUBLINGS))
+        k2.update_used_keyword()
+        self.assertEqual((k2.search_failures, k2.next_search_at),
+                         (0, models.keyword_due_time(k2.last_processed, k2.use_counter, k2.quality_metric)))
+
+    def test_search_results_bulk_insert(self):
+        add_url_to_db('https://www.youtube.com/watch?v=k0___000001')
+        video_ids = [f'k0___{index:06d}' for index in range(50)]
+
+        # the query is looked up once, all videos are inserted at once and the known ones looked up
+        with self.assertNumQueries(5):
+            self.assertEqual(helpers.add_search_results_to_db('k0', video_ids + video_ids[:5]), (49, 1))
+        self.assertEqual(URL.objects.filter(came_from_keyword__keyword='k0').count(), 49)
+        self.assertEqual(helpers.add_search_results_to_db('k0', video_ids), (0, 50))
+
+    def test_token_bucket_quota(self):
+        # the bucket holds the quota of 3 searches
+        searched = self.run_query_search(FakeSearchAPI(), quota=3 * search.SEARCH_COST)
+        self.assertEqual(len(searched), 3)
+        self.assertEqual(URL.objects.count(), 9)
+
+    def test_quota_exceeded_stops(self):
+        api = FakeSearchAPI({'k1': [http_error(403, 'quotaExceeded')]})
+        results = list(search.run_searches(['k0', 'k1', 'k2'], search_video_ids_with(api), search.TokenBucket(10000, 0),
+                                           threads=1))
+        self.assertEqual([keyword for keyword, _ in results], ['k0'])
+        self.assertEqual(api.calls, ['k0', 'k1'])
+
+    def test_token_bucket_refill(self):
+        now = [0.0]
+        bucket = search.TokenBucket(2, 0.5, clock=lambda: now[0])
+        self.assertTrue(bucket.try_acquire() and bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        now[0] = 2.0
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+    def test_shared_quota(self):
+        # two worker processes share the quota of the day, a new Pacific day starts a new count
+        client = FakeRedis()
+        now = [datetime(2026, 10, 18, 23, 30, tzinfo=search.QUOTA_TIMEZONE)]
+        workers = [search.SharedQuota(client, daily_quota=300, clock=lambda: now[0]) for _ in range(2)]
+        self.assertEqual([worker.try_acquire(100) for worker in workers * 2], [True, True, True, False])
+        self.assertEqual(workers[0].used(), 300)
+
+        now[0] += timedelta(hours=1)
+        self.assertTrue(workers[1].try_acquire(100))
+        self.assertEqual(workers[0].used(), 100)
+        self.assertEqual(client.expiry, {key: search.QUOTA_KEY_SECONDS for key in client.values})
+
+
+class FakeRedis:
+    '''The Redis commands SharedQuota uses, on a dict'''
+
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.expiry[key] = ex
+        return True
+
+    def incrby(self, key, amount):
+        self.values[key] = self.values.get(key, 0) + amount
+        return self.values[key]
+
+    def decrby(self, key, amount):
+        return self.incrby(key, -amount)
+
+
+def search_video_ids_with(api):
+    '''helpers.search_video_ids with the given API client'''
+    def search_video_ids(keyword):
+        with mock.patch('api.helpers.get_youtube_client', lambda: api):
+            return helpers.search_video_ids(keyword)
+    return search_video_ids
+
+
+class KeywordScheduleTest(TestCase):
+    '''Test the priority of the keywords: staleness, use count and quality metric, kept up to date incrementally'''
+
+    def setUp(self):
+        now = timezone.now()
+        self.keywords = {}
+        for keyword, days_ago, use_counter, quality_metric in [('fresh', 0, 1, 0), ('stale', 3, 1, 0), ('popular', 3, 10, 0),
+                                                               ('useful', 3, 10, 1), ('new', None, 0, 0)]:
+            last_processed = now - timedelta(days=days_ago) if days_ago is not None else datetime(1, 1, 1, tzinfo=dt_timezone.utc)
+            self.keywords[keyword] = Query.objects.create(keyword=keyword, last_processed=last_processed,
+                                                          use_counter=use_counter, quality_metric=quality_metric)
+
+    def scheduled(self):
+        return [query.keyword for query in helpers.scheduled_keywords(10)]
+
+    def test_priority_order(self):
+        # never searched first, a good quality makes up for many searches
+        self.assertEqual(self.scheduled(), ['new', 'useful', 'stale', 'popular', 'fresh'])
+        self.assertEqual([query.keyword for query in Query.objects.all()], self.scheduled())
+
+    def test_update_used_keyword(self):
+        self.keywords['new'].update_used_keyword()
+        self.keywords['useful'].update_used_keyword()
+        self.assertEqual(self.scheduled(), ['stale', 'popular', 'useful', 'fresh', 'new'])
+
+    def test_classified_scenes(self):
+        url_ids, _ = add_urls_to_db(['https://www.youtube.com/watch?v=aaaaaaaaaaa'], query='popular')
+        scenes = [[0.0, 1.0], [1.0, 2.0], [2.0, 3.0], [3.0, 4.0]]
+        helpers.save_analysis_results(url_ids[0], scenes, [scene + [label] for scene, label in zip(scenes, ['sh', 'mu', 'nh', 'sm'])])
+
+        popular = Query.objects.get(keyword='popular')
+        self.assertEqual((popular.classified_scenes, popular.useful_scenes, popular.quality_metric), (4, 2, Decimal('0.5')))
+        self.assertEqual(self.scheduled(), ['new', 'useful', 'popular', 'stale', 'fresh'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'the plan of small tables depends on the statistics of the database')
+    def test_index_scan(self):
+        plan = Query.objects.order_by('next_search_at', 'id')[:100].explain()
+        self.assertIn('query_schedule_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)  # no sort
+
+
 class QuerySearchTestCase(TestCase):
     """Test case for the query_search shared task."""
 
@@ -100,29 +1055,367 @@ class QuerySearchTestCase(TestCase):
         Query.objects.create(keyword='keyword2')
 
     def test_query_search(self):
-        
-        
-        n_of_urls_initial = URL.objects.all().count()
-        # Call the task function
-        query_search()
-        
-        # Comment this out if the API_KEY limit is reached
-        '''
-        self.assertGreater(URL.objects.all().count(), n_of_urls_initial)
-
-        # Assert that top 100 keywords are processed
-        top_100_keywords = Query.objects.order_by('-last_processed', 'use_counter')[:100]
-        self.assertEqual(len(top_100_keywords), 2)  # Assuming only 2 dummy keywords are created
-
-        
-        # Assert that each keyword was updated correctly
-        for keyword in top_100_keywords:
-            self.assertEqual(keyword.last_processed.date(), timezone.now().date())  # Check last_processed
-            self.assertGreater(keyword.use_counter, 0)  # Check use_counter 
-        '''
+        # in DEBUG the searches are mocked and take nothing from the quota of the API
+        quota = search.TokenBucket(10000, 0)
+        mock_search = mock.Mock(return_value=[])
+        with mock.patch.object(tasks, 'DEBUG', True), mock.patch.object(tasks, 'mock_search_video_ids', mock_search), \
+                mock.patch.object(search, 'get_quota_bucket', lambda: quota):
+            query_search()
+        self.assertEqual(sorted(call.args[0] for call in mock_search.call_args_list), ['keyword1', 'keyword2'])
+        self.assertEqual(quota.tokens, 10000)
+
+        # real searches take SEARCH_COST per call
+        api = FakeSearchAPI()
+        with mock.patch.object(tasks, 'DEBUG', False), mock.patch('api.helpers.get_youtube_client', lambda: api), \
+                mock.patch.object(search, 'get_quota_bucket', lambda: quota):
+            query_search()
+        self.assertEqual(sorted(api.calls), ['keyword1', 'keyword2'])
+        self.assertEqual(quota.tokens, 10000 - 2 * search.SEARCH_COST)
+
+    def test_quota_bucket_without_redis(self):
+        self.addCleanup(setattr, search, '_quota_bucket', None)
+        search._quota_bucket = None
+        with self.settings(SEARCH_QUOTA_REDIS_URL=None):
+            bucket = search.get_quota_bucket()
+        self.assertIsInstance(bucket, search.TokenBucket)
+        self.assertIs(search.get_quota_bucket(), bucket)
+
 
 class DatabaseExists(TestCase):
     def database_existence(self):
         n_of_urls_initial = URL.objects.all().count()
         logger.warn(f"n_of_urls_initial:{n_of_urls_initial}")
-        assert(n_of_urls_initial > 0)
\ No newline at end of file
+        assert(n_of_urls_initial > 0)
+
+
+class GroupedPredictionsTest(TestCase):
+    """Test the grouped predictions endpoint, its columnar format and the number of queries per page"""
+
+    def setUp(self):
+        for i in range(5):
+            video = URL.objects.create(url=f'https://www.youtube.com/watch?v=video{i:06d}')
+            # Scenes are created in reverse order to check the ordering by start time
+            for start_time in [20.0, 10.0, 0.0]:
+                timestamp = VideoTimeStamps.objects.create(video=video, start_time=start_time, end_time=start_time + 10)
+                Prediction.objects.create(video_timestamp=timestamp, prediction='sh' if start_time else 'mu')
+
+        # Videos without predictions are not listed
+        video = URL.objects.create(url='https://www.youtube.com/watch?v=unpredicted')
+        VideoTimeStamps.objects.create(video=video, start_time=0.0, end_time=10.0)
+
+    def test_grouped_predictions(self):
+        response = self.client.get('/grouped_predictions/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 5)
+
+        first_video = response.json()['results'][0]
+        self.assertEqual(first_video, {
+            'video_url': 'https://www.youtube.com/watch?v=video000000',
+            'start_time': [0.0, 10.0, 20.0],
+            'end_time': [10.0, 20.0, 30.0],
+            'prediction': ['mu', 'sh', 'sh'],
+        })
+
+    def test_grouped_predictions_query_count(self):
+        # count, page of videos and one query for the scenes of the whole page
+        with self.assertNumQueries(3):
+            self.client.get('/grouped_predictions/')
+
+        for i in range(5, 20):
+            video = URL.objects.create(url=f'https://www.youtube.com/watch?v=video{i:06d}')
+            timestamp = VideoTimeStamps.objects.create(video=video, start_time=0.0, end_time=10.0)
+            Prediction.objects.create(video_timestamp=timestamp, prediction='nh')
+
+        # The number of queries does not grow with the number of videos
+        with self.assertNumQueries(3):
+            response = self.client.get('/grouped_predictions/')
+        self.assertEqual(len(response.json()['results']), 20)
+
+
+class CursorPaginationTest(TestCase):
+    """Test walking the read-only endpoints with ?pagination=cursor"""
+
+    def setUp(self):
+        video = URL.objects.create(url='https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+        for i in range(7):
+            timestamp = VideoTimeStamps.objects.create(video=video, start_time=i, end_time=i + 1)
+            Prediction.objects.create(video_timestamp=timestamp, prediction='sh')
+        for keyword in ['c', 'a', 'b']:
+            Query.objects.create(keyword=keyword)
+
+    def walk(self, url):
+        results = []
+        while url:
+            # One query per page, no COUNT(*) and no related lookups per row
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertNotIn('count', response.json())
+            results.extend(response.json()['results'])
+            url = response.json()['next']
+        return results
+
+    def test_walk_predictions(self):
+        results = self.walk('/predictions/?pagination=cursor&page_size=3')
+        self.assertEqual([result['video_timestamp']['start_time'] for result in results], list(range(7)))
+
+    def test_walk_queries(self):
+        results = self.walk('/queries/?pagination=cursor&page_size=2')
+        self.assertEqual(sorted(result['keyword'] for result in results), ['a', 'b', 'c'])
+
+    def test_walk_queries_while_searched(self):
+        # the cursor is keyed on the id, so keywords searched during the walk do not move between pages
+        response = self.client.get('/queries/?pagination=cursor&page_size=2').json()
+        for query in Query.objects.all():
+            query.update_used_keyword()
+        keywords = [result['keyword'] for result in response['results']]
+        keywords += [result['keyword'] for result in self.client.get(response['next']).json()['results']]
+        self.assertEqual(keywords, ['c', 'a', 'b'])
+
+    def test_page_number_pagination_is_default(self):
+        response = self.client.get('/video_time_stamps/')
+        self.assertEqual(response.json()['count'], 7)
+
+
+class GraphStatsTest(TestCase):
+    """Test the aggregated and cached stats of the /graph/ dashboard"""
+
+    def setUp(self):
+        cache.clear()
+        video = URL.objects.create(url='https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+        for start_time, end_time, prediction in [(0, 1.5, 'nh'), (2, 4, 'sh'), (4, 6, 'sh'), (6, 16, 'mu'), (16, 26, None)]:
+            timestamp = VideoTimeStamps.objects.create(video=video, start_time=start_time, end_time=end_time)
+            if prediction:
+                Prediction.objects.create(video_timestamp=timestamp, prediction=prediction)
+
+    def test_graph_stats(self):
+        stats = self.client.get('/graph/stats/').json()
+        self.assertEqual(stats['durations'], {'labels': ['<2', '2-5', '5-10', '>10'], 'counts': [1, 2, 0, 2]})
+        self.assertEqual(stats['predictions'], {'labels': ['mu', 'nh', 'sh'], 'counts': [1, 1, 2]})
+
+    def test_graph_stats_cache(self):
+        get_graph_stats()
+
+        # A cached request only looks up the latest ids
+        with self.assertNumQueries(2):
+            get_graph_stats()
+
+        # Inserts without signals invalidate the cache through the latest id
+        timestamp = VideoTimeStamps.objects.first()
+        Prediction.objects.bulk_create([Prediction(video_timestamp=timestamp, prediction='nh')])
+        self.assertEqual(get_graph_stats()['predictions']['counts'], [1, 2, 2])
+
+        # Deletes invalidate the cache through the signals
+        Prediction.objects.filter(prediction='mu').delete()
+        self.assertEqual(get_graph_stats()['predictions']['labels'], ['nh', 'sh'])
+
+
+def import_script(name):
+    '''Imports a script of the repository root (e.g. db_client.py), which is not on the path of manage.py'''
+    root = os.path.dirname(BASE_DIR)
+    if root not in sys.path:
+        sys.path.append(root)
+    return importlib.import_module(name)
+
+
+class PredictionCsvTest(TestCase):
+    '''Test reading a predictions csv file and the summary of an ingest (post_analysis.py)'''
+
+    def test_read_predictions_csv(self):
+        post_analysis = import_script('post_analysis')
+        csv_file = io.StringIO('Video Name,Start Time (s),End Time (s),Classification\r\n'
+                               'aaaaaaaaaaa,0.0,2.5,sh\r\naaaaaaaaaaa,2.5,5,mu\r\n')
+        self.assertEqual(post_analysis.read_predictions_csv(csv_file),
+                         [('aaaaaaaaaaa', 0.0, 2.5, 'sh'), ('aaaaaaaaaaa', 2.5, 5.0, 'mu')])
+
+    def test_print_ingest_summary(self):
+        post_analysis = import_script('post_analysis')
+        unmatched = [('aaaaaaaaaaa', float(second), second + 1.0, 'sh', 'timestamp not found') for second in range(22)]
+        output = io.StringIO()
+        with redirect_stdout(output):
+            post_analysis.print_ingest_summary({'rows': 25, 'inserted': 2, 'duplicates': 1, 'unmatched': unmatched})
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], '2 of 25 predictions inserted, 1 already stored, 22 rows unmatched')
+        self.assertEqual(lines[1], '  aaaaaaaaaaa 0.0-1.0 sh: timestamp not found')
+        self.assertEqual(lines[1:], [f'  aaaaaaaaaaa {row[1]}-{row[2]} sh: timestamp not found' for row in unmatched[:20]]
+                         + ['  ... 2 more'])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'db_client runs Postgres only SQL')
+class DatabaseClientTestCase(TransactionTestCase):
+    '''
+    Base of the tests of db_client.DatabaseClient on the test database. The client commits on connections
+    of its own, so the tests run outside of a test transaction and the tables are emptied after every test.
+    '''
+
+    def setUp(self):
+        db_client = import_script('db_client')
+        settings = connection.settings_dict
+        params = {'dbname': settings['NAME'], 'user': settings['USER'], 'password': settings['PASSWORD'],
+                  'host': settings['HOST'], 'port': settings['PORT']}
+        self.db = db_client.DatabaseClient({key: value for key, value in params.items() if value})
+        self.addCleanup(self.db.close)
+
+
+class PredictionIngestTest(DatabaseClientTestCase):
+    '''Test the bulk ingest of predictions: matched, duplicate and unmatched rows and the summary'''
+
+    def setUp(self):
+        super().setUp()
+        url = URL.objects.create(url='https://www.youtube.com/watch?v=aaaaaaaaaaa', video_id='aaaaaaaaaaa')
+        timestamps = [VideoTimeStamps.objects.create(video=url, start_time=start_time, end_time=end_time)
+                      for start_time, end_time in [(0.0, 2.5), (2.5, 5.0), (5.0, 7.5)]]
+        Prediction.objects.create(video_timestamp=timestamps[2], prediction='nh')
+        self.rows = [
+            ('aaaaaaaaaaa', 0.0, 2.5, 'sh'),
+            ('aaaaaaaaaaa', 2.5, 5.0, 'sm'),  # two rows of one timestamp
+            ('aaaaaaaaaaa', 2.5, 5.0, 'mu'),
+            ('aaaaaaaaaaa', 5.0, 7.5, 'sh'),  # the timestamp has a prediction
+            ('aaaaaaaaaaa', 7.5, 9.0, 'sh'),
+            ('bbbbbbbbbbb', 0.0, 2.5, 'sh'),
+        ]
+
+    def predictions(self):
+        return dict(Prediction.objects.values_list('video_timestamp__start_time', 'prediction'))
+
+    def csv_file(self):
+        csv_file = io.StringIO()
+        writer = csv.writer(csv_file)
+        writer.writerow(import_script('db_client').PREDICTION_CSV_COLUMNS)
+        writer.writerows(self.rows)
+        csv_file.seek(0)
+        return csv_file
+
+    def test_copy_predictions_csv(self):
+        summary = self.db.copy_predictions_csv(self.csv_file())
+        self.assertEqual((summary['rows'], summary['inserted'], summary['duplicates']), (6, 2, 2))
+        self.assertEqual(summary['unmatched'], [('aaaaaaaaaaa', 7.5, 9.0, 'sh', 'timestamp not found'),
+                                                ('bbbbbbbbbbb', 0.0, 2.5, 'sh', 'url not found')])
+        # one prediction per timestamp, the existing one is kept
+        self.assertEqual(self.predictions(), {0.0: 'sh', 2.5: 'mu', 5.0: 'nh'})
+
+        # the same file again only has duplicates
+        summary = self.db.copy_predictions_csv(self.csv_file())
+        self.assertEqual((summary['inserted'], summary['duplicates'], len(summary['unmatched'])), (0, 4, 2))
+        self.assertEqual(Prediction.objects.count(), 3)
+
+    def test_copy_predictions_csv_header(self):
+        with self.assertRaises(ValueError):
+            self.db.copy_predictions_csv(io.StringIO('video,start,end,label\r\naaaaaaaaaaa,0.0,2.5,sh\r\n'))
+        self.assertEqual(Prediction.objects.count(), 1)
+
+    def test_insert_predictions(self):
+        self.assertEqual(self.db.insert_predictions(self.rows), 2)
+        self.assertEqual(self.predictions(), {0.0: 'sh', 2.5: 'mu', 5.0: 'nh'})
+        self.assertEqual(self.db.insert_predictions(self.rows, page_size=2), 0)
+        self.assertEqual(Prediction.objects.count(), 3)
+
+
+class UrlLeaseTest(DatabaseClientTestCase):
+    '''Test the url queue of db_client: claims, leases, download failures and lost connections'''
+
+    def setUp(self):
+        super().setUp()
+        self.urls = [URL.objects.create(url=f'https://www.youtube.com/watch?v={i:011d}', video_id=f'{i:011d}')
+                     for i in range(6)]
+        self.ids = [url.id for url in self.urls]
+
+    def raw_connection(self):
+        psycopg2 = import_script('db_client').psycopg2
+        other = psycopg2.connect(**self.db.params)
+        self.addCleanup(other.close)
+        return other
+
+    def test_claim_urls(self):
+        claimed = self.db.claim_urls('w1', 2, 60)
+        self.assertEqual([row[0] for row in claimed], self.ids[:2])
+        self.assertEqual(set(URL.objects.filter(lease_owner='w1').values_list('id', flat=True)), set(self.ids[:2]))
+        # leased urls are not claimed again, processed urls never
+        self.db.mark_processed(url_ids=[self.ids[2]])
+        self.assertEqual([row[0] for row in self.db.claim_urls('w2', 10, 60)], self.ids[3:])
+        self.assertEqual(self.db.claim_urls('w3', 10, 60), [])
+
+    def test_claim_skips_locked_urls(self):
+        # another worker is in the middle of claiming the first urls
+        other = self.raw_connection()
+        with other.cursor() as cursor:
+            cursor.execute("SELECT id FROM api_url WHERE id = ANY(%s) FOR UPDATE", (self.ids[:3],))
+        claims = []
+        thread = threading.Thread(target=lambda: claims.extend(self.db.claim_urls('w1', 10, 60)))
+        thread.start()
+        thread.join(10)
+        # the claim does not wait for the locks
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([row[0] for row in claims], self.ids[3:])
+        other.rollback()
+        self.assertEqual([row[0] for row in self.db.claim_urls('w2', 10, 60)], self.ids[:3])
+
+    def test_concurrent_claims(self):
+        claims = {}
+
+        def claim(worker_id):
+            claims[worker_id] = [row[0] for row in self.db.claim_urls(worker_id, 2, 60)]
+
+        threads = [threading.Thread(target=claim, args=(f'w{i}',)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        claimed = [url_id for ids in claims.values() for url_id in ids]
+        self.assertEqual(sorted(claimed), self.ids)
+
+    def test_renew_and_release_leases(self):
+        self.db.claim_urls('w1', 2, 60)
+        # only the owner renews or releases a lease
+        self.assertEqual(self.db.renew_leases('w2', self.ids[:2], 600), 0)
+        self.assertEqual(self.db.renew_leases('w1', self.ids[:2], 600), 2)
+        expires_at = URL.objects.get(id=self.ids[0]).lease_expires_at
+        self.assertGreater(expires_at, timezone.now() + timedelta(seconds=300))
+        self.assertEqual(self.db.release_leases('w2', self.ids[:2]), 0)
+        self.assertEqual(self.db.release_leases('w1', self.ids[:1]), 1)
+        self.assertEqual(self.db.renew_leases('w1', [], 600), 0)
+        url = URL.objects.get(id=self.ids[0])
+        self.assertEqual((url.lease_owner, url.lease_expires_at), (None, None))
+        self.assertEqual([row[0] for row in self.db.claim_urls('w2', 1, 60)], self.ids[:1])
+
+    def test_expired_lease_is_claimed_again(self):
+        self.db.claim_urls('w1', 2, 60)
+        # the worker crashed and its leases ran out
+        URL.objects.filter(id=self.ids[0]).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([row[0] for row in self.db.claim_urls('w2', 1, 60)], self.ids[:1])
+        # the crashed worker can not renew the lease it lost
+        self.assertEqual(self.db.renew_leases('w1', self.ids[:2], 60), 1)
+        self.assertEqual(URL.objects.get(id=self.ids[0]).lease_owner, 'w2')
+
+    def test_record_download_failure(self):
+        url_id = self.ids[0]
+        self.db.claim_urls('w1', 1, 60)
+        start = timezone.now()
+        self.assertFalse(self.db.record_download_failure(url_id, 3, 100))
+        url = URL.objects.get(id=url_id)
+        self.assertEqual((url.download_attempts, url.lease_owner, url.is_processed), (1, None, False))
+        self.assertAlmostEqual((url.lease_expires_at - start).total_seconds(), 100, delta=30)
+        # the url waits out its retry, the next retry is twice as long
+        self.assertNotIn(url_id, [row[0] for row in self.db.claim_urls('w2', 10, 60)])
+        self.assertFalse(self.db.record_download_failure(url_id, 3, 100))
+        url = URL.objects.get(id=url_id)
+        self.assertAlmostEqual((url.lease_expires_at - start).total_seconds(), 200, delta=30)
+        # given up after max_attempts
+        self.assertTrue(self.db.record_download_failure(url_id, 3, 100))
+        url = URL.objects.get(id=url_id)
+        self.assertEqual((url.download_attempts, url.is_processed, url.lease_expires_at), (3, True, None))
+
+    def test_lost_connection(self):
+        db_client = import_script('db_client')
+        with self.db.transaction() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            pid = cursor.fetchone()[0]
+        # the server closes the pooled connection in the middle of a transaction
+        with self.assertRaises(db_client.psycopg2.OperationalError):
+            with self.db.transaction() as cursor:
+                with self.raw_connection().cursor() as other:
+                    other.execute("SELECT pg_terminate_backend(%s)", (pid,))
+                cursor.execute("SELECT 1")
+        # the lost connection is not handed out again
+        self.assertEqual(self.db.fetch_all("SELECT 1"), [(1,)])
+        self.assertEqual(len(self.db.claim_urls('w1', 10, 60)), 6)
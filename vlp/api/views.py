@@ -2,17 +2,22 @@ from rest_framework import viewsets
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.pagination import PageNumberPagination
-from .models import Video, Query, Prediction, VideoTimeStamps, URL
+from .models import Video, Query, Prediction, VideoTimeStamps, URL, KeywordImport
 from .forms import FileUploadForm
+from .pagination import CursorPaginationMixin
 from .serializers import VideoSerializer, PredictionSerializer, QuerySerializer, VideoTimeStampsSerializer, GroupedPredictionSerializer, URLSerializer
-from .helpers import add_keyword_to_Query, add_url_to_db
-from django.db.models import Prefetch
+from .helpers import add_url_to_db
+from .keyword_import import SYNC_IMPORT_BYTES, CHUNK_SIZE, run_import, store_upload
+from .tasks import import_keywords_file
+from django.db.models import Prefetch, F, Exists, OuterRef
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.db import transaction
+from django.http import JsonResponse
 from datetime import datetime
-import plotly.express as px
-import pandas as pd
+import functools
+from .stats import get_graph_stats
 from server.settings import DEBUG
 
 import logging
@@ -34,42 +39,63 @@ class VideoViewSet(viewsets.ModelViewSet):
         serializer.save()
 
 def upload_file(request):
+    '''
+    Imports an uploaded file of comma separated keywords into the Query model. Small files are imported
+    within the request in one transaction, larger ones are stored and imported by a Celery job, batch
+    by batch, see keyword_import.py.
+    The progress of an import is served by upload_status.
+    '''
+    keyword_import = None
     if request.method == 'POST':
         form = FileUploadForm(request.POST, request.FILES)
         if form.is_valid():
             uploaded_file = request.FILES['file']
-
-            # Process uploaded file to extract keywords
-            keywords_list = extract_keywords_from_file(uploaded_file)
-
-            # Save keywords to Query model
-            for keyword in keywords_list:
-                keyword = keyword.strip().lower()  # Ensure to strip whitespace, forces lowercase for no case sensitive duplicates
-                if keyword:  # Only process non-empty keywords
-                    add_keyword_to_Query(keyword)
-                    
+            keyword_import = KeywordImport.objects.create(file_name=uploaded_file.name[:255], total_bytes=uploaded_file.size)
+
+            if uploaded_file.size <= SYNC_IMPORT_BYTES:
+                run_import(keyword_import, uploaded_file.chunks(CHUNK_SIZE), atomic=True)
+                keyword_import.refresh_from_db()
+            else:
+                keyword_import.path = store_upload(uploaded_file)
+                keyword_import.save(update_fields=['path'])
+                transaction.on_commit(functools.partial(import_keywords_file.delay, keyword_import.id))
     else:
         form = FileUploadForm()
 
-    return render(request, 'upload_file.html', {'form': form})
-
-def extract_keywords_from_file(uploaded_file):
-    content = uploaded_file.read().decode('utf-8')
-    keywords = content.split(',')  # Split content into keywords (assuming comma-separated)
-    return keywords
-
-class QueryViewSet(viewsets.ReadOnlyModelViewSet):
+    return render(request, 'upload_file.html', {'form': form, 'keyword_import': keyword_import})
+
+
+def upload_status(request, import_id):
+    '''Status and progress of a keyword import'''
+    keyword_import = get_object_or_404(KeywordImport, id=import_id)
+    return JsonResponse({
+        'id': keyword_import.id,
+        'file_name': keyword_import.file_name,
+        'status': keyword_import.status,
+        'total_bytes': keyword_import.total_bytes,
+        'bytes_read': keyword_import.bytes_read,
+        'keywords': keyword_import.keywords,
+        'added': keyword_import.added,
+        'skipped': keyword_import.skipped,
+        'error': keyword_import.error,
+        'created_at': keyword_import.created_at,
+        'finished_at': keyword_import.finished_at,
+    })
+
+# The read-only viewsets below support ?pagination=cursor (&page_size=...) for walking them end to end
+
+class QueryViewSet(CursorPaginationMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Query.objects.all()
     serializer_class = QuerySerializer
     pagination_class = PageNumberPagination
 
-class PredictionViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Prediction.objects.all()
+class PredictionViewSet(CursorPaginationMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Prediction.objects.select_related('video_timestamp__video')
     serializer_class = PredictionSerializer
     pagination_class = PageNumberPagination
 
-class TimeStampViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = VideoTimeStamps.objects.all()
+class TimeStampViewSet(CursorPaginationMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = VideoTimeStamps.objects.select_related('video')
     serializer_class = VideoTimeStampsSerializer
     pagination_class = PageNumberPagination
 
@@ -78,21 +104,20 @@ class GroupedPredictionViewSet(viewsets.ReadOnlyModelViewSet):
     pagination_class = PageNumberPagination
 
     def get_queryset(self):
-        # Fetch unique video timestamps, ensuring each has a related video
-        return VideoTimeStamps.objects.select_related('video').distinct('video')
-
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        # Videos with at least one prediction, their predicted scenes are loaded with one
+        # additional query for the whole page, ordered by start time
+        predicted_scenes = VideoTimeStamps.objects.filter(prediction__isnull=False) \
+            .annotate(prediction_label=F('prediction__prediction')) \
+            .order_by('start_time', 'id') \
+            .only('id', 'video_id', 'start_time', 'end_time')
+
+        return URL.objects.filter(Exists(Prediction.objects.filter(video_timestamp__video=OuterRef('pk')))) \
+            .order_by('id') \
+            .only('id', 'url') \
+            .prefetch_related(Prefetch('videotimestamps_set', queryset=predicted_scenes, to_attr='predicted_scenes'))
     
-class URLViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = URL.objects.all()
+class URLViewSet(CursorPaginationMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = URL.objects.select_related('came_from_keyword')
     serializer_class = URLSerializer
     pagination_class = PageNumberPagination
 
@@ -116,73 +141,10 @@ def graph(request):
     
          ]
 
+    # The charts are drawn in the browser from the aggregated stats of graph_stats
+    return render(request, 'graph.html')
 
 
-    try:
-        timestamps = VideoTimeStamps.objects.all()
-        logger.info(f"Fetched {len(timestamps)} timestamps from the database.")
-
-        if not timestamps:
-            logger.warning("No timestamps found in the database.")
-
-        durations = [(ts.end_time - ts.start_time) for ts in timestamps]
-        
-
-        if not durations:
-            logger.warning("No durations calculated.")
-        
-
-        df1 = pd.DataFrame({'duration': durations})
-        # logger.info(df)
-
-        # Define bins and labels
-        bins = [-float('inf'), 2, 5, 10, float('inf')]
-        labels = ['<2', '2-5', '5-10', '>10']
-        # Categorize 'duration' column
-        df1['duration_category'] = pd.cut(df1['duration'], bins=bins, labels=labels, right=False)
-        # logger.info(df)
-
-        hist1 = px.histogram(df1, x='duration_category', title='Video Duration Histogram'
-                            # nbins=25 
-                            # histfunc= 'avg'
-                           )
-
-        hist1_chart = hist1.to_html(full_html = False, include_plotlyjs = False)
-
-        # logger.warn(hist_chart)
-
-        if DEBUG:
-            return render(request, 'graph.html', {'hist1_chart': hist1_chart})
-
-    except Exception as e:
-        logger.error(f"Error occurred: {str(e)}")
-        return 
-    
-    try:
-        predictions = Prediction.objects.all()
-        logger.info(f"Fetched {len(predictions)} Predictions from the database.")
-
-        if not predictions:
-            logger.warning("No Predictions found in the database.")
-
-        predictions = [pr.prediction for pr in predictions]
-        
-
-        df2 = pd.DataFrame({'predictions': predictions})
-        # logger.info(df2)
-
-        hist2 = px.histogram(df2, x='predictions', title='Predictions Histogram')
-
-        hist2_chart = hist2.to_html(full_html = False, include_plotlyjs = False)
-
-        # logger.info(hist2_chart)
-
-        
-        return render(request, 'graph.html', {'hist1_chart': hist1_chart,'hist2_chart': hist2_chart })
-
-    except Exception as e:
-        logger.error(f"Error occurred: {str(e)}")
-        return 
-    
-
-
+def graph_stats(request):
+    '''Aggregated duration and prediction counts the /graph/ dashboard is rendered from'''
+    return JsonResponse(get_graph_stats())
@@ -0,0 +1,23 @@
+import re
+
+
+# Watch, shorts, embed, live and youtu.be urls all carry the 11 character video id
+VIDEO_ID_PATTERN = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])'
+)
+
+
+def extract_video_id(url):
+    '''
+    Returns the canonical YouTube video id of a watch, shorts or youtu.be url.
+    Returns None if the url is not a YouTube video url.
+    '''
+    if not url:
+        return None
+    match = VIDEO_ID_PATTERN.search(url)
+    return match.group(1) if match else None
+
+
+def watch_url(video_id):
+    '''Returns the watch url of a YouTube video id'''
+    return f"https://www.youtube.com/watch?v={video_id}"
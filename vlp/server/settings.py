@@ -196,6 +196,27 @@ LOGGING = {
 CELERY_BROKER_URL = 'redis://localhost:6379/0' 
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
+# The dashboard stats (see api/stats.py) are invalidated by the analysis workers, so the web workers
+# need a cache they share with them. The local memory cache of development only reaches its own process
+if DEBUG or ENV != "production":
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/1'),
+        }
+    }
+
+# The YouTube search quota used per day is counted here, shared by all workers (see api/search.py).
+# Outside of production it is not set by default and every process counts its own quota
+SEARCH_QUOTA_REDIS_URL = os.environ.get('SEARCH_QUOTA_REDIS_URL',
+                                        None if DEBUG or ENV != "production" else CELERY_BROKER_URL)
+
 CELERY_BEAT_SCHEDULE = {
     'query-search-every-24-hours': {
         'task': 'api.tasks.query_search',
@@ -203,8 +224,28 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': 3600*24,  # Run every 24hours
         # 'schedule': 10,  # Run every 10 seconds
     },
+    'process-urls-every-hour': {
+        'task': 'api.tasks.process_urls',
+        'schedule': 3600,  # Run every hour
+    },
 }
 
+# The url pipeline (see api/tasks.py) runs on dedicated queues: downloads are I/O bound and run with a high
+# concurrency, scene detection and pose classification are CPU bound and run with one process per core or less.
+# Every queue gets its own worker, see start_project.sh
+# The tasks pass the path of the downloaded video on, not the video, so the downloads and the analysis workers
+# must share the download directory: run them on one host, or mount the same volume on every host and point
+# VIDEO_DOWNLOAD_DIR (see api/helpers.py) to it
+CELERY_TASK_ROUTES = {
+    'api.tasks.download_url': {'queue': 'downloads'},
+    'api.tasks.detect_scenes': {'queue': 'analysis'},
+    'api.tasks.classify_scenes': {'queue': 'analysis'},
+}
+
+# A worker reserves only one task per process, so long analysis tasks do not wait behind each other
+# on one worker while another one is idle
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 50
@@ -20,6 +20,8 @@ urlpatterns = [
     path('', include(router.urls)),
     path("robots.txt", TemplateView.as_view(template_name="robots.txt", content_type="text/plain")),
     path('upload/', views.upload_file, name='upload_file'),
+    path('upload/status/<int:import_id>/', views.upload_status, name='upload_status'),
     path('graph/', views.graph, name='graph'),
+    path('graph/stats/', views.graph_stats, name='graph_stats'),
 #     path('api-auth/', include('rest_framework.urls', namespace='rest_framework'))
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file